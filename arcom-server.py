@@ -11,31 +11,79 @@
    http://www.arcomcontrollers.com/images/documents/rc210/rcpprotocol.pdf
 
 """
+import atexit
+import collections
 import datetime
+import events
 import fcntl
+import history
 import optparse
 import logging
 import logging.handlers
+import log_queue
+import metrics
 import os
 import pickle
+import poller
+import scheduler
 import signal
 import sys
 import threading
 import time
-from time import sleep
+import tracing
 from configparser import ConfigParser
 import serial
+import serial_engine
 import weblog_Google as weblog
 import web_server
 
 configDefaults = {
-    'serialDevice': '/dev/ttyUSB0'
+    'serialDevice': '/dev/ttyUSB0',
+    'commandTimeout': str(serial_engine.DEFAULT_TIMEOUT),
+    'trustWindow': '5',
+    'logFormat': 'text',
+    'logQueueSize': str(log_queue.DEFAULT_SIZE),
 }
 
-LOG_HISTORY_SIZE = 100
+# State changes made by a successful command, keyed by [arcom commands]
+# option name (the config parser lower cases option names).
+COMMAND_STATE = {
+    'port1disable': ('port1Enabled', False),
+    'port1enable': ('port1Enabled', True),
+    'port3unbridge': ('port3Bridged', False),
+    'port3bridge': ('port3Bridged', True),
+}
+
+# Serial priority class of [arcom commands] entries; the rest are
+# serial_engine.OPERATOR.  A macro takes its most urgent step's class.
+COMMAND_PRIORITY = {
+    'port1disable': serial_engine.SAFETY,
+}
+# Seconds setDateTime may wait for the port.  The clock is read as the
+# commands are sent, so this only bounds how late a sync may happen.
+DATETIME_DEADLINE = 5.0
+# Seconds before a failed timed enable of port 1 is tried again.
+AUTO_ENABLE_RETRY = 30
+
+# Methods fanOut may run on several controllers at once, and that
+# [arcom schedule] may run.
+FANOUT_METHODS = (
+    'port1Disable', 'port1Enable', 'port3Unbridge', 'port3Bridge',
+    'restart', 'setDateTime', 'runMacro', 'status',
+)
+
+LOG_HISTORY_SIZE = 10000
 debugFile = 'arcom.commands'
 historyFile = 'arcom.history'
+journalFile = 'arcom.journal'
+traceFile = 'arcom.traces'
+scheduleFile = 'arcom.schedule'
+SCHEDULE_AUTH = 'SCHEDULE'
+indexFile = 'arcom.db'
+CONTROLLER_PREFIX = 'controller '
 logFile = 'arcom.log'
+configFile = 'arcom-server.conf'
+reloadLock = threading.Lock()
 logFormat = '%(levelname)-7s %(asctime)s %(threadName)s %(message)s'
 """
 logging.basicConfig(
@@ -44,8 +92,44 @@ logging.basicConfig(
 )
 """
 log = logging.getLogger('arcom')
-log.addHandler(logging.handlers.RotatingFileHandler(
-    logFile, maxBytes=512*1024, backupCount=5))
+
+
+def section_options(cfg, section):
+  """Options set in section itself, whatever their values, rather than
+     inherited defaults.
+     """
+  return dict((key, cfg.get(section, key)) for key in cfg._sections[section])
+
+
+def controller_devices(cfg):
+  """The names of the [controller NAME] sections in cfg, in order, with
+     each one's serialDevice.  Raises ValueError if one has no device of
+     its own or two share one, as two serial engines on a port would
+     take each other's answers.
+     """
+  devices = collections.OrderedDict()
+  for section in cfg.sections():
+    if not section.startswith(CONTROLLER_PREFIX):
+      continue
+    device = section_options(cfg, section).get('serialdevice')
+    if not device:
+      raise ValueError('[%s] needs a serialDevice of its own' % section)
+    for other, used in devices.items():
+      if used == device:
+        raise ValueError('[%s] serialDevice %s is already used by '
+                         'controller %s' % (section, device, other))
+    devices[section[len(CONTROLLER_PREFIX):].strip()] = device
+  return devices
+
+
+def controller_file(filename, name):
+  """arcom.journal for the unnamed controller, arcom-NAME.journal for
+     controller NAME.
+     """
+  if not name:
+    return filename
+  base, ext = os.path.splitext(filename)
+  return '%s-%s%s' % (base, name, ext)
 
 
 class Arcom(object):
@@ -53,23 +137,43 @@ class Arcom(object):
      We maintain current state and interact with the serial port
      It's OK to hard code the serial setup as the Arcom serial
      settings are fixed.
+
+     A named controller takes its serialDevice, identity,
+     commandTimeout and any command codes that differ from [arcom
+     commands] from its [controller NAME] section, and keeps its
+     history in files of its own.  All but the serial device are
+     re-read by reload().
+
+     Port state and any pending auto-enable are kept by the scheduler,
+     which saves them, so they survive a restart.
      """
-  def __init__(self, opt, cfg):
+  def __init__(self, opt, cfg, weblogger, schedules, name=''):
     """open and configure serial port"""
-    self.cfg = cfg
+    self.name = name
     self.testing = opt.testing
-    self.weblog = weblog.LogGoogle(cfg, opt.testing)
-    self.arcomLock = threading.Lock()
-    self.port1Lock = threading.Lock()
-    self.port1Enabled = True
-    self.enableTimer = None
-    self.port3Bridged = True
-    self.identity = cfg.get('arcom server', 'identity')
+    self.weblog = weblogger
+    own = self.apply_settings(self.read_settings(cfg))
+    self.device = own.get('serialdevice') or opt.device
+    self.port1Lock = metrics.TimedLock(metrics.lock_wait_seconds,
+                                       metrics.lock_hold_seconds,
+                                       (controller_file('port1', name),))
+    self.schedules = schedules
+    saved = schedules.state.get(name, {})
+    self.port1Enabled = saved.get('port1Enabled', True)
+    self.port3Bridged = saved.get('port3Bridged', True)
+    self.enableJob = None
     self.autoEnableTime = None
+    for job in schedules.list():
+      if job['controller'] == name and job['action'] == 'port1Enable':
+        self.enableJob = job['id']
+        self.autoEnableTime = job['due']
+    self.confirmed = {}         # state attr -> when the controller confirmed it
+    self.changes = events.ChangeNotifier(self.statusSnapshot)
+    self.changes.listeners.append(self.save_state)
     self.load_history(LOG_HISTORY_SIZE)
     if not opt.testing:
       self.serialport = serial.Serial(
-          port=opt.device,
+          port=self.device,
           baudrate=9600,
           parity=serial.PARITY_NONE,
           stopbits=serial.STOPBITS_ONE,
@@ -77,186 +181,330 @@ class Arcom(object):
           timeout=.1
           )
     else:
-      self.serialport = open(debugFile, 'w')
-
-  def register_functions(self, server):
-    """Register externally callable methods with XMLRPC server."""
-    server.register_function(self.port1Disable)
-    server.register_function(self.port1Enable)
-    server.register_function(self.port3Unbridge)
-    server.register_function(self.port3Bridge)
-    server.register_function(self.restart)
-    server.register_function(self.setDateTime)
-    server.register_function(self.status)
-    server.register_function(self.getLog)
-    server.register_function(self.logInterference)
-    server.register_function(self.setViolator)
+      self.serialport = open(controller_file(debugFile, name), 'w')
+    self.engine = serial_engine.SerialEngine(
+        self.serialport,
+        timeout=self.commandTimeout,
+        testing=opt.testing)
+    self.events = events.EventRing()
+    self.engine.listeners.append(self.controller_output)
+    self.poller = None
+    interval, quiet, polls = poller.read_polls(
+        cfg, set(attr for attr, _ in COMMAND_STATE.values()))
+    if polls and not opt.testing:
+      self.poller = poller.StatePoller(
+          self.engine, polls, self.reconcile, interval, quiet,
+          name=controller_file('poller', name))
+      self.poller.start()
+
+  def read_settings(self, cfg):
+    """Read the command codes and settings from cfg without using them,
+       so a bad value raises here and leaves the old settings in place.
+       Returns them for apply_settings().
+       """
+    own = {}
+    if self.name:
+      own = section_options(cfg, CONTROLLER_PREFIX + self.name)
+    commands = section_options(cfg, 'arcom commands')
+    commands.update(own)
+    def setting(key):
+      return own.get(key.lower()) or cfg.get('arcom server', key)
+    return {'cfg': cfg,
+            'own': own,
+            'commands': commands,
+            'identity': setting('identity'),
+            'trustWindow': float(setting('trustWindow')),
+            'commandTimeout': float(setting('commandTimeout'))}
+
+  def apply_settings(self, settings):
+    """Use settings from read_settings().  Returns this controller's own
+       section.
+       """
+    self.cfg = settings['cfg']
+    self.commands = settings['commands']
+    self.identity = settings['identity']
+    self.trustWindow = settings['trustWindow']
+    self.commandTimeout = settings['commandTimeout']
+    return settings['own']
+
+  def reload_settings(self, cfg):
+    """read_settings() for a re-read config, which may not move the
+       controller to another serial device without a restart.
+       """
+    settings = self.read_settings(cfg)
+    device = settings['own'].get('serialdevice')
+    if device and device != self.device:
+      raise ValueError('%s: serialDevice change to %s needs a restart'
+                       % (self.name or 'arcom', device))
+    return settings
+
+  def reload(self, settings):
+    """Apply settings from reload_settings() without closing the serial
+       port.
+       """
+    self.apply_settings(settings)
+    self.engine.timeout = self.commandTimeout
+    self.changes.notify()
 
+  def register_functions(self, server, prefix=''):
+    """Register externally callable methods with XMLRPC server.
+       Names are prefixed with prefix, e.g. 'north.' for controller north.
+       """
+    for func in (self.port1Disable, self.port1Enable, self.port3Unbridge,
+                 self.port3Bridge, self.restart, self.setDateTime,
+                 self.status, self.getLog, self.queryLog,
+                 self.logInterference, self.weblogStatus, self.setViolator,
+                 self.runMacro, self.getTraces, self.getEvents,
+                 self.serialStatus):
+      server.register_function(func, prefix + func.__name__)
+
+  def command(self, name):
+    """The code for [arcom commands] entry name on this controller."""
+    return self.commands[name.lower()]
+
+  @tracing.traced('authlog')
   def authlog(self, auth, string, history=True, level=logging.INFO):
     """We log to a file and the in memory queue."""
-    log.log(level, '[%s] %s', auth, string)
+    if self.name:
+      log.log(level, '[%s] %s: %s', auth, self.name, string)
+    else:
+      log.log(level, '[%s] %s', auth, string)
     if history:
       self.history.append((time.time(), auth, string))
-      while len(self.history) > LOG_HISTORY_SIZE:
-        del self.history[0]
-      try:
-        with open(historyFile, "w") as f:
-          pickle.dump(self.history, f)
-      except IOError as e:
-        log.error('dumping to %s: %s', historyFile, e)
+      self.changes.notify(force=True)
 
   def load_history(self, num_entries):
-    """Read pickled entries from history file and initialize
-       self.history with tuples of (time, call, string).
-       Truncate to the max size.
+    """Open the history journal, keeping up to num_entries tuples of
+       (time, call, string) in memory, and the index that holds all of
+       it.  A pickled history file from older versions is imported into
+       a new journal.
        """
     log.debug('Loading max of %d log entries.', num_entries)
-    try:
-      with open(historyFile) as f:
-        self.history = pickle.load(f)
-    except IOError as e:
-      log.error('error loading %s: %s', historyFile, e)
-      self.history = []
-    while len(self.history) > LOG_HISTORY_SIZE:
-      del self.history[0]
-    log.info('Loaded %d entries to history', len(self.history))
-
-
-  def cmdSend(self, command):
-    """Sends one command to the controller after clearing stream.
-       This interaction with the Arcom controller is protected
-       by a lock since we have some asynchronous activites in
-       separate threads (like re-enabling after a timeout).
-       """
-    status = False
-
-    def clrBuff():
-      """Swallow any pending output from the controller."""
-      if self.testing:
+    self.history = history.HistoryJournal(
+        controller_file(journalFile, self.name), num_entries)
+    atexit.register(self.history.close)
+    self.historyIndex = history.HistoryIndex(
+        controller_file(indexFile, self.name))
+    self.historyIndex.sync(self.history.tail(num_entries))
+    self.history.listeners.append(self.historyIndex.add)
+    if (not self.name and not len(self.history) and
+        os.path.exists(historyFile)):
+      try:
+        with open(historyFile) as f:
+          entries = pickle.load(f)
+      except (IOError, pickle.PickleError) as e:
+        log.error('error importing %s: %s', historyFile, e)
         return
-      indata = ''
-      count = 0
-      while count < 5:
-        indata = self.serialport.readline()
-        log.debug('clrBuff received: %s', indata)
-        count += 1
-      self.serialport.write('\r')
-
-    self.arcomLock.acquire()
-    clrBuff()
-    sleep(0.1)
-    command = '1*' + command + '\r\n'
-    log.debug(' Sending: %s', command)
-    self.serialport.write(str(command))
-    if self.testing:
-      self.serialport.flush()
-      self.arcomLock.release()
-      return True, 'TESTING MODE'
-
-    sleep(0.1)
-    indata = self.serialport.readline()
-    log.debug('received from arcom: ' + indata)
-    if indata.startswith("+"):
-      msg = 'succeeded'
-      status = True
-    elif indata.startswith("-"):
-      msg = 'failed: %s' % command
-    else:
-      msg = "unexpected response: %s" % indata
-    log.debug(msg)
-    clrBuff()
-    self.arcomLock.release()
+      for entry in entries[-num_entries:]:
+        self.history.append(entry)
+      self.history.commit()
+      log.info('Imported %d entries from %s', len(entries), historyFile)
+
+
+  def cmdSend(self, command, priority=serial_engine.OPERATOR, target=None):
+    """Sends one command to the controller and waits for its answer.
+       The serial engine's executor thread serializes access to the
+       port since we have some asynchronous activites in separate
+       threads (like re-enabling after a timeout), taking the most
+       urgent priority class first.
+       """
+    return self.engine.send(command, priority=priority, target=target)
+
+  def stateSend(self, name, priority=None):
+    """Send [arcom commands] entry name, one of COMMAND_STATE, and
+       record the state it sets.  priority is its serial priority class,
+       by default from COMMAND_PRIORITY.  If the controller confirmed that state
+       within the last trustWindow seconds, and no command for it is
+       queued or being sent, the command is skipped.
+       """
+    attr, value = COMMAND_STATE[name.lower()]
+    if (getattr(self, attr) == value and
+        time.time() - self.confirmed.get(attr, 0) < self.trustWindow and
+        self.engine.pending(attr) is None):
+      metrics.commands_saved.inc(('skipped',))
+      return True, 'succeeded (skipped, %s already %s)' % (attr, value)
+    if priority is None:
+      priority = COMMAND_PRIORITY.get(name.lower(), serial_engine.OPERATOR)
+    status, msg = self.cmdSend(self.command(name), priority, attr)
+    # An opposite command queued since will record its own state.
+    if status and self.engine.pending(attr) in (None, self.command(name)):
+      setattr(self, attr, value)
+      self.confirmed[attr] = time.time()
     return status, msg
 
+  def reconcile(self, attr, value, generation):
+    """Take a polled state value unless one of our own commands ran
+       since it was read.  A difference is logged as drift.
+       """
+    if self.engine.generation != generation:
+      return
+    current = getattr(self, attr)
+    if current == value:
+      return
+    self.confirmed[attr] = time.time()
+    setattr(self, attr, value)
+    metrics.state_drift.inc((attr,))
+    self.authlog('POLL', 'Drift: %s was %s, controller reports %s' % (
+        attr, current, value))
+
+  def save_state(self, snapshot):
+    """Have the scheduler save our port state.  A change listener."""
+    self.schedules.save_state(self.name, {
+        'port1Enabled': snapshot['port1Enabled'],
+        'port3Bridged': snapshot['port3Bridged']})
+
+  def cancel_auto_enable(self, auth):
+    """Drop the pending auto-enable, if any.  Called with port1Lock held."""
+    if self.enableJob:
+      log.info('[%s] Timer cancelled', auth)
+      self.schedules.cancel(self.enableJob)
+      self.enableJob = None
+      self.autoEnableTime = None
+
   def port1Disable(self, auth, interval=0):
     """Disable Port 1 (the main repeater) and optionally set enable timer
-       We always disable in case our state is out of sync, then
-       if there is not already a enableTimer running, we create and
-       start one.  This will re-enable the repeater after interval seconds.
-       Manipulation of port 1 is protected with a lock.
+       We disable unless the controller confirmed port 1 off within
+       the trust window, in case our state is out of sync, then
+       if there is not already an auto-enable scheduled, we schedule
+       one.  This will re-enable the repeater after interval seconds.
+       port1Lock covers the timer, not the wait for the port, so a
+       disable is never held up behind a queued enable or macro.
        """
-    self.port1Lock.acquire()
     msg = 'Port 1 OFF'
     if interval:
       msg += ' (with %d second timer)' % interval
-    if self.enableTimer:
-      secs_left = int(self.autoEnableTime - time.time())
-      log.info('[%s] Timed disable already active (%d secs left)', auth, secs_left)
-      self.port1Lock.release()
-      return False, "Timed disable already active (%d secs left)" % secs_left
+    with self.port1Lock:
+      if self.enableJob:
+        secs_left = int(self.autoEnableTime - time.time())
+        log.info('[%s] Timed disable already active (%d secs left)', auth, secs_left)
+        return False, "Timed disable already active (%d secs left)" % secs_left
     self.authlog(auth, msg)
-    status, msg = self.cmdSend(self.cfg.get('arcom commands', 'port1Disable'))
-    if status:
-      self.port1Enabled = False
-      if interval > 0:
-        if not self.enableTimer:
+    status, msg = self.stateSend('port1Disable')
+    if status and interval > 0:
+      with self.port1Lock:
+        if not self.enableJob:
           log.info('[%s] Setting enable timer for %d seconds', auth, interval)
-          self.enableTimer = threading.Timer(interval, self.port1Enable, [auth, True])
-          self.enableTimer.start()
-          self.autoEnableTime = time.time() + float(interval)
-    self.port1Lock.release()
+          self.schedule_auto_enable(auth, interval)
+    self.changes.notify()
     return status, msg
 
+  def schedule_auto_enable(self, auth, interval):
+    """Enable port 1 in interval seconds.  Called with port1Lock held."""
+    self.autoEnableTime = time.time() + float(interval)
+    self.enableJob = self.schedules.add(
+        'port1Enable', [auth, True], self.autoEnableTime, self.name)
+
   def port1Enable(self, auth, fromTimer=False):
-    """Enable Port 1.  Like port1Disable, its protected by the same lock."""
-    self.port1Lock.acquire()
+    """Enable Port 1.  The timer's enable is sent as SAFETY, so it never
+       expires in the queue, and if it fails it is tried again
+       AUTO_ENABLE_RETRY seconds later rather than leaving port 1 off.
+       """
     if fromTimer:
       log.info('[%s] Timer expired, re-enabling repeater', auth)
     self.authlog(auth, 'Port 1 ON')
-    status, msg = self.cmdSend(self.cfg.get('arcom commands', 'port1Enable'))
-    if status:
-      self.port1Enabled = True
-    if self.enableTimer:
-      log.info('[%s] Timer cancelled', auth)
-      self.enableTimer.cancel()
-      self.enableTimer = None
-      self.autoEnableTime = None
-    self.port1Lock.release()
+    status, msg = self.stateSend(
+        'port1Enable', serial_engine.SAFETY if fromTimer else None)
+    with self.port1Lock:
+      if status or not fromTimer:
+        self.cancel_auto_enable(auth)
+      else:
+        log.warning('[%s] Timed enable failed (%s), retrying in %ds',
+                    auth, msg, AUTO_ENABLE_RETRY)
+        self.schedule_auto_enable(auth, AUTO_ENABLE_RETRY)
+    self.changes.notify()
     return status, msg
 
   def port3Unbridge(self, auth):
     self.authlog(auth, 'Unbridge Port 1-3')
-    status, msg = self.cmdSend(self.cfg.get('arcom commands', 'port3Unbridge'))
+    status, msg = self.stateSend('port3Unbridge')
     if status:
-      self.port3Bridged = False
+      self.changes.notify()
     return status, msg
 
   def port3Bridge(self, auth):
     self.authlog(auth, 'Bridge Port 1-3')
-    status, msg = self.cmdSend(self.cfg.get('arcom commands', 'port3Bridge'))
+    status, msg = self.stateSend('port3Bridge')
     if status:
-      self.port3Bridged = True
+      self.changes.notify()
     return status, msg
 
   def restart(self, auth):
     self.authlog(auth, 'Restart')
-    _, _ = self.cmdSend(self.cfg.get('arcom commands', 'restart'))
+    _, _ = self.cmdSend(self.command('restart'))
     return True, 'Restarting...'
 
   def setDateTime(self, auth):
     self.authlog(auth, 'Set Date/Time')
-    now = datetime.datetime.now()
-    datestring = now.strftime('%m%d%y')
-    timestring = now.strftime('%H%M%S')
-    datestring = self.cfg.get('arcom commands', 'setDate') + datestring
-    timestring = self.cfg.get('arcom commands', 'setTime') + timestring
-    status, msg = self.cmdSend(datestring)
-    if not status:
-      return status, msg
-    sleep(.5)
-    self.cmdSend(timestring)
-    if status:
-      return True, "Date/Time set to (%s, %s)" % (datestring[-6:], timestring[-6:])
-    else:
-      return status, msg
+    sent = {}
+    def clock(code, fmt):
+      """The command for code, built from the clock when the executor
+         sends it.  Both steps use the first step's reading, so a sync
+         across midnight cannot set the new time with the old date.
+         """
+      def command():
+        if 'now' not in sent:
+          sent['now'] = datetime.datetime.now()
+        return code + sent['now'].strftime(fmt)
+      return command
+    results = self.engine.send_many(
+        [clock(self.command('setDate'), '%m%d%y'),
+         clock(self.command('setTime'), '%H%M%S')],
+        priority=serial_engine.MAINTENANCE, deadline=DATETIME_DEADLINE)
+    for status, msg in results:
+      if not status:
+        return status, msg
+    return True, "Date/Time set to (%s, %s)" % (
+        sent['now'].strftime('%m%d%y'), sent['now'].strftime('%H%M%S'))
+
+  def macros(self):
+    """Return dict of macro name to list of [arcom commands] names."""
+    macros = {}
+    if self.cfg.has_section('arcom macros'):
+      defaults = self.cfg.defaults()
+      for name in self.cfg.options('arcom macros'):
+        if name not in defaults:
+          steps = self.cfg.get('arcom macros', name).split(',')
+          macros[name] = [step.strip() for step in steps if step.strip()]
+    return macros
+
+  def runMacro(self, auth, name):
+    """Run a macro from [arcom macros] in a single session on the port.
+       Returns (status, results) with a (step, status, msg) tuple for
+       each step attempted; the macro stops at the first failure.
+       """
+    steps = self.macros().get(name.lower())
+    if not steps:
+      self.authlog(auth, 'Macro %s: not defined' % name)
+      return False, [(name, False, 'unknown macro')]
+    for step in steps:
+      if step.lower() not in self.commands:
+        self.authlog(auth, 'Macro %s: unknown command %s' % (name, step))
+        return False, [(step, False, 'unknown command')]
+    self.authlog(auth, 'Macro %s (%s)' % (name, ', '.join(steps)))
+    commands = [self.command(step) for step in steps]
+    priority = min(COMMAND_PRIORITY.get(step.lower(), serial_engine.OPERATOR)
+                   for step in steps)
+    results = []
+    sent = self.engine.send_many(commands, priority=priority)
+    with self.port1Lock:
+      for step, (status, msg) in zip(steps, sent):
+        results.append((step, status, msg))
+        if status and step.lower() in COMMAND_STATE:
+          attr, value = COMMAND_STATE[step.lower()]
+          setattr(self, attr, value)
+          self.confirmed[attr] = time.time()
+          if step.lower() == 'port1enable':
+            self.cancel_auto_enable(auth)
+    self.changes.notify()
+    status = len(results) == len(steps) and all(r[1] for r in results)
+    return status, results
 
   def logInterference(self, auth, location, seconds):
     self.authlog(auth, 'Log Interference %s, %d seconds' % (location, seconds))
     return self.weblog.log(auth, location, seconds/60)
 
-  def status(self, auth):
-    """Non-Standard: returns dict"""
-    self.authlog(auth, "Status Request", history=False, level=logging.DEBUG)
+  def statusSnapshot(self):
+    """Current state as returned by status()."""
     status = {
         'identity': self.identity,
         'port1Enabled': self.port1Enabled,
@@ -268,11 +516,92 @@ class Arcom(object):
       status['auto-enable'] = self.autoEnableTime
     return status
 
+  def weblogStatus(self, auth):
+    """Non-Standard: returns dict of weblog outbox depth and latency."""
+    self.authlog(auth, "Weblog Status Request", history=False,
+                 level=logging.DEBUG)
+    return self.weblog.stats()
+
+  def status(self, auth):
+    """Non-Standard: returns dict"""
+    self.authlog(auth, "Status Request", history=False, level=logging.DEBUG)
+    return self.statusSnapshot()
+
+  def waitStatus(self, auth, since, timeout):
+    """Wait up to timeout seconds for the status to change from version
+       since.  Returns a dict of the new version, the status and the
+       keys that changed.  Used by the web server's /status long-poll.
+       """
+    self.authlog(auth, "Status Wait (since %d)" % since, history=False,
+                 level=logging.DEBUG)
+    version, status, changed = self.changes.wait(since, timeout)
+    return {'version': version, 'status': status, 'changed': changed}
+
+  def serialStatus(self, auth):
+    """Non-Standard: returns a dict of the serial queue depth and the
+       oldest job's wait in seconds, by priority class, and whether a
+       job is running.
+       """
+    self.authlog(auth, "Serial Status", history=False, level=logging.DEBUG)
+    return self.engine.stats()
+
+  def controller_output(self, seconds, line):
+    """Keep a line of unsolicited controller output as an event."""
+    event = self.events.add(seconds, line.decode('utf-8', 'replace'))
+    metrics.controller_events.inc((event['kind'],))
+
+  def getEvents(self, auth, since=0, limit=events.EVENT_LIMIT):
+    """Non-Standard: returns a dict with the controller's unsolicited
+       output after event number since, oldest first, as dicts of seq,
+       time, kind and text, plus the seq to pass next time and how many
+       events were missed.  Does not wait; /events does.
+       """
+    self.authlog(auth, "Events (since %d)" % since, history=False,
+                 level=logging.DEBUG)
+    return self.events.wait(since, 0, limit)
+
+  def waitEvents(self, auth, since, timeout):
+    """Like getEvents, but waits up to timeout seconds for an event.
+       Used by the web server's /events long-poll.
+       """
+    self.authlog(auth, "Events Wait (since %d)" % since, history=False,
+                 level=logging.DEBUG)
+    return self.events.wait(since, timeout)
+
   def getLog(self, auth, num_entries):
     """Non-Standard: returns an array of strings, possibly empty"""
+    entries = self.history.tail(num_entries)
     self.authlog(auth, "Log Request - %d entries, returning %d" % (
-        num_entries, len(self.history[-num_entries:])))
-    return self.history[-num_entries:]
+        num_entries, len(entries)))
+    return entries
+
+  def queryLog(self, auth, call='', action='', start=0, end=0,
+               cursor=0, limit=50):
+    """Non-Standard: returns a dict with a page of (time, call, string)
+       entries, newest first, and the cursor for the next page (0 when
+       there are no more).  Empty or zero filters match everything.
+       """
+    entries, cursor = self.historyIndex.query(call, action, start, end,
+                                              cursor, limit)
+    self.authlog(auth, "Log Query - call '%s', action '%s', returning %d" % (
+        call, action, len(entries)), level=logging.DEBUG)
+    return {'entries': entries, 'cursor': cursor}
+
+  def exportLog(self, auth, call='', action='', start=0, end=0):
+    """Generate (time, call, action, string) for the /export page,
+       oldest first.
+       """
+    self.authlog(auth, "Log Export - call '%s', action '%s'" % (call, action),
+                 history=False)
+    return self.historyIndex.export(call, action, start, end)
+
+  def getTraces(self, auth, limit=100, min_ms=0):
+    """Non-Standard: returns the newest limit request traces that took
+       at least min_ms milliseconds, newest first.  Each is a tree of
+       spans with start offsets and durations in milliseconds.
+       """
+    self.authlog(auth, "Trace Request", history=False, level=logging.DEBUG)
+    return tracing.traces(limit, min_ms)
 
   def setViolator(self, auth, violator):
     #TODO(dpk): implement violator setting
@@ -280,14 +609,223 @@ class Arcom(object):
     return False, 'Not implemented yet.'
 
 
+class Controllers(object):
+  """All the controllers this server drives.
+     Each [controller NAME] section in the config is an Arcom with its
+     own serial engine, lock, history and state, and its methods are
+     registered as NAME.method.  The first one is also registered under
+     the plain method names, so clients that know of only one
+     controller keep working.  Without any [controller NAME] sections
+     there is a single unnamed controller on --device, as before.
+     """
+  def __init__(self, opt, cfg):
+    self.weblog = weblog.LogGoogle(cfg, opt.testing)
+    self.schedules = scheduler.Scheduler(scheduleFile, self.dispatch)
+    self.names = list(controller_devices(cfg)) or ['']
+    self.controllers = collections.OrderedDict(
+        (name, Arcom(opt, cfg, self.weblog, self.schedules, name))
+        for name in self.names)
+    self.default = self.controllers[self.names[0]]
+    self.changes = self.default.changes
+    self.load_schedules(self.read_schedules(cfg))
+    self.schedules.start()
+
+  def read_schedules(self, cfg, strict=False):
+    """The schedules from [arcom schedule] in cfg.  One that names an
+       unknown controller or action is logged and left out, or with
+       strict raises ValueError.
+       """
+    schedules = []
+    for job_id, name, action, args, repeat in scheduler.read_config(
+        cfg, strict):
+      if (name and name not in self.controllers) or action not in FANOUT_METHODS:
+        if strict:
+          raise ValueError('%s: unknown controller or action' % job_id)
+        log.error('%s: unknown controller or action', job_id)
+        continue
+      schedules.append((job_id, name, action, args, repeat))
+    return schedules
+
+  def load_schedules(self, schedules):
+    """Replace the schedules from the config with those from
+       read_schedules().
+       """
+    for job in self.schedules.list():
+      if job['id'].startswith('config:'):
+        self.schedules.cancel(job['id'])
+    now = time.time()
+    for job_id, name, action, args, repeat in schedules:
+      self.schedules.add(action, [SCHEDULE_AUTH] + args,
+                         scheduler.next_due(repeat, now),
+                         name or self.names[0], repeat, job_id)
+
+  def reload(self, cfg):
+    """Apply a re-read config to the running controllers.  The weblog,
+       every controller's section and the schedules are all read and
+       checked before any of them is applied, so a config with a bad
+       value raises and leaves the old one running.  Adding or removing
+       a controller needs a restart.
+       """
+    names = list(controller_devices(cfg))
+    if (names or ['']) != self.names:
+      raise ValueError('controllers changed to %s; that needs a restart'
+                       % names)
+    weblog_settings = self.weblog.read_settings(cfg)
+    settings = dict((name, arcom.reload_settings(cfg))
+                    for name, arcom in self.controllers.items())
+    schedules = self.read_schedules(cfg, strict=True)
+    self.weblog.apply_settings(weblog_settings)
+    for name, arcom in self.controllers.items():
+      arcom.reload(settings[name])
+    self.load_schedules(schedules)
+
+  def dispatch(self, job):
+    """Run a scheduled job.  Called on the scheduler thread."""
+    if job['action'] not in FANOUT_METHODS:
+      log.error('schedule %s: %s is not allowed', job['id'], job['action'])
+      return
+    result = getattr(self.controller(job['controller']), job['action'])(
+        *job['args'])
+    log.info('schedule %s: %s', job['id'], result)
+
+  def register_functions(self, server):
+    """Register every controller's methods, and the group methods."""
+    self.default.register_functions(server)
+    if self.names != ['']:
+      for name, arcom in self.controllers.items():
+        arcom.register_functions(server, name + '.')
+    server.register_function(self.listControllers)
+    server.register_function(self.fanOut)
+    server.register_function(self.listSchedules)
+    server.register_function(self.cancelSchedule)
+
+  def controller(self, name):
+    """The controller called name; '' is the first one."""
+    if not name:
+      return self.default
+    return self.controllers[name]
+
+  def waitStatus(self, auth, since, timeout, controller=''):
+    """The /status long-poll, for one controller."""
+    return self.controller(controller).waitStatus(auth, since, timeout)
+
+  def waitEvents(self, auth, since, timeout, controller=''):
+    """The /events long-poll, for one controller."""
+    return self.controller(controller).waitEvents(auth, since, timeout)
+
+  def exportLog(self, auth, call='', action='', start=0, end=0,
+                controller=''):
+    """The /export history, for one controller."""
+    return self.controller(controller).exportLog(auth, call, action,
+                                                 start, end)
+
+  def listSchedules(self, auth):
+    """Non-Standard: returns the pending schedules, soonest first, each
+       a dict of id, due, controller, action, args and repeat.
+       """
+    return self.schedules.list()
+
+  def cancelSchedule(self, auth, job_id):
+    """Non-Standard: cancel schedule job_id.  Cancelling an auto-enable
+       leaves port 1 disabled.
+       """
+    for arcom in self.controllers.values():
+      if arcom.enableJob == job_id:
+        arcom.port1Lock.acquire()
+        arcom.cancel_auto_enable(auth)
+        arcom.changes.notify()
+        arcom.port1Lock.release()
+        arcom.authlog(auth, 'Auto-enable cancelled')
+        return True, 'Auto-enable cancelled'
+    job = self.schedules.cancel(job_id)
+    if job is None:
+      return False, 'No schedule %s' % job_id
+    log.info('[%s] Schedule %s (%s) cancelled', auth, job_id, job['action'])
+    return True, 'Schedule %s cancelled' % job_id
+
+  def listControllers(self, auth):
+    """Non-Standard: returns a list of (name, identity), first is the
+       default.
+       """
+    return [(name, arcom.identity) for name, arcom in self.controllers.items()]
+
+  def fanOut(self, auth, method, names, *args):
+    """Non-Standard: run method(auth, *args) on each of the named
+       controllers (all of them if names is empty) at the same time.
+       Each controller has its own serial port, so this takes about as
+       long as the slowest one.  Returns a dict of name to result.
+       """
+    if method not in FANOUT_METHODS:
+      return {'': (False, 'method %s can not be fanned out' % method)}
+    unknown = [name for name in names if name not in self.controllers]
+    if unknown:
+      return {'': (False, 'unknown controller(s): %s' % ', '.join(unknown))}
+    names = names or self.names
+    results = {}
+    parent = tracing.current()
+
+    def run(name):
+      with tracing.span('fanOut ' + name, parent=parent):
+        try:
+          results[name] = getattr(self.controllers[name], method)(auth, *args)
+        except Exception as e:
+          log.exception('fanOut %s on %s failed', method, name)
+          results[name] = (False, 'error: %s' % e)
+
+    threads = [threading.Thread(target=run, args=(name,),
+                                name='fanout-' + name) for name in names]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results
+
+
 def die(_signum, _frame):
-  """Exit gracefully.  Generally from SIGINTR while testing."""
+  """Exit gracefully, from SIGINT while testing or SIGTERM from
+     arcom.rc stop.  sys.exit runs the atexit handlers, which commit
+     the history journals and write out the queued log records.
+     """
   sys.exit(0)
 
+def dump_traces(_signum, _frame):
+  """SIGUSR1 handler that writes the recent request traces to traceFile
+     on a thread of its own, as the dump takes the trace ring's lock and
+     logs, and the signal may arrive while this thread holds either.
+     """
+  threading.Thread(target=tracing.dump, args=(traceFile,),
+                   name='dump traces').start()
+
+def read_config():
+  cfg = ConfigParser(configDefaults)
+  cfg.read(configFile)
+  return cfg
+
+def reload_config(arcom, server):
+  """Re-read the config, passwords and static files into the running
+     server.  A config that fails to parse or check is logged and the
+     old one kept whole.
+     """
+  with reloadLock:
+    log.info('Reloading %s', configFile)
+    try:
+      arcom.reload(read_config())
+    except Exception:
+      log.exception('reloading %s failed', configFile)
+    web_server.reload(server)
+
+def hangup(arcom, server):
+  """SIGHUP handler that reloads on a thread of its own, so the accept
+     loop keeps going and no lock is taken in the signal handler.
+     """
+  def handler(_signum, _frame):
+    threading.Thread(target=reload_config, args=(arcom, server),
+                     name='reload').start()
+  return handler
+
 def main():
   """Main module - parse args and start server"""
-  cfg = ConfigParser(configDefaults)
-  cfg.read('arcom-server.conf')
+  cfg = read_config()
 
   p = optparse.OptionParser()
 
@@ -310,13 +848,23 @@ def main():
   if opt.verbose > 1:
     log.setLevel(logging.DEBUG)
 
-  # Create a second handler to log to the console.
-  formatter = logging.Formatter(logFormat)
+  # The log file, and optionally the console, are written by a listener
+  # thread so logging never blocks a request or the serial port.
+  handlers = [logging.handlers.RotatingFileHandler(
+      logFile, maxBytes=512*1024, backupCount=5)]
   if opt.logtostderr:
     handler = logging.StreamHandler(sys.stderr)
     handler.setLevel(logging.DEBUG)
+    handlers.append(handler)
+  if cfg.get('arcom server', 'logFormat') == 'json':
+    formatter = log_queue.JSONFormatter()
+  else:
+    formatter = logging.Formatter(logFormat)
+  for handler in handlers:
     handler.setFormatter(formatter)
-    log.addHandler(handler)
+  listener = log_queue.start(
+      log, handlers, cfg.getint('arcom server', 'logQueueSize'))
+  atexit.register(listener.stop)
 
   # More than a pidfile, we use locking to ensure exclusive access.
   if opt.pidfile:
@@ -331,8 +879,12 @@ def main():
     f.flush()
 
   signal.signal(signal.SIGINT, die)
-  arcom = Arcom(opt, cfg)
-  web_server.run_server(arcom, opt)
+  signal.signal(signal.SIGTERM, die)
+  signal.signal(signal.SIGUSR1, dump_traces)
+  arcom = Controllers(opt, cfg)
+  server = web_server.make_server(arcom, opt)
+  signal.signal(signal.SIGHUP, hangup(arcom, server))
+  server.serve_forever()
 
 
 if __name__ == '__main__':
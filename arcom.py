@@ -10,42 +10,353 @@
    Reference: RCP Protocol and Serial Port Operations
    (available from the Arcom website)
 """
+import base64
+import collections
+import curses
+import httplib
+import json
 import optparse
 import os
+import Queue
 import re
-import signal
 import socket
 import ssl
-import sys
+import threading
 import time
+import urllib
 import xmlrpclib
 from time import sleep
 from configparser import ConfigParser
 
 config_file = '.arcom.conf'
 opt = None
-
-
-class TimeoutError(IOError): pass
+STATUS_WAIT = 25      # seconds each /status long-poll waits on the server
+STATUS_ROWS = 6       # screen rows kept for status fields
+MESSAGE_ROWS = 12     # screen rows kept for command output
+TICK = 200            # milliseconds between screen updates when idle
+CTRL_C = 3
+
+MENU = (
+    " |                                              |",
+    " | 0.  Exit                                     |",
+    " | 1.  DISABLE Port 1 XMIT - 05:00 Minutes      |",
+    " | 2.  DISABLE Port 1 XMIT - 10:00 Minutes      |",
+    " | 3.  DISABLE Port 1 XMIT - 15:00 Minutes      |",
+    " | 4.  DISABLE Port 1 XMIT                      |",
+    " | 5.  ENABLE  Port 1 XMIT                      |",
+    " | 6.  UN-BRIDGE IRLP NODE Port 3</>1           |",
+    " | 7.  BRIDGE    IRLP NODE Port 3<->1           |",
+    " | 8.  RESTART CONTROLLER                       |",
+    " | 9.  SET DATE/TIME                            |",
+    " | 10. BROWSE LOG ENTRIES                       |",
+    " |                                              |",
+    "  ------------------------------ KG7AUL/KD7DK --",
+)
+
+
+class StatusWatcher(threading.Thread):
+  """Long-poll the server's /status endpoint for changes.
+     Keeps the latest status for the console to draw.
+  """
+  def __init__(self, opt, call, status):
+    threading.Thread.__init__(self, name='status-watcher')
+    self.daemon = True
+    self.opt = opt
+    self.call = call
+    self.status = status
+    self.version = 0
+
+  def run(self):
+    auth = base64.b64encode('%s:%s' % (self.opt.user, self.opt.password))
+    headers = {'Authorization': 'Basic ' + auth}
+    conn = None
+    while True:
+      path = '/status?' + urllib.urlencode(
+          {'since': self.version, 'call': self.call, 'timeout': STATUS_WAIT})
+      try:
+        if conn is None:
+          conn = httplib.HTTPSConnection(
+              self.opt.host, self.opt.port, timeout=STATUS_WAIT + 10,
+              context=ssl._create_unverified_context())
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+          raise httplib.HTTPException('status %d' % resp.status)
+        update = json.loads(body)
+      except (socket.error, httplib.HTTPException, ValueError):
+        conn = None
+        sleep(5)
+        continue
+      self.status = update['status']
+      self.version = update['version']
+
+
+class RPCWorker(threading.Thread):
+  """Make server calls off the UI thread, one at a time.
+     The proxy's connection is kept alive between calls.  Each result
+     goes on the results queue for the UI thread to pick up.
+  """
+  def __init__(self, proxy, results):
+    threading.Thread.__init__(self, name='rpc-worker')
+    self.daemon = True
+    self.proxy = proxy
+    self.calls = Queue.Queue()
+    self.results = results
+
+  def call(self, method, args, done=None):
+    """Queue proxy.method(*args); done(result) runs on the UI thread."""
+    self.calls.put((method, args, done))
+
+  def run(self):
+    while True:
+      method, args, done = self.calls.get()
+      try:
+        result, error = getattr(self.proxy, method)(*args), None
+      except (socket.error, xmlrpclib.Error, httplib.HTTPException) as e:
+        result, error = None, e
+      self.results.put((method, result, error, done))
 
 
 def countdown(t):
-  """Count down t seconds printing the time in minutes:seconds.
-     Allows users to interrupt out of the countdown.
-     Returns number of seconds remaining in from t if terminated early.
+  """Return t seconds as a countdown line in minutes:seconds."""
+  mins, secs = divmod(max(0, int(t)), 60)
+  timeformat = '{:02d}:{:02d}'.format(mins, secs)
+  return "Countdown: " + timeformat + "  [CTRL+C to re-enable]"
+
+
+def status_lines(status):
+  """Render the status fields as menu lines."""
+  lines = []
+  for key, value in sorted(status.items()):
+    if key == 'testing':
+      if value:
+        lines.append(" |             TESTING MODE!                    |")
+    elif key == 'auto-enable':
+      lines.append(" | auto-enable at %-29.29s |" % time.strftime(
+          '%H:%M:%S', time.localtime(value)))
+    elif key != 'identity':
+      lines.append(" | %-16.16s %-27.27s |" % (key, value))
+  return lines
+
+
+def successString(status):
+  """Take boolean success status and return string."""
+  if status:
+    return "succeeded"
+  else:
+    return "failed"
+
+
+class Console(object):
+  """curses menu.  Each screen row remembers what it shows, so only the
+     status fields, countdown and output that changed are redrawn.  Server
+     calls go through an RPCWorker so the countdown and the prompt keep
+     running while a slow call is outstanding.
   """
-  while t:
+  def __init__(self, screen, worker, results, watcher, call, location):
+    self.screen = screen
+    self.worker = worker
+    self.results = results
+    self.watcher = watcher
+    self.call = call
+    self.location = location
+    self.drawn = {}             # row -> text on screen
+    self.messages = collections.deque(maxlen=MESSAGE_ROWS)
+    self.messages_changed = True
+    self.prompt = None
+    self.answer = None          # called with the text entered at the prompt
+    self.input = ''
+    self.enable_at = None       # end of the running countdown
+    self.pending = 0            # server calls not yet answered
+    self.quit = False
+    self.status_row = 1
+    self.menu_row = self.status_row + STATUS_ROWS
+    self.countdown_row = self.menu_row + len(MENU)
+    self.prompt_row = self.countdown_row + 1
+    self.message_row = self.prompt_row + 2
+
+  def draw(self, row, text):
+    """Put text on row unless it is already there."""
+    if self.drawn.get(row) == text:
+      return
+    self.drawn[row] = text
     try:
-      mins, secs = divmod(t, 60)
-      timeformat = '{:02d}:{:02d}'.format(mins, secs)
-      sys.stdout.write("\rCountdown: " + timeformat + "  [CTRL+C to re-enable]")
-      sys.stdout.flush()
-      sleep(1)
-      t -= 1
-    except KeyboardInterrupt:
-      print ""
-      break
-  return t
+      self.screen.move(row, 0)
+      self.screen.clrtoeol()
+      self.screen.addstr(row, 0, text)
+    except curses.error:
+      pass      # past the bottom of a small terminal
+
+  def message(self, text):
+    self.messages.extend(text.split('\n'))
+    self.messages_changed = True
+
+  def ask(self, question, answer):
+    """Show question on the prompt line; answer(text) gets the reply."""
+    self.prompt = question
+    self.answer = answer
+    self.input = ''
+
+  def ask_confirm(self, question, action):
+    """Ask a yes/no question defaulting to no; run action on yes."""
+    def answer(choice):
+      if choice.lower() in ('yes', 'y', 'ye'):
+        action()
+    self.ask(question + ' [y/N] ', answer)
+
+  def rpc(self, method, args, done=None):
+    self.pending += 1
+    self.worker.call(method, args, done)
+
+  def print_result(self, result):
+    status, msg = result
+    self.message("Command %s: %s" % (successString(status), msg))
+
+  def print_failure(self, command):
+    def done(result):
+      status, msg = result
+      if not status:
+        self.message("%s failed: %s" % (command, msg))
+    return done
+
+  def refresh(self):
+    """Bring the screen up to date."""
+    status = self.watcher.status
+    self.draw(0, "  %s %6.6s - Arcom RC210 Control %s" % (
+        8 * "-", status.get("identity", ""), 8 * "-"))
+    lines = status_lines(status)
+    for i in range(STATUS_ROWS):
+      self.draw(self.status_row + i, lines[i] if i < len(lines) else '')
+    for i, line in enumerate(MENU):
+      self.draw(self.menu_row + i, line)
+
+    line = ''
+    if self.enable_at is not None:
+      line = countdown(self.enable_at - time.time())
+    self.draw(self.countdown_row, line)
+
+    busy = '  (waiting for server)' if self.pending else ''
+    self.draw(self.prompt_row, (self.prompt or '') + self.input + busy)
+    if self.messages_changed:
+      self.messages_changed = False
+      for i in range(MESSAGE_ROWS):
+        self.draw(self.message_row + i,
+                  self.messages[i] if i < len(self.messages) else '')
+    try:
+      self.screen.move(self.prompt_row, len(self.prompt or '') + len(self.input))
+    except curses.error:
+      pass
+    self.screen.refresh()
+
+  def run(self):
+    curses.raw()                # CTRL+C arrives as a key
+    self.screen.timeout(TICK)
+    self.ask("Enter your choice [0-10]: ", self.dispatch)
+    while not self.quit:
+      while not self.results.empty():
+        method, result, error, done = self.results.get()
+        self.pending -= 1
+        if error is not None:
+          self.message("Server error: %s" % error)
+        elif done:
+          done(result)
+      if self.enable_at is not None and time.time() >= self.enable_at:
+        self.enable_at = None
+      self.refresh()
+
+      ch = self.screen.getch()
+      if ch == -1:
+        continue
+      elif ch == CTRL_C:
+        self.interrupt()
+      elif ch in (curses.KEY_ENTER, 10, 13):
+        choice, answer = self.input.strip(), self.answer
+        self.ask("Enter your choice [0-10]: ", self.dispatch)
+        answer(choice)
+      elif ch in (curses.KEY_BACKSPACE, 8, 127):
+        self.input = self.input[:-1]
+      elif 32 <= ch < 127:
+        self.input += chr(ch)
+
+  def interrupt(self):
+    """CTRL+C re-enables during a countdown and quits otherwise."""
+    if self.enable_at is None:
+      self.quit = True
+      return
+    self.enable_at = None
+    self.rpc('port1Enable', [self.call], self.print_failure('port1Enable'))
+
+  def disable_for_minutes(self, minutes):
+    """Disable for specified number of minutes with a countdown.
+       If the users interrupts the countdown, re-enable immediately.
+    """
+    def disabled(result):
+      self.print_failure('port1Disable')(result)
+      if result[0]:
+        self.enable_at = time.time() + minutes * 60 + 1
+
+    def disable():
+      self.message("DISABLING Port 1 XMIT - %02d:00 Minutes" % minutes)
+      self.rpc('port1Disable', [self.call, minutes * 60], disabled)
+      self.rpc('logInterference', [self.call, self.location, minutes],
+               self.print_failure('logInterference'))
+    self.ask_confirm('Are you SURE? (Action will be logged.)', disable)
+
+  def list_log(self, who, cursor=0):
+    """Display a page of log entries (time, call, string) and offer the next."""
+    def listLog(page):
+      for seconds, call, string in page['entries']:
+        tm = time.localtime(seconds)
+        self.message("%s [%s] %s" % (time.strftime('%x %X', tm), call, string))
+      if page['cursor']:
+        self.ask_confirm("Older entries?",
+                         lambda: self.list_log(who, page['cursor']))
+    self.rpc('queryLog', [self.call, who, '', 0, 0, cursor, 10], listLog)
+
+  def dispatch(self, line):
+    """Decide what do to.  Eventually table driven?"""
+    call = self.call
+
+    if line == "":
+      return
+    try:
+      choice = int(line)
+    except ValueError:
+      choice = 99
+
+    if choice in (1, 2, 3):
+      self.disable_for_minutes(5 * choice)
+    elif choice == 4:
+      self.message("DISABLING Port 1 XMIT")
+      self.ask_confirm("Are you SURE?", lambda: self.rpc(
+          'port1Disable', [call], self.print_result))
+    elif choice == 5:
+      self.message("ENABLING Port 1 XMIT")
+      self.enable_at = None
+      self.rpc('port1Enable', [call], self.print_result)
+    elif choice == 6:
+      self.message("UN-BRIDGING IRLP NODE Port 3</>1")
+      self.ask_confirm("Are you SURE?", lambda: self.rpc(
+          'port3Unbridge', [call], self.print_result))
+    elif choice == 7:
+      self.message("BRIDGING IRLP NODE Port 3<->1")
+      self.rpc('port3Bridge', [call], self.print_result)
+    elif choice == 8:
+      def restart():
+        self.message("RESTARTING CONTROLLER")
+        self.rpc('restart', [call], self.print_result)
+      self.ask_confirm("Are you SURE?", restart)
+    elif choice == 9:
+      self.rpc('setDateTime', [call], self.print_result)
+    elif choice == 10:
+      self.ask("Callsign (blank for all): ", self.list_log)
+    elif choice == 0:
+      self.quit = True
+    else:
+      # Any other integer inputs print an error message
+      self.message("Invalid option selected. Choose a valid number option.")
+
 
 def interact(opt, cfg):
   """Main user interaction loop.
@@ -53,16 +364,18 @@ def interact(opt, cfg):
   """
   #print 'opening https://%s:%s@%s:%s' % (
   #    opt.user, opt.password, opt.host, opt.port)
+  # The server speaks HTTP/1.1, so the proxy's transport keeps one
+  # connection (and TLS session) open across calls.
   arcom = xmlrpclib.ServerProxy(
-      "https://%s:%s@localhost:%s" % (opt.user, opt.password, opt.port),
-      verbose=False, use_datetime=True, 
+      "https://%s:%s@%s:%s" % (opt.user, opt.password, opt.host, opt.port),
+      verbose=False, use_datetime=True,
       context=ssl._create_unverified_context())
 
   call = cfg.get('arcom', 'call')
   if not re.match(r'[A-Za-z]+\d[A-Za-z]+', call):
     raise RuntimeError('Format error for call in .arcom.conf.')
   location = cfg.get('arcom', 'location')
-  
+
   while True:
     try:
       status = arcom.status(call)
@@ -71,173 +384,14 @@ def interact(opt, cfg):
       print "Server error: %s, sleeping 5" % e
       sleep(5)
 
-  def ask_confirm(question, default):
-    """Prompt for user yes/no response with a possible default"""
-    valid = {'yes': True, 'y': True, 'ye': True,
-             'no': False, 'n': False}
-    if default is None:
-      prompt = ''
-    elif default == 'yes':
-      prompt = ' [Y/n] '
-    elif default == 'no':
-      prompt = ' [y/N] '
-    else:
-      raise ValueError("invalid default answer: '%s'" % default)
-
-    while True:
-      sys.stdout.write(question + prompt)
-      try:
-        choice = raw_input().lower()
-      except (EOFError, KeyboardInterrupt):
-        print ""
-        sys.exit(0)
-
-      if default is None:
-        return choice
-      elif choice == '':
-        return valid[default]
-      elif choice in valid:
-        return valid[choice]
-      else:
-        sys.stdout.write(
-            "Please respond with 'y' or 'n'.\n")
-
-  def print_failure(command, result):
-    status, msg = result
-    if not status:
-      print "%s failed: %s" % (command, msg)
-
-  def disable_for_minutes(minutes):
-    """Disable for specified number of seconds.
-       If the users interrupts the countdown, re-enable immediately.
-    """
-    if ask_confirm('Are you SURE? (Action will be logged.) ', 'no'):
-      print "DISABLING Port 1 XMIT - %02d:00 Minutes" % minutes
-      print_failure('port1Disable', arcom.port1Disable(call, minutes*60))
-      print_failure('logInterference', arcom.logInterference(call, location, minutes))
-      if countdown(minutes*60+1) > 0:
-        print_failure('port1Enable', arcom.port1Enable(call))
-      print ""
-      return True
-
-  def printStatus(status):
-    for key, value in sorted(status.items()):
-      if key == 'testing':
-        if value:
-          print " |             TESTING MODE!                    |"
-      elif key == 'auto-enable':
-        print " | auto-enable at %-29.29s |" % time.strftime('%H:%M:%S',
-                                                             time.localtime(value))
-      else:
-        print " | %-16.16s %-27.27s |" % (key, value)
-
-  def print_menu(status):       ## Your menu design here
-    """Render the menu."""
-    #TODO(dpk): we should use curses library here?
-    os.system('clear') # this is expensive.
-    print " ", 8 * "-", "%6.6s - Arcom RC210 Control" % status["identity"], 8 * "-"
-    printStatus(status)
-    print " |", 44 * " ", "|"
-    print " | 0.  Exit                                     |"
-    print " | 1.  DISABLE Port 1 XMIT - 05:00 Minutes      |"
-    print " | 2.  DISABLE Port 1 XMIT - 10:00 Minutes      |"
-    print " | 3.  DISABLE Port 1 XMIT - 15:00 Minutes      |"
-    print " | 4.  DISABLE Port 1 XMIT                      |"
-    print " | 5.  ENABLE  Port 1 XMIT                      |"
-    print " | 6.  UN-BRIDGE IRLP NODE Port 3</>1           |"
-    print " | 7.  BRIDGE    IRLP NODE Port 3<->1           |"
-    print " | 8.  RESTART CONTROLLER                       |"
-    print " | 9.  SET DATE/TIME                            |"
-    print " | 10. GET LAST 10 LOG ENTRIES                  |"
-    print " |", 44 * " ", "|"
-    print " ", 30 * "-", "KG7AUL/KD7DK", "--"
-
-
-  def listLog(entries):
-    """Display the log entry tuples (time, call, string)."""
-    for entry in entries:
-      seconds, call, string = entry
-      tm = time.localtime(seconds)
-      print "%s [%s] %s" % (time.strftime('%x %X', tm), call, string)
-
-  def successString(status):
-    """Take boolean success status and return string."""
-    if status:
-      return "succeeded"
-    else:
-      return "failed"
-
-  def dispatch(line):
-    """Decide what do to.  Eventually table driven?"""
-    status = False
-    msg = ''
-
-    if line == "":
-      return
-    try:
-      choice = int(line)
-    except ValueError:
-      choice = 99
-
-    if choice is 1:
-      return disable_for_minutes(5)
-    elif choice is 2:
-      return disable_for_minutes(10)
-    elif choice is 3:
-      return disable_for_minutes(15)
-    elif choice is 4:
-      print "DISABLING Port 1 XMIT"
-      if ask_confirm("Are you SURE? ", "no"):
-        status, msg = arcom.port1Disable(call)
-    elif choice is 5:
-      print "ENABLING Port 1 XMIT"
-      status, msg = arcom.port1Enable(call)
-    elif choice is 6:
-      print "UN-BRIDGING IRLP NODE Port 3</>1"
-      if ask_confirm("Are you SURE? ", "no"):
-        status, msg = arcom.port3Unbridge(call)
-    elif choice is 7:
-      print "BRIDGING IRLP NODE Port 3<->1"
-      status, msg = arcom.port3Bridge(call)
-    elif choice is 8:
-      if ask_confirm("Are you SURE? ", "no"):
-        print "RESTARTING CONTROLLER"
-        status, msg = arcom.restart(call)
-    elif choice is 9:
-      status, msg = arcom.setDateTime(call)
-    elif choice is 10:
-      entries = arcom.getLog(call, 10)
-      listLog(entries)
-      return
-    elif choice is 0:
-      print "Quitting"
-      sys.exit(0)
-    else:
-      # Any other integer inputs print an error message
-      print "Invalid option selected. Choose a valid number option."
-      return
-    print "Command %s: %s" % (successString(status), msg)
-    return
-
-  def timeout(signum, frame):
-    raise TimeoutError('Timeout')
-
-  signal.signal(signal.SIGALRM, timeout)
-  while True:
-    try:
-      status = arcom.status(call)
-      print_menu(status)    ## Displays menu
-      signal.alarm(15)      ## Refresh menu (status) every 15 seconds
-      choice = ask_confirm("Enter your choice [0-10]: ", None)
-      signal.alarm(0)
-      dispatch(choice)
-    except TimeoutError:
-      continue
-    except SyntaxError:
-      continue
-    except socket.error, e:
-      print "Server error: %s" % e
-    ask_confirm("Continue?", None)
+  watcher = StatusWatcher(opt, call, status)
+  watcher.start()
+  results = Queue.Queue()
+  worker = RPCWorker(arcom, results)
+  worker.start()
+  curses.wrapper(lambda screen: Console(
+      screen, worker, results, watcher, call, location).run())
+  print "Quitting"
 
 
 def main():
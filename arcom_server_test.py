@@ -0,0 +1,232 @@
+#!/usr/bin/python
+"""
+Tests for arcom-server.py's configuration handling.
+
+Run it from the arcom-server directory:  python arcom_server_test.py
+"""
+import imp
+import logging
+import optparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from configparser import ConfigParser
+import serial_engine
+import serial_engine_test
+
+arcom_server = imp.load_source(
+    'arcom_server',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arcom-server.py'))
+
+
+def config(text):
+  cfg = ConfigParser(arcom_server.configDefaults)
+  cfg.read_string(text)
+  return cfg
+
+
+class SectionOptionsTest(unittest.TestCase):
+  def test_controller_device_equal_to_default(self):
+    cfg = config(u"""
+[arcom server]
+serialDevice = /dev/ttyUSB1
+[controller north]
+serialDevice = %s
+identity = N1AAA/R
+""" % arcom_server.configDefaults['serialDevice'])
+    own = arcom_server.section_options(cfg, 'controller north')
+    self.assertEqual(own, {'serialdevice': '/dev/ttyUSB0',
+                           'identity': 'N1AAA/R'})
+
+  def test_defaults_not_included(self):
+    cfg = config(u"""
+[controller south]
+identity = S1AAA/R
+""")
+    own = arcom_server.section_options(cfg, 'controller south')
+    self.assertEqual(own, {'identity': 'S1AAA/R'})
+
+
+class ControllerDevicesTest(unittest.TestCase):
+  def test_devices_in_order(self):
+    cfg = config(u"""
+[controller north]
+serialDevice = /dev/ttyUSB0
+[controller south]
+serialDevice = /dev/ttyUSB1
+""")
+    self.assertEqual(list(arcom_server.controller_devices(cfg).items()),
+                     [('north', '/dev/ttyUSB0'), ('south', '/dev/ttyUSB1')])
+
+  def test_device_required(self):
+    cfg = config(u"""
+[arcom server]
+serialDevice = /dev/ttyUSB1
+[controller north]
+identity = N1AAA/R
+""")
+    self.assertRaises(ValueError, arcom_server.controller_devices, cfg)
+
+  def test_device_not_shared(self):
+    cfg = config(u"""
+[controller north]
+serialDevice = /dev/ttyUSB0
+[controller south]
+serialDevice = /dev/ttyUSB0
+""")
+    self.assertRaises(ValueError, arcom_server.controller_devices, cfg)
+
+
+RELOAD_CONFIG = u"""
+[arcom server]
+identity = WW1AAA/R
+[arcom commands]
+port1Disable = **4321
+port1Enable = **5566
+port3Unbridge = **2323
+port3Bridge = **2324
+restart = **99998
+setDate = 5101
+setTime = 5100
+[arcom schedule]
+clock = daily 03:00 setDateTime
+[controller north]
+serialDevice = /dev/ttyUSB0
+identity = N1AAA/R
+trustWindow = %s
+[controller south]
+serialDevice = /dev/ttyUSB1
+identity = S1AAA/R
+[google form]
+url_base = https://docs.google.com/forms/d/e/test
+"""
+
+
+class ControllersTest(unittest.TestCase):
+  """Runs a Controllers for RELOAD_CONFIG in testing mode, in a
+     directory of its own.
+     """
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.dir = tempfile.mkdtemp()
+    os.chdir(self.dir)
+    opt = optparse.Values({'testing': True, 'device': '/dev/null'})
+    # Reloads need no scheduler thread, and one left waiting for a due
+    # job trips over interpreter shutdown.
+    start = arcom_server.scheduler.Scheduler.start
+    arcom_server.scheduler.Scheduler.start = lambda scheduler: None
+    try:
+      self.controllers = arcom_server.Controllers(
+          opt, config(RELOAD_CONFIG % 5))
+    finally:
+      arcom_server.scheduler.Scheduler.start = start
+
+  def tearDown(self):
+    for arcom in self.controllers.controllers.values():
+      arcom.history.close()
+    os.chdir(self.cwd)
+    shutil.rmtree(self.dir)
+
+
+class ReloadTest(ControllersTest):
+  def test_reload_applies_everything(self):
+    self.controllers.reload(config(
+        (RELOAD_CONFIG % 7).replace('S1AAA', 'S2BBB')))
+    self.assertEqual(self.controllers.controller('north').trustWindow, 7.0)
+    self.assertEqual(self.controllers.controller('south').identity, 'S2BBB/R')
+
+  def test_bad_value_keeps_old_config(self):
+    text = (RELOAD_CONFIG % 'soon').replace('S1AAA', 'S2BBB')
+    self.assertRaises(ValueError, self.controllers.reload, config(text))
+    self.assertEqual(self.controllers.controller('north').trustWindow, 5.0)
+    self.assertEqual(self.controllers.controller('south').identity, 'S1AAA/R')
+
+  def test_bad_schedule_keeps_old_config(self):
+    text = (RELOAD_CONFIG % 7).replace('03:00 setDateTime', '03:00 reboot')
+    self.assertRaises(ValueError, self.controllers.reload, config(text))
+    self.assertEqual(self.controllers.controller('north').trustWindow, 5.0)
+    self.assertEqual([job['action'] for job in self.controllers.schedules.list()],
+                     ['setDateTime'])
+
+  def test_shared_device_keeps_old_config(self):
+    text = (RELOAD_CONFIG % 7).replace('/dev/ttyUSB1', '/dev/ttyUSB0')
+    self.assertRaises(ValueError, self.controllers.reload, config(text))
+    self.assertEqual(self.controllers.controller('north').trustWindow, 5.0)
+
+  def test_changed_controllers_keep_old_config(self):
+    text = (RELOAD_CONFIG % 7).replace('[controller south]', '[controller east]')
+    self.assertRaises(ValueError, self.controllers.reload, config(text))
+    self.assertEqual(self.controllers.controller('north').trustWindow, 5.0)
+
+
+class SerialTest(ControllersTest):
+  """Runs controller north on a fake serial port."""
+  def setUp(self):
+    ControllersTest.setUp(self)
+    self.arcom = self.controllers.controller('north')
+    self.port = serial_engine_test.FakePort(0.2)
+    self.arcom.engine = serial_engine.SerialEngine(self.port)
+    self.addCleanup(self.arcom.engine.close)
+
+  def call_spaced(self, calls, spacing):
+    """Make (label, func, args) calls on threads, spacing seconds apart.
+       Returns their results by label.
+       """
+    results = {}
+    def call(label, func, args):
+      results[label] = func(*args)
+    threads = []
+    for label, func, args in calls:
+      threads.append(threading.Thread(target=call, args=(label, func, args)))
+      threads[-1].start()
+      time.sleep(spacing)
+    for thread in threads:
+      thread.join()
+    return results
+
+
+class FanOutTest(ControllersTest):
+  def test_failure_reported_per_controller(self):
+    def broken(auth):
+      raise IOError('port gone')
+    self.controllers.controller('south').restart = broken
+    results = self.controllers.fanOut('TEST', 'restart', [])
+    self.assertEqual(results['north'], (True, 'Restarting...'))
+    self.assertEqual(results['south'], (False, 'error: port gone'))
+
+
+class StateSendTest(SerialTest):
+  def test_not_skipped_behind_opposite_command(self):
+    arcom, port = self.arcom, self.port
+    results = self.call_spaced(
+        [(name, arcom.stateSend, (name,))
+         for name in ('port3Unbridge', 'port3Bridge', 'port3unbridge')], 0.1)
+    self.assertEqual(port.written, ['**2323', '**2324', '**2323'])
+    self.assertEqual(results['port3unbridge'], (True, 'succeeded'))
+    self.assertFalse(arcom.port3Bridged)
+
+
+class Port1Test(SerialTest):
+  def test_disable_not_held_up_by_queued_enable(self):
+    arcom = self.arcom
+    self.call_spaced([('clock', arcom.setDateTime, ('TEST',)),
+                      ('unbridge', arcom.port3Unbridge, ('TEST',)),
+                      ('enable', arcom.port1Enable, ('TEST',)),
+                      ('disable', arcom.port1Disable, ('TEST',))], 0.05)
+    self.assertEqual([code[:4] for code in self.port.written],
+                     ['5101', '5100', '**43', '**23', '**55'])
+
+  def test_failed_timed_enable_is_rescheduled(self):
+    self.port.answer = '-'
+    status, _ = self.arcom.port1Enable('TEST', True)
+    self.assertFalse(status)
+    self.assertTrue(self.arcom.enableJob)
+    self.assertEqual(self.port.written, ['**5566'])
+
+
+if __name__ == '__main__':
+  logging.getLogger('arcom').addHandler(logging.NullHandler())
+  unittest.main()
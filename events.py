@@ -0,0 +1,130 @@
+"""
+Change notification for arcom-server.
+
+Clients long-poll for changes instead of re-requesting status on a
+timer.  A ChangeNotifier keeps a version number that is bumped whenever
+the watched state changes, along with a few recent snapshots so a
+waiter can be told which keys changed since the version it last saw.
+
+An EventRing keeps the controller's unsolicited output (alarms, DTMF,
+COS, echoes) as numbered events that clients read from the last number
+they saw.
+"""
+import collections
+import threading
+import time
+
+SNAPSHOTS = 32
+EVENT_RING_SIZE = 1000
+EVENT_LIMIT = 100       # events returned by one wait()
+
+# Event kind by the start of the line (upper cased); anything else is
+# a 'message'.
+EVENT_KINDS = (
+    ('ALARM', 'alarm'),
+    ('DTMF', 'dtmf'),
+    ('PORT ', 'port'),
+    ('1*', 'echo'),
+)
+
+
+class ChangeNotifier(object):
+  """Versioned snapshots of a dict that waiters can block on."""
+  def __init__(self, snapshot):
+    """snapshot is a callable returning the current state as a dict."""
+    self.snapshot = snapshot
+    self.listeners = []         # called with each new snapshot
+    self.version = 1
+    self._cond = threading.Condition(threading.Lock())
+    self._snapshots = collections.deque([(1, snapshot())], maxlen=SNAPSHOTS)
+
+  def notify(self, force=False):
+    """Record a new version if the snapshot changed (or if forced,
+       eg. when something not in the snapshot like history changed)
+       and wake any waiters.
+       """
+    current = self.snapshot()
+    with self._cond:
+      if not force and current == self._snapshots[-1][1]:
+        return
+      self.version += 1
+      self._snapshots.append((self.version, current))
+      self._cond.notify_all()
+    for listener in self.listeners:
+      listener(current)
+
+  def wait(self, since, timeout):
+    """Wait up to timeout seconds for a version newer than since.
+       Returns (version, snapshot, changed) where changed lists the keys
+       that differ from the snapshot at since, or all keys if that
+       version is no longer known.  A since from before a restart
+       (newer than any version given out) returns at once.
+       """
+    deadline = time.time() + timeout
+    with self._cond:
+      while since == self.version:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._cond.wait(remaining)
+      version, current = self._snapshots[-1]
+      previous = None
+      for old_version, old in self._snapshots:
+        if old_version == since:
+          previous = old
+    if previous is None:
+      changed = sorted(current)
+    else:
+      changed = sorted(key for key in set(current) | set(previous)
+                       if current.get(key) != previous.get(key))
+    return version, current, changed
+
+
+def event_kind(text):
+  """Classify a line of controller output."""
+  upper = text.upper()
+  for prefix, kind in EVENT_KINDS:
+    if upper.startswith(prefix):
+      return kind
+  return 'message'
+
+
+class EventRing(object):
+  """The last size events, numbered from 1, that waiters can block on."""
+  def __init__(self, size=EVENT_RING_SIZE):
+    self.seq = 0
+    self._events = collections.deque(maxlen=size)
+    self._cond = threading.Condition(threading.Lock())
+
+  def add(self, seconds, text):
+    """Record a line the controller sent at seconds; returns the event."""
+    with self._cond:
+      self.seq += 1
+      event = {'seq': self.seq, 'time': seconds, 'kind': event_kind(text),
+               'text': text}
+      self._events.append(event)
+      self._cond.notify_all()
+    return event
+
+  def wait(self, since, timeout=0, limit=EVENT_LIMIT):
+    """Wait up to timeout seconds for events numbered after since.
+       Returns a dict with up to limit events, oldest first, the seq to
+       pass as since next time, and how many events after since were
+       missed because they have left the ring.  A since from before a
+       restart (larger than any number given out) starts over from 0.
+       """
+    deadline = time.time() + timeout
+    with self._cond:
+      if since > self.seq:
+        since = 0
+      while self.seq <= since:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._cond.wait(remaining)
+      first = self._events[0]['seq'] if self._events else self.seq + 1
+      events = [event for event in self._events if event['seq'] > since]
+    events = events[:limit]
+    return {'seq': events[-1]['seq'] if events else since,
+            'events': events,
+            'missed': max(0, first - since - 1)}
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+"""
+Tests for events.py's long-poll waits.
+
+Run it from the arcom-server directory:  python events_test.py
+"""
+import threading
+import time
+import unittest
+import events
+
+
+class ChangeNotifierTest(unittest.TestCase):
+  def setUp(self):
+    self.state = {'port1Enabled': True, 'port3Bridged': True}
+    self.notifier = events.ChangeNotifier(lambda: dict(self.state))
+
+  def test_since_after_restart_returns_at_once(self):
+    start = time.time()
+    version, current, changed = self.notifier.wait(40, 5)
+    self.assertLess(time.time() - start, 1.0)
+    self.assertEqual(version, 1)
+    self.assertEqual(current, self.state)
+    self.assertEqual(changed, ['port1Enabled', 'port3Bridged'])
+
+  def test_waits_for_change(self):
+    def change():
+      time.sleep(0.1)
+      self.state['port1Enabled'] = False
+      self.notifier.notify()
+    threading.Thread(target=change).start()
+    version, current, changed = self.notifier.wait(1, 5)
+    self.assertEqual(version, 2)
+    self.assertFalse(current['port1Enabled'])
+    self.assertEqual(changed, ['port1Enabled'])
+
+  def test_times_out_without_change(self):
+    start = time.time()
+    version, _, changed = self.notifier.wait(1, 0.1)
+    self.assertGreaterEqual(time.time() - start, 0.1)
+    self.assertEqual(version, 1)
+    self.assertEqual(changed, [])
+
+
+class EventRingTest(unittest.TestCase):
+  def test_since_after_restart_starts_over(self):
+    ring = events.EventRing()
+    ring.add(1.0, 'ALARM 1')
+    result = ring.wait(40, 5)
+    self.assertEqual([event['seq'] for event in result['events']], [1])
+    self.assertEqual(result['missed'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,15 +2,15 @@
 """
 Generate entries for arcom.password file.
 """
-import hashlib
 import sys
+import passwords
 
 def main():
   sys.stdout.write('user: ')
   call = sys.stdin.readline().strip()
   sys.stdout.write('password: ')
   password = sys.stdin.readline().strip()
-  print '%s:%s' % (call, hashlib.sha224('arcom%s%s' % (call, password)).hexdigest())
+  print '%s:%s' % (call, passwords.hash_password(call, password))
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,333 @@
+"""
+Action history for arcom-server.
+
+History is an append-only journal of fixed size records, after a header
+record, backed by a bounded in memory ring.  Logging an action only appends to the ring and
+a pending list; a background thread group commits the pending records to
+the journal once per commit interval.  When the journal grows well past
+the ring size it is compacted down to the ring contents, and at startup
+the ring is rebuilt by reading just the tail of the journal.  A journal
+from before the header, with smaller records, is rewritten on loading.
+
+Committed records are also fed to a SQLite index which keeps the full
+history and answers filtered, paginated queries.
+"""
+import collections
+import errno
+import itertools
+import logging
+import os
+import sqlite3
+import struct
+import threading
+
+log = logging.getLogger('arcom')
+
+# time, call, action text - 512 bytes, strings are NUL padded utf-8.
+# The journal starts with a record of MAGIC and NUL padding.
+CALL_SIZE = 32
+TEXT_SIZE = 472
+RECORD = struct.Struct('<d%ds%ds' % (CALL_SIZE, TEXT_SIZE))
+MAGIC = 'arcomhj2'
+HEADER = MAGIC.ljust(RECORD.size, '\0')
+
+# Records of journals without a header.
+RECORD_V1 = struct.Struct('<d16s104s')
+
+# Action types for the index, by prefix of the logged string.
+ACTION_TYPES = (
+    ('Port 1 OFF', 'port1Disable'),
+    ('Port 1 ON', 'port1Enable'),
+    ('Unbridge', 'port3Unbridge'),
+    ('Bridge', 'port3Bridge'),
+    ('Restart', 'restart'),
+    ('Set Date/Time', 'setDateTime'),
+    ('Log Interference', 'logInterference'),
+    ('Log Request', 'getLog'),
+    ('Log Query', 'queryLog'),
+    ('Macro', 'runMacro'),
+    ('setViolator', 'setViolator'),
+)
+
+MAX_PAGE_SIZE = 500
+EXPORT_PAGE_SIZE = 500
+
+
+def _encode(value):
+  """Encode to utf-8."""
+  if not isinstance(value, unicode):
+    value = str(value).decode('utf-8', 'replace')
+  return value.encode('utf-8')
+
+
+def _truncate(data, size):
+  """Truncate utf-8 data to size bytes on a character boundary."""
+  if len(data) > size:
+    data = data[:size].decode('utf-8', 'ignore').encode('utf-8')
+  return data
+
+
+def fit(entry):
+  """Return a (time, call, string) tuple as it will be read back from
+     a record: utf-8, and cut to the record's field sizes with a warning
+     if too long.
+     """
+  seconds, call, string = entry
+  call, string = _encode(call), _encode(string)
+  if len(call) > CALL_SIZE or len(string) > TEXT_SIZE:
+    log.warning('history entry cut to fit a record: %r %r', call, string)
+    call, string = _truncate(call, CALL_SIZE), _truncate(string, TEXT_SIZE)
+  return seconds, call, string
+
+
+def action_type(string):
+  """Classify a logged action string for the index."""
+  for prefix, action in ACTION_TYPES:
+    if string.startswith(prefix):
+      return action
+  return 'other'
+
+
+def _text(value):
+  """SQLite wants unicode, history strings are utf-8."""
+  if isinstance(value, unicode):
+    return value
+  return str(value).decode('utf-8', 'replace')
+
+
+def pack(entry):
+  """Pack a (time, call, string) tuple into a journal record."""
+  return RECORD.pack(*fit(entry))
+
+
+def unpack(data, record=RECORD):
+  """Unpack a journal record into a (time, call, string) tuple."""
+  seconds, call, string = record.unpack(data)
+  return seconds, call.rstrip('\0'), string.rstrip('\0')
+
+
+class HistoryJournal(object):
+  """Bounded history of (time, call, string) tuples with a journal file."""
+  def __init__(self, path, size, commit_interval=1.0, compact_factor=4):
+    self.path = path
+    self.size = size
+    self.commit_interval = commit_interval
+    self.compact_limit = size * compact_factor
+    self.ring = collections.deque(maxlen=size)
+    self._pending = []
+    self.listeners = []
+    self._lock = threading.Lock()
+    self._commit_lock = threading.Lock()
+    self._stop = threading.Event()
+    self._file = None
+    self._records, current = self._load()
+    if current:
+      self._file = open(path, 'ab')
+    elif not self._compact(list(self.ring)):
+      raise IOError('cannot write %s' % path)
+    self._writer = threading.Thread(target=self._commit_loop,
+                                    name='history-writer')
+    self._writer.daemon = True
+    self._writer.start()
+
+  def __len__(self):
+    return len(self.ring)
+
+  def _load(self):
+    """Fill the ring from the tail of the journal.  A partial record
+       left by a crash mid-write is cut off, and a missing journal is an
+       empty history.  Returns the number of records in the journal and
+       whether it has the current header, and so can be appended to.
+       """
+    try:
+      with open(self.path, 'r+b') as f:
+        current = f.read(len(MAGIC)) == MAGIC
+        record, start = (RECORD, RECORD.size) if current else (RECORD_V1, 0)
+        f.seek(0, os.SEEK_END)
+        records, extra = divmod(f.tell() - start, record.size)
+        if extra:
+          log.error('%s: dropping %d byte partial record', self.path, extra)
+          f.truncate(start + records * record.size)
+        first = max(0, records - self.size)
+        f.seek(start + first * record.size)
+        data = f.read((records - first) * record.size)
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        log.error('error loading %s: %s', self.path, e)
+      return 0, False
+    for offset in xrange(0, len(data), record.size):
+      self.ring.append(unpack(data[offset:offset + record.size], record))
+    log.info('Loaded %d entries to history', len(self.ring))
+    if records and not current:
+      log.info('Converting %s to %d byte records', self.path, RECORD.size)
+    return records, current
+
+  def append(self, entry):
+    """Add a (time, call, string) tuple.  It is written to the journal
+       by the next group commit.
+       """
+    entry = fit(entry)
+    with self._lock:
+      self.ring.append(entry)
+      self._pending.append(entry)
+
+  def tail(self, num_entries):
+    """Return the newest num_entries tuples, oldest first."""
+    with self._lock:
+      start = max(0, len(self.ring) - num_entries) if num_entries > 0 else 0
+      return list(itertools.islice(self.ring, start, None))
+
+  def commit(self):
+    """Write pending records to the journal, compacting if it is due."""
+    with self._commit_lock:
+      with self._lock:
+        batch, self._pending = self._pending, []
+        snapshot = None
+        if batch and self._records + len(batch) > self.compact_limit:
+          snapshot = list(self.ring)
+      if snapshot is not None:
+        self._compact(snapshot)
+      elif batch:
+        try:
+          self._file.write(''.join(pack(entry) for entry in batch))
+          self._file.flush()
+          os.fsync(self._file.fileno())
+          self._records += len(batch)
+        except (IOError, OSError) as e:
+          log.error('writing to %s: %s', self.path, e)
+      if batch:
+        for listener in self.listeners:
+          try:
+            listener(batch)
+          except Exception as e:
+            log.error('history listener %s: %s', listener, e)
+
+  def _compact(self, snapshot):
+    """Replace the journal with just the records in snapshot.  Returns
+       False if it could not be written.
+       """
+    tmp_path = self.path + '.tmp'
+    try:
+      with open(tmp_path, 'wb') as f:
+        f.write(HEADER + ''.join(pack(entry) for entry in snapshot))
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(tmp_path, self.path)
+    except (IOError, OSError) as e:
+      log.error('compacting %s: %s', self.path, e)
+      return False
+    if self._file is not None:
+      self._file.close()
+    self._file = open(self.path, 'ab')
+    log.debug('Compacted %s from %d to %d records',
+              self.path, self._records, len(snapshot))
+    self._records = len(snapshot)
+    return True
+
+  def _commit_loop(self):
+    while not self._stop.wait(self.commit_interval):
+      self.commit()
+
+  def close(self):
+    """Commit anything pending and stop the writer thread."""
+    self._stop.set()
+    self._writer.join()
+    self.commit()
+
+
+class HistoryIndex(object):
+  """SQLite store of the full history, indexed by call, action and time.
+     Queries return pages newest first; the cursor returned with a page
+     is passed back to get the next (older) page.
+     """
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.executescript("""
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY,
+            time REAL NOT NULL,
+            call TEXT NOT NULL COLLATE NOCASE,
+            action TEXT NOT NULL,
+            string TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS history_call ON history (call, id);
+        CREATE INDEX IF NOT EXISTS history_action ON history (action, id);
+        CREATE INDEX IF NOT EXISTS history_time ON history (time);
+        """)
+
+  def add(self, entries):
+    """Insert (time, call, string) tuples."""
+    rows = [(seconds, _text(call), action_type(string), _text(string))
+            for seconds, call, string in entries]
+    with self._lock:
+      with self._db:
+        self._db.executemany(
+            'INSERT INTO history (time, call, action, string) '
+            'VALUES (?, ?, ?, ?)', rows)
+
+  def sync(self, entries):
+    """Add the entries newer than anything already indexed."""
+    with self._lock:
+      latest = self._db.execute('SELECT MAX(time) FROM history').fetchone()[0]
+    missing = [entry for entry in entries if latest is None or entry[0] > latest]
+    if missing:
+      self.add(missing)
+      log.info('Indexed %d history entries', len(missing))
+
+  def _filters(self, call, action, start, end):
+    """WHERE clauses and their arguments; empty or zero do not filter."""
+    where, args = [], []
+    if call:
+      where.append('call = ?')
+      args.append(_text(call))
+    if action:
+      where.append('action = ?')
+      args.append(action)
+    if start:
+      where.append('time >= ?')
+      args.append(start)
+    if end:
+      where.append('time < ?')
+      args.append(end)
+    return where, args
+
+  def query(self, call='', action='', start=0, end=0, cursor=0, limit=50):
+    """Return (entries, cursor) for one page of matching history.
+       Empty or zero arguments do not filter.  The returned cursor is 0
+       when there are no older matches.
+       """
+    where, args = self._filters(call, action, start, end)
+    if cursor:
+      where.append('id < ?')
+      args.append(cursor)
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    sql = 'SELECT id, time, call, string FROM history'
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY id DESC LIMIT ?'
+    args.append(limit + 1)
+    with self._lock:
+      rows = self._db.execute(sql, args).fetchall()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else 0
+    return [(row[1], row[2], row[3]) for row in rows[:limit]], next_cursor
+
+  def export(self, call='', action='', start=0, end=0):
+    """Generate (time, call, action, string) for all matching history,
+       oldest first.  Rows are read EXPORT_PAGE_SIZE at a time and the
+       lock is only held while a page is read, so a slow reader neither
+       holds up new entries nor needs the whole result in memory.
+       """
+    where, args = self._filters(call, action, start, end)
+    where.append('id > ?')
+    sql = ('SELECT id, time, call, action, string FROM history WHERE ' +
+           ' AND '.join(where) + ' ORDER BY id LIMIT ?')
+    last = 0
+    while True:
+      with self._lock:
+        rows = self._db.execute(sql, args + [last, EXPORT_PAGE_SIZE]).fetchall()
+      for row in rows:
+        yield row[1:]
+      if len(rows) < EXPORT_PAGE_SIZE:
+        return
+      last = rows[-1][0]
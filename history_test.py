@@ -0,0 +1,71 @@
+#!/usr/bin/python
+"""
+Tests for history.py's journal: what is logged is what is read back
+after a restart, and older journals are still read.
+
+Run it from the arcom-server directory:  python history_test.py
+"""
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import history
+
+LOCATION = 'Interference reported on the north side of the ridge near ' * 3
+
+
+class JournalTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'arcom.journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def open_journal(self):
+    journal = history.HistoryJournal(self.path, 10)
+    self.addCleanup(journal.close)
+    return journal
+
+  def reopen(self, journal):
+    journal.close()
+    return self.open_journal()
+
+  def test_long_entry_survives_restart(self):
+    journal = self.open_journal()
+    journal.append((1.0, 'KD7DK/Doug', 'Log Interference ' + LOCATION))
+    before = journal.tail(10)
+    self.assertEqual(self.reopen(journal).tail(10), before)
+    self.assertEqual(before[0][2], 'Log Interference ' + LOCATION)
+
+  def test_too_long_entry_cut_before_ring(self):
+    journal = self.open_journal()
+    journal.append((1.0, 'K' * 40, 'x' * 600))
+    before = journal.tail(10)
+    self.assertEqual(len(before[0][1]), history.CALL_SIZE)
+    self.assertEqual(len(before[0][2]), history.TEXT_SIZE)
+    self.assertEqual(self.reopen(journal).tail(10), before)
+
+  def test_missing_journal_is_empty(self):
+    journal = self.open_journal()
+    self.assertEqual(len(journal), 0)
+    journal.append((1.0, 'KD7DK', 'Port 1 OFF'))
+    self.assertEqual(self.reopen(journal).tail(10),
+                     [(1.0, 'KD7DK', 'Port 1 OFF')])
+
+  def test_old_journal_converted(self):
+    with open(self.path, 'wb') as f:
+      for seconds in range(3):
+        f.write(history.RECORD_V1.pack(seconds, 'KD7DK', 'Bridge'))
+    journal = self.open_journal()
+    journal.append((3.0, 'KG7AUL', 'Unbridge'))
+    entries = self.reopen(journal).tail(10)
+    self.assertEqual(entries[0], (0.0, 'KD7DK', 'Bridge'))
+    self.assertEqual(entries[-1], (3.0, 'KG7AUL', 'Unbridge'))
+    self.assertEqual(len(entries), 4)
+
+
+if __name__ == '__main__':
+  logging.getLogger('arcom').addHandler(logging.NullHandler())
+  unittest.main()
@@ -0,0 +1,98 @@
+"""
+Queued logging for arcom-server.
+
+Request and serial threads should not wait on a log file write, least of
+all while holding a lock.  QueueHandler renders each record's message and
+puts it on a bounded queue; one QueueListener thread formats the records
+and hands them to the real handlers.  When the queue is full the record
+is dropped and counted rather than blocking the caller.
+
+JSONFormatter writes one JSON object per line for log shippers.
+"""
+import json
+import logging
+import Queue
+import threading
+import metrics
+
+DEFAULT_SIZE = 10000
+
+_formatter = logging.Formatter()
+
+
+class QueueHandler(logging.Handler):
+  """Puts records on a queue for a QueueListener."""
+  def __init__(self, queue):
+    logging.Handler.__init__(self)
+    self.queue = queue
+
+  def prepare(self, record):
+    """Render the message and traceback now, on the logging thread, as
+       the arguments may change before the listener gets to them.
+       """
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+      record.exc_text = _formatter.formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+  def emit(self, record):
+    try:
+      self.queue.put_nowait(self.prepare(record))
+    except Queue.Full:
+      metrics.log_records_dropped.inc()
+    except Exception:
+      self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+  """Takes records off a queue and passes them to handlers."""
+  def __init__(self, queue, handlers):
+    threading.Thread.__init__(self, name='logger')
+    self.daemon = True
+    self.queue = queue
+    self.handlers = handlers
+
+  def run(self):
+    while True:
+      record = self.queue.get()
+      if record is None:
+        break
+      for handler in self.handlers:
+        if record.levelno >= handler.level:
+          handler.handle(record)
+
+  def stop(self):
+    """Write out what is queued and stop."""
+    self.queue.put(None)
+    self.join()
+    for handler in self.handlers:
+      handler.flush()
+
+
+class JSONFormatter(logging.Formatter):
+  """Formats a record as a single line JSON object."""
+  def format(self, record):
+    entry = {'time': round(record.created, 3),
+             'level': record.levelname,
+             'thread': record.threadName,
+             'msg': record.getMessage()}
+    if record.exc_info and not record.exc_text:
+      record.exc_text = self.formatException(record.exc_info)
+    if record.exc_text:
+      entry['exc'] = record.exc_text
+    return json.dumps(entry, sort_keys=True)
+
+
+def start(logger, handlers, size=DEFAULT_SIZE):
+  """Send logger's records through a queue of size to handlers, instead
+     of any handlers it had.  Returns the listener.
+     """
+  queue = Queue.Queue(size)
+  listener = QueueListener(queue, handlers)
+  listener.start()
+  for handler in list(logger.handlers):
+    logger.removeHandler(handler)
+  logger.addHandler(QueueHandler(queue))
+  return listener
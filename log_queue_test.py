@@ -0,0 +1,57 @@
+#!/usr/bin/python
+"""
+Tests for log_queue.py: records queued when the listener is stopped
+are written, and only a full queue drops them.
+
+Run it from the arcom-server directory:  python log_queue_test.py
+"""
+import logging
+import time
+import unittest
+import log_queue
+import metrics
+
+
+class SlowHandler(logging.Handler):
+  """Keeps the messages it handles, taking a while over each."""
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+    self.flushed = False
+
+  def emit(self, record):
+    time.sleep(0.001)
+    self.messages.append(record.getMessage())
+
+  def flush(self):
+    self.flushed = True
+
+
+class ListenerTest(unittest.TestCase):
+  def setUp(self):
+    self.logger = logging.getLogger('log_queue_test')
+    self.logger.propagate = False
+    self.logger.setLevel(logging.INFO)
+    self.handler = SlowHandler()
+
+  def test_stop_drains_queue(self):
+    listener = log_queue.start(self.logger, [self.handler])
+    for i in range(200):
+      self.logger.info('record %d', i)
+    listener.stop()
+    self.assertEqual(self.handler.messages,
+                     ['record %d' % i for i in range(200)])
+    self.assertTrue(self.handler.flushed)
+
+  def test_full_queue_counts_drops(self):
+    dropped = metrics.log_records_dropped.values.get((), 0)
+    listener = log_queue.start(self.logger, [self.handler], size=1)
+    for i in range(200):
+      self.logger.info('record %d', i)
+    listener.stop()
+    self.assertEqual(len(self.handler.messages) +
+                     metrics.log_records_dropped.values[()] - dropped, 200)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,203 @@
+"""
+Metrics for arcom-server in the Prometheus text exposition format.
+
+Counters and histograms are module level objects registered when they
+are created; the web server's /metrics page renders them all.  Updating
+one is a dict lookup and a few additions under an uncontended lock, so
+they can sit on the hot paths.
+"""
+import bisect
+import threading
+import time
+import tracing
+
+# Seconds, from a fast serial answer to a slow Google post.
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+  with _registry_lock:
+    _registry.append(metric)
+  return metric
+
+
+def _label_string(names, values):
+  if not names:
+    return ''
+  pairs = []
+  for name, value in zip(names, values):
+    value = str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    pairs.append('%s="%s"' % (name, value))
+  return '{%s}' % ','.join(pairs)
+
+
+def _number(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+  """A count that only goes up, optionally split by labels."""
+  kind = 'counter'
+
+  def __init__(self, name, doc, labels=()):
+    self.name = name
+    self.doc = doc
+    self.labels = tuple(labels)
+    self.values = {}
+    self.lock = threading.Lock()
+    _register(self)
+
+  def inc(self, labels=(), amount=1):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def samples(self):
+    with self.lock:
+      values = sorted(self.values.items())
+    for labels, value in values:
+      yield self.name, _label_string(self.labels, labels), value
+
+
+class Gauge(Counter):
+  """A value that goes up and down; inc() with a negative amount."""
+  kind = 'gauge'
+
+
+class Histogram(object):
+  """Observations counted into cumulative buckets, optionally split by
+     labels.
+     """
+  kind = 'histogram'
+
+  def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.doc = doc
+    self.labels = tuple(labels)
+    self.buckets = tuple(buckets)
+    self.values = {}            # labels -> [bucket counts..., sum]
+    self.lock = threading.Lock()
+    _register(self)
+
+  def observe(self, value, labels=()):
+    i = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      counts = self.values.get(labels)
+      if counts is None:
+        counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+      counts[i] += 1
+      counts[-1] += value
+
+  def since(self, start, labels=()):
+    """Observe the seconds since start (a time.time())."""
+    self.observe(time.time() - start, labels)
+
+  def samples(self):
+    with self.lock:
+      values = sorted((labels, list(counts))
+                      for labels, counts in self.values.items())
+    label_names = self.labels + ('le',)
+    for labels, counts in values:
+      total = 0
+      for bound, count in zip(self.buckets + (float('inf'),), counts):
+        total += count
+        yield (self.name + '_bucket',
+               _label_string(label_names, labels + (_number(bound),)), total)
+      yield self.name + '_sum', _label_string(self.labels, labels), counts[-1]
+      yield self.name + '_count', _label_string(self.labels, labels), total
+
+
+class TimedLock(object):
+  """A Lock that records how long callers wait for it and hold it."""
+  def __init__(self, wait, hold, labels=()):
+    self.lock = threading.Lock()
+    self.wait = wait
+    self.hold = hold
+    self.labels = labels
+    self.acquired = None
+
+  def acquire(self):
+    start = time.time()
+    self.lock.acquire()
+    self.acquired = time.time()
+    tracing.add_span('lock wait', start, self.acquired,
+                     lock=','.join(self.labels))
+    self.wait.observe(self.acquired - start, self.labels)
+    return True
+
+  def release(self):
+    self.hold.since(self.acquired, self.labels)
+    self.lock.release()
+
+  def __enter__(self):
+    return self.acquire()
+
+  def __exit__(self, *args):
+    self.release()
+
+
+def render():
+  """All registered metrics in the text exposition format."""
+  with _registry_lock:
+    metrics = list(_registry)
+  lines = []
+  for metric in metrics:
+    lines.append('# HELP %s %s' % (metric.name, metric.doc))
+    lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+    for name, labels, value in metric.samples():
+      lines.append('%s%s %s' % (name, labels, _number(value)))
+  return '\n'.join(lines) + '\n'
+
+
+# Metrics shared between modules.
+serial_command_seconds = Histogram(
+    'arcom_serial_command_seconds',
+    'Round trip time of one command to the controller.', ('result',))
+serial_queue_wait_seconds = Histogram(
+    'arcom_serial_queue_wait_seconds',
+    'Time a job waits for the serial port.', ('priority',))
+serial_queue_depth = Gauge(
+    'arcom_serial_queue_depth', 'Jobs waiting for the serial port.',
+    ('priority',))
+serial_jobs_expired = Counter(
+    'arcom_serial_jobs_expired_total',
+    'Jobs cancelled because their deadline passed while queued.',
+    ('priority',))
+serial_job_seconds = Histogram(
+    'arcom_serial_job_seconds',
+    'Time a job holds the serial port.')
+lock_wait_seconds = Histogram(
+    'arcom_lock_wait_seconds', 'Time spent waiting for a lock.', ('lock',))
+lock_hold_seconds = Histogram(
+    'arcom_lock_hold_seconds', 'Time a lock is held.', ('lock',))
+rpc_seconds = Histogram(
+    'arcom_rpc_seconds', 'RPC method latency.', ('method', 'result'))
+http_responses = Counter(
+    'arcom_http_responses_total', 'HTTP responses sent by status code.',
+    ('code',))
+auth_failures = Counter(
+    'arcom_auth_failures_total', 'Rejected HTTP requests.', ('reason',))
+weblog_post_seconds = Histogram(
+    'arcom_weblog_post_seconds', 'Time to post a report to the web log.',
+    ('result',))
+state_polls = Counter(
+    'arcom_state_polls_total', 'Controller state polls by result.',
+    ('result',))
+state_drift = Counter(
+    'arcom_state_drift_total',
+    'Polled state that differed from what the server thought.', ('state',))
+log_records_dropped = Counter(
+    'arcom_log_records_dropped_total',
+    'Log records dropped because the log queue was full.')
+controller_events = Counter(
+    'arcom_controller_events_total',
+    'Unsolicited lines from the controller by kind.', ('kind',))
+commands_saved = Counter(
+    'arcom_commands_saved_total',
+    'Commands not sent because they were coalesced or already in effect.',
+    ('how',))
@@ -0,0 +1,184 @@
+"""
+Durable outbox for reports posted to outside services.
+
+A report is written to a spool directory before the caller returns and
+is removed only once it has been delivered, so nothing is lost when the
+remote end is slow or down or the server restarts.  A small pool of
+sender threads delivers reports, retrying failures with exponential
+backoff.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('arcom')
+
+
+class Outbox(object):
+  """Spool directory plus sender threads.
+     send is called with a queued payload and returns (status, msg);
+     a false status or an exception means try again later.
+     """
+  def __init__(self, path, send, senders=2, max_attempts=20,
+               backoff=5.0, max_backoff=600.0):
+    self.path = path
+    self.send = send
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self._cond = threading.Condition(threading.Lock())
+    self._queue = []          # heap of (due time, sequence, item)
+    self._seq = itertools.count()
+    self._inflight = 0
+    self._sent = 0
+    self._failed = 0
+    self._retries = 0
+    self._post_seconds = 0.0
+    self._delivery_seconds = 0.0
+    self._last_post_seconds = None
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self._load()
+    for i in range(senders):
+      sender = threading.Thread(target=self._sender, name='outbox-%d' % i)
+      sender.daemon = True
+      sender.start()
+
+  def _load(self):
+    """Queue reports left in the spool directory by an earlier run."""
+    for name in sorted(os.listdir(self.path)):
+      if not name.endswith('.json'):
+        continue
+      try:
+        with open(os.path.join(self.path, name)) as f:
+          item = json.load(f)
+      except (IOError, ValueError) as e:
+        log.error('outbox: unreadable %s: %s', name, e)
+        continue
+      item['name'] = name
+      heapq.heappush(self._queue, (time.time(), next(self._seq), item))
+    if self._queue:
+      log.info('outbox: %d queued reports from %s', len(self._queue), self.path)
+
+  def _write(self, item):
+    """Atomically write item to its spool file."""
+    path = os.path.join(self.path, item['name'])
+    data = dict((k, v) for k, v in item.items() if k != 'name')
+    with open(path + '.tmp', 'w') as f:
+      json.dump(data, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+  def put(self, payload):
+    """Spool payload for delivery.  Raises IOError/OSError if it could
+       not be written.
+       """
+    now = time.time()
+    seq = next(self._seq)       # tells apart reports spooled in one tick
+    item = {
+        'name': '%.6f-%d-%d.json' % (now, os.getpid(), seq),
+        'payload': payload,
+        'queued': now,
+        'attempts': 0,
+        }
+    self._write(item)
+    with self._cond:
+      heapq.heappush(self._queue, (now, seq, item))
+      self._cond.notify()
+    return item['name']
+
+  def stats(self):
+    """Queue depth, delivery counts and latencies."""
+    with self._cond:
+      sent = self._sent
+      stats = {
+          'queued': len(self._queue),
+          'inflight': self._inflight,
+          'sent': sent,
+          'failed': self._failed,
+          'retries': self._retries,
+          'oldest': 0.0,
+          }
+      if self._queue:
+        stats['oldest'] = time.time() - min(i[2]['queued'] for i in self._queue)
+      if self._last_post_seconds is not None:
+        stats['lastPostSeconds'] = self._last_post_seconds
+      if sent:
+        stats['avgPostSeconds'] = self._post_seconds / sent
+        stats['avgDeliverySeconds'] = self._delivery_seconds / sent
+    return stats
+
+  def _next(self):
+    """Block until a report is due and return it."""
+    with self._cond:
+      while True:
+        if self._queue:
+          wait = self._queue[0][0] - time.time()
+          if wait <= 0:
+            self._inflight += 1
+            return heapq.heappop(self._queue)[2]
+        else:
+          wait = None
+        self._cond.wait(wait)
+
+  def _sender(self):
+    while True:
+      item = self._next()
+      start = time.time()
+      try:
+        status, msg = self.send(item['payload'])
+      except Exception as e:
+        status, msg = False, str(e)
+      seconds = time.time() - start
+      item['attempts'] += 1
+      if status:
+        self._delivered(item, seconds)
+      else:
+        self._retry(item, seconds, msg)
+
+  def _delivered(self, item, seconds):
+    try:
+      os.remove(os.path.join(self.path, item['name']))
+    except OSError as e:
+      log.error('outbox: removing %s: %s', item['name'], e)
+    log.info('outbox: delivered %s in %.2fs', item['name'], seconds)
+    with self._cond:
+      self._inflight -= 1
+      self._sent += 1
+      self._post_seconds += seconds
+      self._last_post_seconds = seconds
+      self._delivery_seconds += time.time() - item['queued']
+
+  def _retry(self, item, seconds, msg):
+    """Requeue with backoff, or give up after max_attempts."""
+    name = item['name']
+    if item['attempts'] >= self.max_attempts:
+      log.error('outbox: giving up on %s after %d attempts: %s',
+                name, item['attempts'], msg)
+      try:
+        os.rename(os.path.join(self.path, name),
+                  os.path.join(self.path, name + '.failed'))
+      except OSError as e:
+        log.error('outbox: %s', e)
+      with self._cond:
+        self._inflight -= 1
+        self._failed += 1
+      return
+    delay = min(self.backoff * 2 ** (item['attempts'] - 1), self.max_backoff)
+    log.info('outbox: %s attempt %d failed in %.2fs (%s), retry in %ds',
+             name, item['attempts'], seconds, msg, delay)
+    try:
+      self._write(item)
+    except (IOError, OSError) as e:
+      log.error('outbox: updating %s: %s', name, e)
+    with self._cond:
+      self._inflight -= 1
+      self._retries += 1
+      self._last_post_seconds = seconds
+      heapq.heappush(self._queue, (time.time() + delay, next(self._seq), item))
+      self._cond.notify()
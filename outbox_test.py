@@ -0,0 +1,40 @@
+#!/usr/bin/python
+"""
+Tests for outbox.py's spool.
+
+Run it from the arcom-server directory:  python outbox_test.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import outbox
+
+
+class StoppedClock(object):
+  """Stands in for the time module with a clock that does not move."""
+  @staticmethod
+  def time():
+    return 1000.0
+
+
+class SpoolTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.clock, outbox.time = outbox.time, StoppedClock
+
+  def tearDown(self):
+    outbox.time = self.clock
+    shutil.rmtree(self.dir)
+
+  def test_reports_in_one_tick_kept_apart(self):
+    spool = outbox.Outbox(self.dir, None, senders=0)
+    names = [spool.put({'report': i}) for i in range(3)]
+    self.assertEqual(len(set(names)), 3)
+    self.assertEqual(sorted(os.listdir(self.dir)), sorted(names))
+    reloaded = outbox.Outbox(self.dir, None, senders=0)
+    self.assertEqual(reloaded.stats()['queued'], 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
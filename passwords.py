@@ -0,0 +1,40 @@
+"""
+Password hashes for arcom.passwd, shared by web_server and gen_password.
+"""
+import hashlib
+import hmac
+import logging
+import os
+
+log = logging.getLogger('arcom')
+
+PBKDF2_ITERATIONS = 100000
+
+
+def hash_password(user, password, salt=None, iterations=PBKDF2_ITERATIONS):
+  """Return a pbkdf2_sha256$iterations$salt$hash entry for arcom.passwd."""
+  if salt is None:
+    salt = os.urandom(16).encode('hex')
+  digest = hashlib.pbkdf2_hmac('sha256', 'arcom' + user + password,
+                               salt, iterations)
+  return 'pbkdf2_sha256$%d$%s$%s' % (iterations, salt, digest.encode('hex'))
+
+
+def check_password(user, password, password_hash):
+  """Check a password against either hash format in arcom.passwd:
+     pbkdf2_sha256$iterations$salt$hash or the older bare sha224.  A
+     malformed entry fails the check, with a warning.
+     """
+  if password_hash.startswith('pbkdf2_sha256$'):
+    try:
+      _, iterations, salt, _ = password_hash.split('$')
+      iterations = int(iterations)
+      if iterations < 1:
+        raise ValueError(iterations)
+    except ValueError:
+      log.warning('malformed pbkdf2_sha256 entry for %s', user)
+      return False
+    expected = hash_password(user, password, salt, iterations)
+  else:
+    expected = hashlib.sha224('arcom'+user+password).hexdigest()
+  return hmac.compare_digest(expected, str(password_hash))
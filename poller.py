@@ -0,0 +1,102 @@
+"""
+Background state poller for the Arcom RC210.
+
+Our idea of port 1 and port 3 only changes when our own commands
+succeed, so changes made at the keypad or by DTMF go unnoticed.  The
+poller asks the controller now and then, only once the serial port has
+been quiet for a while, and reports what it finds.  Its queries are
+background jobs on the serial engine: they are dropped rather than sent
+if an operator command is waiting, and a reading is thrown away if an
+operator command got in while it was being taken.
+
+Polls are configured in [arcom poll]:
+
+  interval = 30                 ; seconds between rounds
+  quiet = 5                     ; seconds the port must be idle
+  port1Enabled = CODE | REGEX   ; true when a line of the answer matches
+"""
+import logging
+import re
+import threading
+import metrics
+
+log = logging.getLogger('arcom')
+
+POLL_SECTION = 'arcom poll'
+DEFAULT_INTERVAL = 30.0
+DEFAULT_QUIET = 5.0
+QUIET_CHECK = 0.5       # seconds between checks for an idle port
+
+
+def read_polls(cfg, attrs):
+  """Return (interval, quiet, polls) from [arcom poll], where polls is a
+     list of (attr, code, regex).  attrs are the state attribute names
+     that may be polled; the config parser lower cases option names.
+     """
+  if not cfg.has_section(POLL_SECTION):
+    return DEFAULT_INTERVAL, DEFAULT_QUIET, []
+  by_option = dict((attr.lower(), attr) for attr in attrs)
+  polls = []
+  defaults = cfg.defaults()
+  for option in cfg.options(POLL_SECTION):
+    if option in ('interval', 'quiet') or option in defaults:
+      continue
+    if option not in by_option:
+      log.error('[%s] %s: not a state that can be polled', POLL_SECTION, option)
+      continue
+    code, _, pattern = cfg.get(POLL_SECTION, option).partition('|')
+    regex = re.compile(pattern.strip(), re.MULTILINE)
+    polls.append((by_option[option], code.strip(), regex))
+  interval = DEFAULT_INTERVAL
+  quiet = DEFAULT_QUIET
+  if cfg.has_option(POLL_SECTION, 'interval'):
+    interval = cfg.getfloat(POLL_SECTION, 'interval')
+  if cfg.has_option(POLL_SECTION, 'quiet'):
+    quiet = cfg.getfloat(POLL_SECTION, 'quiet')
+  return interval, quiet, polls
+
+
+class StatePoller(threading.Thread):
+  """Poll the controller's state during idle windows on the port.
+     reconcile(attr, value, generation) is called with each reading and
+     the engine generation it was taken in.
+     """
+  def __init__(self, engine, polls, reconcile, interval=DEFAULT_INTERVAL,
+               quiet=DEFAULT_QUIET, name='poller'):
+    threading.Thread.__init__(self, name=name)
+    self.daemon = True
+    self.engine = engine
+    self.polls = polls
+    self.reconcile = reconcile
+    self.interval = interval
+    self.quiet = quiet
+    self.stopped = threading.Event()
+
+  def stop(self):
+    self.stopped.set()
+
+  def wait_for_quiet(self):
+    """Wait until the port has been idle for quiet seconds.  Gives up
+       (returns False) when the next round is due or on stop().
+       """
+    waited = 0.0
+    while self.engine.idle_for() < self.quiet:
+      if waited >= self.interval or self.stopped.wait(QUIET_CHECK):
+        return False
+      waited += QUIET_CHECK
+    return True
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      for attr, code, regex in self.polls:
+        if not self.wait_for_quiet():
+          metrics.state_polls.inc(('busy',))
+          break
+        generation = self.engine.generation
+        status, text = self.engine.query(code)
+        if not status:
+          log.debug('poll %s: %s', attr, text)
+          metrics.state_polls.inc(('failed',))
+          continue
+        metrics.state_polls.inc(('ok',))
+        self.reconcile(attr, bool(regex.search(text)), generation)
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+"""Arcom RC210 control - Controller simulator
+
+   Presents a pseudo-terminal that speaks enough of the RCP serial
+   protocol to exercise arcom-server.py without a controller attached.
+   Each 1*<code> line is answered with + (or - for a rejected code)
+   after a configurable delay and jitter.  Bytes can be dropped from
+   the output and unsolicited lines are sent now and then, as the real
+   controller does.
+
+   python rc210_sim.py --link /tmp/rc210 --delay 0.05 --jitter 0.02
+   python arcom-server.py --device /tmp/rc210
+
+   With --config, only the codes in [arcom commands] are accepted
+   (setDate and setTime followed by six digits).
+
+   Reference: RCP Protocol and Serial Port Operations
+   (available from the Arcom website)
+"""
+import heapq
+import optparse
+import os
+import pty
+import random
+import select
+import sys
+import time
+import tty
+from configparser import ConfigParser
+
+UNSOLICITED = (
+    'DTMF 1234',
+    'Port 1 COS',
+    'Port 1 COS drop',
+    'Port 3 COS',
+    'Port 3 COS drop',
+    'Timeout timer reset',
+)
+
+
+class Simulator(object):
+  """One simulated controller on a pty."""
+  def __init__(self, delay=0.0, jitter=0.0, drop=0.0, reject=0.0,
+               chatter=0.0, codes=None, seed=None):
+    self.delay = delay
+    self.jitter = jitter
+    self.drop = drop
+    self.reject = reject
+    self.chatter = chatter
+    self.codes = codes
+    self.random = random.Random(seed)
+    self.master, self.slave = pty.openpty()
+    tty.setraw(self.slave)
+    self.name = os.ttyname(self.slave)
+    self.pending = []           # heap of (due, seq, data) to write
+    self.seq = 0
+    self.buf = ''
+    self.next_chatter = self.chatter_due(time.time())
+    self.stats = {'commands': 0, 'accepted': 0, 'rejected': 0,
+                  'unsolicited': 0, 'dropped': 0, 'garbage': 0}
+
+  def chatter_due(self, now):
+    if not self.chatter:
+      return None
+    return now + self.random.expovariate(1.0 / self.chatter)
+
+  def accept(self, code):
+    """True if code is one the controller would take."""
+    if self.codes is None:
+      return True
+    if code in self.codes:
+      return True
+    for prefix in self.codes:
+      rest = code[len(prefix):]
+      if code.startswith(prefix) and len(rest) == 6 and rest.isdigit():
+        return True
+    return False
+
+  def queue(self, data, due):
+    heapq.heappush(self.pending, (due, self.seq, data))
+    self.seq += 1
+
+  def write(self, data):
+    """Write data to the port, dropping bytes at random."""
+    if self.drop:
+      kept = [c for c in data if self.random.random() >= self.drop]
+      self.stats['dropped'] += len(data) - len(kept)
+      data = ''.join(kept)
+    if data:
+      os.write(self.master, data)
+
+  def handle(self, line, now):
+    """Answer one line from the server."""
+    if not line.startswith('1*'):
+      self.stats['garbage'] += 1
+      print 'ignored %r' % line
+      return
+    code = line[2:]
+    self.stats['commands'] += 1
+    ok = self.accept(code) and self.random.random() >= self.reject
+    self.stats['accepted' if ok else 'rejected'] += 1
+    delay = max(0.0, self.delay + self.random.uniform(-self.jitter, self.jitter))
+    print '%s %s (%.3fs)' % ('+' if ok else '-', code, delay)
+    sys.stdout.flush()
+    self.queue('+\r\n' if ok else '-\r\n', now + delay)
+
+  def run(self):
+    while True:
+      now = time.time()
+      wakeups = [due for due in (self.next_chatter,) if due is not None]
+      if self.pending:
+        wakeups.append(self.pending[0][0])
+      wait = max(0.0, min(wakeups) - now) if wakeups else None
+      ready, _, _ = select.select([self.master], [], [], wait)
+
+      now = time.time()
+      if ready:
+        self.buf += os.read(self.master, 1024)
+        while True:
+          cut = min([i for i in (self.buf.find('\r'), self.buf.find('\n'))
+                     if i >= 0] or [-1])
+          if cut < 0:
+            break
+          line, self.buf = self.buf[:cut], self.buf[cut+1:]
+          if line:
+            self.handle(line, now)
+
+      while self.pending and self.pending[0][0] <= now:
+        self.write(heapq.heappop(self.pending)[2])
+      if self.next_chatter is not None and self.next_chatter <= now:
+        self.stats['unsolicited'] += 1
+        self.write(self.random.choice(UNSOLICITED) + '\r\n')
+        self.next_chatter = self.chatter_due(now)
+
+
+def config_codes(path):
+  """The command codes from an arcom-server.conf."""
+  cfg = ConfigParser()
+  if not cfg.read(path):
+    raise IOError('cannot read %s' % path)
+  defaults = cfg.defaults()
+  return set(str(value) for key, value in cfg.items('arcom commands')
+             if key not in defaults)
+
+
+def main():
+  """Main module - parse args and run the simulator"""
+  p = optparse.OptionParser()
+  p.add_option('--link', action='store', type='string', dest='link',
+               help='make a symlink to the pty here for --device')
+  p.add_option('--delay', action='store', type='float', dest='delay',
+               help='seconds before each response')
+  p.add_option('--jitter', action='store', type='float', dest='jitter',
+               help='responses vary by up to this many seconds either way')
+  p.add_option('--drop', action='store', type='float', dest='drop',
+               help='fraction of output bytes to drop')
+  p.add_option('--reject', action='store', type='float', dest='reject',
+               help='fraction of commands to answer with -')
+  p.add_option('--chatter', action='store', type='float', dest='chatter',
+               help='mean seconds between unsolicited lines, 0 for none')
+  p.add_option('--config', action='store', type='string', dest='config',
+               help='accept only the [arcom commands] codes in this file')
+  p.add_option('--seed', action='store', type='int', dest='seed')
+  p.set_defaults(link=None, delay=0.05, jitter=0.0, drop=0.0, reject=0.0,
+                 chatter=0.0, config=None, seed=None)
+  opt, _ = p.parse_args()
+
+  codes = config_codes(opt.config) if opt.config else None
+  sim = Simulator(opt.delay, opt.jitter, opt.drop, opt.reject, opt.chatter,
+                  codes, opt.seed)
+  if opt.link:
+    if os.path.islink(opt.link):
+      os.unlink(opt.link)
+    os.symlink(sim.name, opt.link)
+  print 'RC210 simulator on %s' % (opt.link or sim.name)
+  sys.stdout.flush()
+  try:
+    sim.run()
+  except KeyboardInterrupt:
+    print sim.stats
+  finally:
+    if opt.link and os.path.islink(opt.link):
+      os.unlink(opt.link)
+
+
+if __name__ == '__main__':
+  main()
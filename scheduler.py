@@ -0,0 +1,221 @@
+"""
+Deferred and recurring actions for arcom-server.
+
+One thread works through a heap of schedules ordered by due time and
+runs each through a dispatch callback, e.g. the auto-enable at the end
+of a timed disable or a nightly setDateTime.  One-off schedules and the
+controllers' port state are saved to a JSON file on every change, so a
+restart during a timed disable still re-enables the repeater (straight
+away if the time has passed while the server was down).
+
+Recurring schedules come from [arcom schedule], one per line:
+
+  clock = daily 03:00 setDateTime
+  north-clock = daily 03:05 north.setDateTime
+  lock = every 3600 runMacro lockdown
+
+They are rebuilt from the config at startup rather than saved.
+"""
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+log = logging.getLogger('arcom')
+
+SCHEDULE_SECTION = 'arcom schedule'
+
+
+def next_due(repeat, now):
+  """The next time after now for a 'daily HH:MM' or 'every SECONDS'
+     repeat spec.
+     """
+  kind, _, spec = repeat.partition(' ')
+  if kind == 'every':
+    return now + float(spec)
+  if kind == 'daily':
+    hour, minute = [int(part) for part in spec.split(':')]
+    today = datetime.datetime.fromtimestamp(now).replace(
+        hour=hour, minute=minute, second=0, microsecond=0)
+    due = time.mktime(today.timetuple())
+    if due <= now:
+      due = time.mktime((today + datetime.timedelta(days=1)).timetuple())
+    return due
+  raise ValueError('bad repeat %r' % repeat)
+
+
+def read_config(cfg, strict=False):
+  """Return [(id, controller, action, args, repeat)] from [arcom schedule].
+     A bad schedule is logged and left out, or with strict raises
+     ValueError.
+     """
+  if not cfg.has_section(SCHEDULE_SECTION):
+    return []
+  defaults = cfg.defaults()
+  result = []
+  for label in cfg.options(SCHEDULE_SECTION):
+    if label in defaults:
+      continue
+    words = cfg.get(SCHEDULE_SECTION, label).split()
+    try:
+      if words[0] == 'daily':
+        repeat, target, args = 'daily ' + words[1], words[2], words[3:]
+      elif words[0] == 'every':
+        repeat, target, args = 'every ' + words[1], words[2], words[3:]
+      else:
+        raise ValueError(words[0])
+      next_due(repeat, time.time())
+    except (IndexError, ValueError) as e:
+      if strict:
+        raise ValueError('[%s] %s: bad schedule (%s)'
+                         % (SCHEDULE_SECTION, label, e))
+      log.error('[%s] %s: bad schedule (%s)', SCHEDULE_SECTION, label, e)
+      continue
+    controller, _, action = target.rpartition('.')
+    result.append(('config:' + label, controller, action, args, repeat))
+  return result
+
+
+class Scheduler(object):
+  """Runs dispatch(job) for each schedule when it is due, on one thread.
+     A job is a dict with id, due, controller, action, args and repeat.
+     """
+  def __init__(self, path, dispatch):
+    self.path = path
+    self.dispatch = dispatch
+    self.jobs = {}
+    self.state = {}
+    self._heap = []
+    self._seq = itertools.count()
+    self._cond = threading.Condition(threading.Lock())
+    self._save_lock = threading.Lock()
+    self._thread = None
+    self.load()
+
+  def load(self):
+    """Read the saved schedules and port state."""
+    try:
+      with open(self.path) as f:
+        saved = json.load(f)
+    except IOError:
+      return
+    except ValueError as e:
+      log.error('error reading %s: %s', self.path, e)
+      return
+    self.state = saved.get('state', {})
+    for job in saved.get('schedules', []):
+      self._push(job)
+    log.info('Loaded %d schedules from %s', len(self.jobs), self.path)
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name='scheduler')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _push(self, job):
+    self.jobs[job['id']] = job
+    heapq.heappush(self._heap, (job['due'], next(self._seq), job['id']))
+
+  def add(self, action, args, due, controller='', repeat=None, job_id=None):
+    """Schedule action(*args) on controller at due; returns the id."""
+    job = {'id': job_id or uuid.uuid4().hex[:8], 'due': due,
+           'controller': controller, 'action': action, 'args': list(args),
+           'repeat': repeat}
+    with self._cond:
+      self._push(job)
+      self._cond.notify()
+    self.save()
+    return job['id']
+
+  def cancel(self, job_id):
+    """Remove a schedule.  Returns it, or None if there is no such id."""
+    with self._cond:
+      job = self.jobs.pop(job_id, None)
+      self._cond.notify()
+    if job:
+      self.save()
+    return job
+
+  def list(self):
+    """All schedules, soonest first."""
+    with self._cond:
+      return sorted((dict(job) for job in self.jobs.values()),
+                    key=lambda job: job['due'])
+
+  def save_state(self, controller, state):
+    """Remember a controller's state, saving if it changed."""
+    with self._cond:
+      if self.state.get(controller) == state:
+        return
+      self.state[controller] = state
+    self.save()
+
+  def save(self):
+    """Write one-off schedules and state to path, atomically."""
+    with self._cond:
+      saved = {'schedules': [job for job in self.jobs.values()
+                             if not job['id'].startswith('config:')],
+               'state': dict(self.state)}
+      data = json.dumps(saved, indent=1, sort_keys=True)
+    with self._save_lock:
+      tmp = self.path + '.tmp'
+      try:
+        with open(tmp, 'w') as f:
+          f.write(data)
+          f.flush()
+          os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+      except (IOError, OSError) as e:
+        log.error('error saving %s: %s', self.path, e)
+
+  def _next(self):
+    """Wait for and take the next due job, rescheduling repeats.  A
+       one-off job stays in jobs, and so in the saved file, until it has
+       run.
+       """
+    with self._cond:
+      while True:
+        while self._heap:
+          due, _, job_id = self._heap[0]
+          job = self.jobs.get(job_id)
+          if job is not None and job['due'] == due:
+            break
+          heapq.heappop(self._heap)       # cancelled or rescheduled
+        if not self._heap:
+          self._cond.wait()
+          continue
+        wait = self._heap[0][0] - time.time()
+        if wait > 0:
+          self._cond.wait(wait)
+          continue
+        heapq.heappop(self._heap)
+        if job['repeat']:
+          self._push(dict(job, due=next_due(job['repeat'], time.time())))
+        return job
+
+  def _run(self):
+    while True:
+      self._run_one(self._next())
+
+  def _run_one(self, job):
+    """Dispatch job, then drop it if it was a one-off.  A failure is
+       logged and the job still dropped; a crash during dispatch leaves
+       it saved, to run again at the next start.
+       """
+    log.info('Running schedule %s: %s %s%s', job['id'], job['action'],
+             job['controller'] + ' ' if job['controller'] else '',
+             job['args'])
+    try:
+      self.dispatch(job)
+    except Exception:
+      log.exception('schedule %s failed', job['id'])
+    if not job['repeat']:
+      with self._cond:
+        if self.jobs.get(job['id']) is job:
+          del self.jobs[job['id']]
+    self.save()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+"""
+Tests for scheduler.py: [arcom schedule] parsing, and that one-off
+jobs are kept until they have run.
+
+Run it from the arcom-server directory:  python scheduler_test.py
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from configparser import ConfigParser
+import scheduler
+
+
+def config(text):
+  cfg = ConfigParser({'serialDevice': '/dev/ttyUSB0'})
+  cfg.read_string(text)
+  return cfg
+
+
+class ReadConfigTest(unittest.TestCase):
+  def test_entries(self):
+    cfg = config(u"""
+[arcom schedule]
+clock = daily 03:00 setDateTime
+north-clock = daily 03:05 north.setDateTime
+lock = every 3600 runMacro lockdown
+""")
+    self.assertEqual(sorted(scheduler.read_config(cfg)), [
+        ('config:clock', '', 'setDateTime', [], 'daily 03:00'),
+        ('config:lock', '', 'runMacro', ['lockdown'], 'every 3600'),
+        ('config:north-clock', 'north', 'setDateTime', [], 'daily 03:05'),
+    ])
+
+  def test_no_section(self):
+    self.assertEqual(scheduler.read_config(config(u"")), [])
+
+  def test_bad_entries_left_out(self):
+    cfg = config(u"""
+[arcom schedule]
+typo = dialy 03:00 setDateTime
+late = daily 25:00 setDateTime
+short = every
+clock = daily 03:00 setDateTime
+""")
+    self.assertEqual([entry[0] for entry in scheduler.read_config(cfg)],
+                     ['config:clock'])
+
+  def test_bad_entry_strict(self):
+    cfg = config(u"""
+[arcom schedule]
+late = daily 25:00 setDateTime
+""")
+    self.assertRaises(ValueError, scheduler.read_config, cfg, True)
+
+  def test_next_due(self):
+    now = time.mktime((2026, 10, 18, 12, 0, 0, 0, 0, -1))
+    self.assertEqual(scheduler.next_due('every 60', now), now + 60)
+    self.assertEqual(scheduler.next_due('daily 13:30', now), now + 5400)
+    self.assertEqual(
+        time.localtime(scheduler.next_due('daily 03:00', now))[2:4], (19, 3))
+
+
+class RunTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'arcom.schedule')
+    self.ran = []
+    self.done = threading.Event()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def saved_ids(self):
+    with open(self.path) as f:
+      return [job['id'] for job in json.load(f)['schedules']]
+
+  def test_job_saved_until_run(self):
+    def dispatch(job):
+      self.ran.append((job['id'], self.saved_ids()))
+    schedules = scheduler.Scheduler(self.path, dispatch)
+    schedules.add('port1Enable', ['TEST', True], time.time() - 1,
+                  job_id='enable')
+    schedules._run_one(schedules._next())
+    self.assertEqual(self.ran, [('enable', ['enable'])])
+    self.assertEqual(self.saved_ids(), [])
+    self.assertEqual(schedules.list(), [])
+
+  def test_failure_logged_and_next_job_runs(self):
+    def dispatch(job):
+      self.ran.append(job['id'])
+      if job['id'] == 'first':
+        raise RuntimeError('controller gone')
+      self.done.set()
+    schedules = scheduler.Scheduler(self.path, dispatch)
+    now = time.time()
+    schedules.add('port1Enable', [], now - 2, job_id='first')
+    schedules.add('port1Enable', [], now - 1, job_id='second')
+    schedules.start()
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual(self.ran, ['first', 'second'])
+
+  def test_saved_job_runs_after_restart(self):
+    scheduler.Scheduler(self.path, None).add(
+        'port1Enable', ['TEST', True], time.time() - 1, job_id='enable')
+    schedules = scheduler.Scheduler(self.path, lambda job: self.ran.append(job))
+    schedules._run_one(schedules._next())
+    self.assertEqual([job['id'] for job in self.ran], ['enable'])
+
+  def test_repeat_rescheduled(self):
+    schedules = scheduler.Scheduler(self.path, self.ran.append)
+    schedules.add('setDateTime', [], time.time() - 1, repeat='every 60',
+                  job_id='config:clock')
+    schedules._run_one(schedules._next())
+    self.assertEqual(len(self.ran), 1)
+    self.assertGreater(schedules.list()[0]['due'], time.time() + 50)
+
+
+if __name__ == '__main__':
+  logging.getLogger('arcom').addHandler(logging.NullHandler())
+  unittest.main()
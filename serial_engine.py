@@ -0,0 +1,393 @@
+"""
+Serial engine for the Arcom RC210 controller.
+
+A reader thread consumes everything the controller sends and frames it
+into lines.  A line starting with + or - is the answer to the command in
+flight and is handed straight to the waiting caller; anything else is
+unsolicited output and goes to the listeners, unless it is the text of
+a query's answer.  Commands complete as soon as the controller answers
+instead of after fixed sleeps and blind drains of the port.  Each is
+sent after a bare CR that clears any partial entry on the controller.
+After a command times out, the next waits briefly for its late answer,
+so that answer is not taken for the next command's.
+
+All writes go through a single executor thread that owns the port;
+callers queue a job of one or more commands and wait for its results.
+Jobs are run in order of priority class (SAFETY, OPERATOR, MAINTENANCE,
+BACKGROUND), first come first served within a class, so a port 1
+disable never waits behind a date/time sync.  A job still queued at
+its deadline is cancelled and its caller told so.  Background jobs
+(state polls) are dropped instead of run when anything else is queued
+behind them, so they never hold up an operator.  A caller sending a
+command that is already queued, and not yet started, shares its result
+instead of sending it again; a command that sets some state on the
+controller is shared only while it is the newest one queued for that
+state, so a later opposite command is never answered for it.
+"""
+import itertools
+import logging
+import Queue
+import threading
+import time
+import metrics
+import tracing
+
+log = logging.getLogger('arcom')
+
+DEFAULT_TIMEOUT = 2.0
+
+# Priority classes, most urgent first.
+SAFETY = 0
+OPERATOR = 1
+MAINTENANCE = 2
+BACKGROUND = 3
+PRIORITY_NAMES = ('safety', 'operator', 'maintenance', 'background')
+
+# Seconds a job of each class may wait in the queue by default; None
+# waits as long as it takes.
+DEADLINES = (None, 30.0, 60.0, None)
+
+# Seconds to wait for the late answer to a command that timed out
+# before sending the next.
+LATE_ANSWER_WAIT = 1.0
+
+
+class Job(object):
+  """A sequence of commands to run back to back on the port."""
+  def __init__(self, commands, timeout, background=False, collect=False,
+               priority=OPERATOR, deadline=None):
+    self.commands = commands
+    self.timeout = timeout
+    self.background = background
+    self.collect = collect
+    self.priority = priority
+    self.key = None             # set while it is the newest for its key
+    self.started = False
+    self.cancelled = False
+    self.results = []
+    self.done = threading.Event()
+    self.queued = time.time()
+    if deadline is None:
+      deadline = DEADLINES[priority]
+    self.deadline = None if deadline is None else self.queued + deadline
+    self.span = tracing.current()
+
+
+class SerialEngine(object):
+  """Owns the serial port: one reader thread, and one executor thread
+     that runs queued jobs one command at a time.  In testing mode the
+     port is a plain file, nothing is read back and every command
+     succeeds.
+     """
+  def __init__(self, port, timeout=DEFAULT_TIMEOUT, testing=False):
+    self.port = port
+    self.timeout = timeout
+    self.testing = testing
+    self._jobs = Queue.PriorityQueue()   # (priority, seq, job)
+    self._seq = itertools.count()
+    self._cond = threading.Condition(threading.Lock())
+    self._waiting = False
+    self._late_until = 0.0      # a timed out command may still answer until
+    self._response = None
+    self._lines = []
+    self._collecting = False
+    self.listeners = []         # called with (time, line) for unsolicited output
+    self._inflight = {}         # key -> newest unfinished Job for it
+    self._inflight_lock = threading.Lock()  # also job.started, cancelled
+    self._running = True
+    self._busy = False
+    self.generation = 0         # foreground jobs started
+    self.last_used = 0.0        # when the last foreground job finished
+    self._reader = None
+    if not testing:
+      self._reader = threading.Thread(target=self._read_loop,
+                                      name='serial-reader')
+      self._reader.daemon = True
+      self._reader.start()
+    self._executor = threading.Thread(target=self._execute_loop,
+                                      name='serial-executor')
+    self._executor.daemon = True
+    self._executor.start()
+
+  def close(self):
+    """Stop the reader and executor threads and close the port."""
+    self._running = False
+    self._jobs.put((-1, -1, None))
+    self._executor.join(1.0)
+    if self._reader:
+      self._reader.join(1.0)
+    self.port.close()
+
+  def _read_loop(self):
+    """Frame incoming bytes into lines.  The port has a short read
+       timeout; a partial line left over when the port goes quiet is
+       treated as complete since the controller does not always
+       terminate its responses.
+       """
+    buf = ''
+    while self._running:
+      try:
+        data = self.port.read(self.port.in_waiting or 1)
+      except (IOError, OSError, ValueError) as e:
+        if self._running:
+          log.error('serial read failed: %s', e)
+          time.sleep(1)
+        continue
+      if not data:
+        if buf:
+          self._handle_line(buf)
+          buf = ''
+        continue
+      buf += data
+      while True:
+        cut = min([i for i in (buf.find('\r'), buf.find('\n')) if i >= 0] or [-1])
+        if cut < 0:
+          break
+        line, buf = buf[:cut], buf[cut+1:]
+        if line:
+          self._handle_line(line)
+
+  def _handle_line(self, line):
+    """Deliver a response to the waiting command, or to the listeners."""
+    with self._cond:
+      if self._waiting and line[0] in '+-':
+        self._response = line
+        self._waiting = False
+        self._cond.notify_all()
+        return
+      if self._late_until and line[0] in '+-':
+        log.info('late answer from arcom: %r', line)
+        self._late_until = 0.0
+        self._cond.notify_all()
+        return
+      if self._waiting:
+        self._lines.append(line)
+        if self._collecting:
+          return
+    log.debug('unsolicited from arcom: %r', line)
+    now = time.time()
+    for listener in self.listeners:
+      try:
+        listener(now, line)
+      except Exception:
+        log.exception('serial listener %s', listener)
+
+  def send(self, command, timeout=None, priority=OPERATOR, deadline=None,
+           target=None):
+    """Send one command and wait for the controller's answer.
+       Returns a (status, msg) tuple.  If the same command is already
+       queued at this priority and not yet started, wait for that one
+       instead; its msg is then marked (coalesced).  target names the
+       state the command sets, if any: then it is shared only if it is
+       the newest command queued for target.  deadline is the seconds
+       the command may wait to be sent, by default DEADLINES[priority].
+       """
+    key = ('target', target) if target else (priority, command)
+    with self._inflight_lock:
+      job = self._inflight.get(key)
+      shared = (job is not None and not job.started and
+                job.priority == priority and job.commands == [command])
+      if not shared:
+        job = Job([command], self.timeout if timeout is None else timeout,
+                  priority=priority, deadline=deadline)
+        job.key = key
+        self._inflight[key] = job
+        self._put(job)
+    self._wait(job)
+    status, msg = job.results[0]
+    if shared:
+      metrics.commands_saved.inc(('coalesced',))
+      msg += ' (coalesced)'
+    return status, msg
+
+  def pending(self, target):
+    """The command queued or being sent for target, the newest if more
+       than one, or None.
+       """
+    with self._inflight_lock:
+      job = self._inflight.get(('target', target))
+      return job.commands[0] if job is not None else None
+
+  def send_many(self, commands, timeout=None, priority=OPERATOR,
+                deadline=None):
+    """Send a sequence of commands in one session on the port.
+       Nothing else can get between the steps.  A command may be a
+       function returning it, called just before it is sent, for one
+       that must not go stale in the queue.  Stops at the first
+       failure; returns one (status, msg) tuple per step attempted, or
+       a single failure if the job passed its deadline unsent.
+       """
+    if timeout is None:
+      timeout = self.timeout
+    job = Job(commands, timeout, priority=priority, deadline=deadline)
+    self._put(job)
+    self._wait(job)
+    return job.results
+
+  def query(self, command, timeout=None, background=True):
+    """Send one command and return (status, text), where text is
+       everything the controller sent up to and including its + or -.
+       A background query gives way to any other job: it returns
+       (False, 'skipped: port busy') without being sent if something
+       else is queued when its turn comes.
+       """
+    if timeout is None:
+      timeout = self.timeout
+    job = Job([command], timeout, background=background, collect=True,
+              priority=BACKGROUND if background else OPERATOR)
+    self._put(job)
+    self._wait(job)
+    return job.results[0]
+
+  def stats(self):
+    """Queued jobs by priority class and how long the oldest of each
+       has been waiting, in seconds.
+       """
+    now = time.time()
+    with self._jobs.mutex:
+      jobs = [item[2] for item in self._jobs.queue if item[2] is not None]
+    depth = dict((name, 0) for name in PRIORITY_NAMES)
+    oldest = dict((name, 0.0) for name in PRIORITY_NAMES)
+    for job in jobs:
+      if job.cancelled or job.started:
+        continue
+      name = PRIORITY_NAMES[job.priority]
+      depth[name] += 1
+      oldest[name] = max(oldest[name], now - job.queued)
+    return {'depth': depth, 'oldest': oldest, 'busy': self._busy}
+
+  def _put(self, job):
+    metrics.serial_queue_depth.inc((PRIORITY_NAMES[job.priority],))
+    self._jobs.put((job.priority, next(self._seq), job))
+
+  def _wait(self, job):
+    """Wait for job, cancelling it if its deadline passes unstarted."""
+    if job.deadline is not None:
+      if job.done.wait(max(0.0, job.deadline - time.time())):
+        return
+      with self._inflight_lock:
+        if not job.started and not job.cancelled:
+          self._expire(job)
+    job.done.wait()
+
+  def _expire(self, job):
+    """Cancel a queued job.  Called with _inflight_lock held."""
+    name = PRIORITY_NAMES[job.priority]
+    job.cancelled = True
+    metrics.serial_queue_depth.inc((name,), -1)
+    metrics.serial_jobs_expired.inc((name,))
+    self._forget(job)
+    log.info('%s job %s expired after %.1fs in the queue', name,
+             job.commands, time.time() - job.queued)
+    job.results = [(False, 'expired: not sent within %.1f seconds' % (
+        job.deadline - job.queued))]
+    job.done.set()
+
+  def _forget(self, job):
+    """Stop offering a finished job to callers, unless a newer job has
+       taken its key.  Called with _inflight_lock held.
+       """
+    if job.key is not None and self._inflight.get(job.key) is job:
+      del self._inflight[job.key]
+
+  def idle_for(self):
+    """Seconds since the last foreground job, 0 while one is queued
+       or running.
+       """
+    if self._busy or not self._jobs.empty():
+      return 0.0
+    return time.time() - self.last_used
+
+  def _execute_loop(self):
+    """Run queued jobs.  This is the only thread that writes the port."""
+    while self._running:
+      _, _, job = self._jobs.get()
+      if job is None:
+        break
+      with self._inflight_lock:
+        if job.cancelled:
+          continue
+        if job.deadline is not None and time.time() > job.deadline:
+          self._expire(job)
+          continue
+        job.started = True
+      metrics.serial_queue_depth.inc((PRIORITY_NAMES[job.priority],), -1)
+      if job.background and not self._jobs.empty():
+        job.results.append((False, 'skipped: port busy'))
+        job.done.set()
+        continue
+      if not job.background:
+        self._busy = True
+        self.generation += 1
+      start = time.time()
+      metrics.serial_queue_wait_seconds.observe(
+          start - job.queued, (PRIORITY_NAMES[job.priority],))
+      if job.span:
+        tracing.add_span('serial queue', job.queued, start, parent=job.span)
+      try:
+        for command in job.commands:
+          if callable(command):
+            command = command()
+          with tracing.span('serial ' + command, parent=job.span):
+            status, msg = self._transact(command, job.timeout, job.collect)
+          job.results.append((status, msg))
+          if not status:
+            break
+      except (IOError, OSError, ValueError) as e:
+        log.error('serial write failed: %s', e)
+        job.results.append((False, 'serial error: %s' % e))
+      finally:
+        metrics.serial_job_seconds.since(start)
+        if not job.background:
+          self.last_used = time.time()
+          self._busy = False
+        with self._inflight_lock:
+          self._forget(job)
+        job.done.set()
+
+  def _transact(self, command, timeout, collect=False):
+    """Run one command/response exchange.  Executor thread only.
+       With collect, msg is the controller's answer text.
+       """
+    command = '1*' + command + '\r\n'
+    log.debug(' Sending: %r', command)
+    start = time.time()
+    if self.testing:
+      self.port.write(str(command))
+      self.port.flush()
+      metrics.serial_command_seconds.since(start, ('ok',))
+      return True, 'TESTING MODE'
+
+    with self._cond:
+      while time.time() < self._late_until:
+        self._cond.wait(self._late_until - time.time())
+      self._late_until = 0.0
+      self._response = None
+      self._lines = []
+      self._collecting = collect
+      self._waiting = True
+    self.port.write('\r' + str(command))
+    deadline = start + timeout
+    with self._cond:
+      while self._response is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._cond.wait(remaining)
+      response = self._response
+      lines = self._lines
+      self._waiting = False
+      if response is None:
+        self._late_until = time.time() + LATE_ANSWER_WAIT
+    log.debug('received from arcom: %r (%.3fs)', response, time.time() - start)
+
+    if response is None:
+      metrics.serial_command_seconds.since(start, ('timeout',))
+      return False, 'no response within %.1f seconds' % timeout
+    elif response.startswith('+'):
+      metrics.serial_command_seconds.since(start, ('ok',))
+      return True, '\n'.join(lines + [response]) if collect else 'succeeded'
+    metrics.serial_command_seconds.since(start, ('failed',))
+    if collect:
+      return False, '\n'.join(lines + [response])
+    return False, 'failed: %s' % command.strip()
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Tests for serial_engine.py: coalescing, priority classes, deadlines and
+background jobs, against a fake controller.
+
+Run it from the arcom-server directory:  python serial_engine_test.py
+"""
+import logging
+import Queue
+import threading
+import time
+import unittest
+import serial_engine
+
+
+class FakePort(object):
+  """Answers each command with answer after delay seconds and records
+     the commands in the order they were written.
+     """
+  def __init__(self, delay, answer='+'):
+    self.delay = delay
+    self.answer = answer
+    self.written = []
+    self.in_waiting = 0
+    self._answers = Queue.Queue()
+
+  def write(self, data):
+    self.written.append(data.strip()[2:])
+    threading.Timer(self.delay, self._answers.put,
+                    [self.answer + '\r\n']).start()
+
+  def read(self, _size):
+    try:
+      return self._answers.get(timeout=0.05)
+    except Queue.Empty:
+      return ''
+
+  def close(self):
+    pass
+
+
+class EngineTest(unittest.TestCase):
+  def setUp(self):
+    self.port = FakePort(0.2)
+    self.engine = serial_engine.SerialEngine(self.port, timeout=2.0)
+    self.results = {}
+    self.threads = []
+
+  def tearDown(self):
+    self.engine.close()
+
+  def start(self, label, func, *args, **kwargs):
+    """Call func on a thread of its own, keeping its result as label,
+       and give it time to queue its job.
+       """
+    def run():
+      self.results[label] = func(*args, **kwargs)
+    thread = threading.Thread(target=run)
+    thread.start()
+    self.threads.append(thread)
+    time.sleep(0.02)
+
+  def join(self):
+    for thread in self.threads:
+      thread.join()
+
+  def test_queued_command_is_shared(self):
+    self.start('busy', self.engine.send, 'BUSY')
+    self.start('first', self.engine.send, 'CMD')
+    self.start('second', self.engine.send, 'CMD')
+    self.join()
+    self.assertEqual(self.port.written, ['BUSY', 'CMD'])
+    self.assertEqual(self.results['second'], (True, 'succeeded (coalesced)'))
+
+  def test_started_command_is_not_shared(self):
+    self.start('first', self.engine.send, 'CMD')
+    self.start('second', self.engine.send, 'CMD')
+    self.join()
+    self.assertEqual(self.port.written, ['CMD', 'CMD'])
+    self.assertEqual(self.results['second'], (True, 'succeeded'))
+
+  def test_command_behind_opposite_is_not_shared(self):
+    self.start('busy', self.engine.send, 'BUSY')
+    self.start('off', self.engine.send, 'OFF', target='state')
+    self.start('on', self.engine.send, 'ON', target='state')
+    self.assertEqual(self.engine.pending('state'), 'ON')
+    self.start('off again', self.engine.send, 'OFF', target='state')
+    self.join()
+    self.assertEqual(self.port.written, ['BUSY', 'OFF', 'ON', 'OFF'])
+    self.assertEqual(self.results['off again'], (True, 'succeeded'))
+    self.assertEqual(self.engine.pending('state'), None)
+
+  def test_priority_order(self):
+    self.start('busy', self.engine.send, 'BUSY')
+    self.start('maintenance', self.engine.send, 'MAINTENANCE',
+               priority=serial_engine.MAINTENANCE)
+    self.start('operator', self.engine.send, 'OPERATOR')
+    self.start('safety', self.engine.send, 'SAFETY',
+               priority=serial_engine.SAFETY)
+    self.join()
+    self.assertEqual(self.port.written,
+                     ['BUSY', 'SAFETY', 'OPERATOR', 'MAINTENANCE'])
+
+  def test_deadline_expires_unsent(self):
+    self.start('busy', self.engine.send, 'BUSY')
+    status, msg = self.engine.send('LATE', deadline=0.05)
+    self.join()
+    self.assertFalse(status)
+    self.assertTrue(msg.startswith('expired'))
+    self.assertEqual(self.port.written, ['BUSY'])
+    self.assertEqual(self.engine.stats()['depth']['operator'], 0)
+
+  def test_background_gives_way(self):
+    self.start('busy', self.engine.send, 'BUSY')
+    self.start('first', self.engine.query, 'POLL1')
+    self.start('second', self.engine.query, 'POLL2')
+    self.join()
+    self.assertEqual(self.results['first'], (False, 'skipped: port busy'))
+    self.assertEqual(self.results['second'], (True, '+'))
+    self.assertEqual(self.port.written, ['BUSY', 'POLL2'])
+
+
+if __name__ == '__main__':
+  logging.getLogger('arcom').addHandler(logging.NullHandler())
+  unittest.main()
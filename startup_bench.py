@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""
+Cold start benchmark for arcom-server.
+
+Times how long the modules arcom-server uses take to import, each in a
+fresh interpreter, and then how long arcom-server.py --testing takes
+from exec until it completes a TLS handshake on its port, --runs times.
+--json writes the results so runs can be compared release to release.
+
+Run it from the arcom-server directory, with its config, arcom.passwd,
+key.pem and cert.pem, so the server starts as it would in service.
+"""
+import json
+import optparse
+import os
+import platform
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import time
+import web_server_bench
+
+MODULES = ('serial', 'configparser', 'requests', 'weblog_Google',
+           'web_server', 'history', 'serial_engine')
+IMPORT_TIMER = ('import time; start = time.time(); import %s; '
+                'print time.time() - start')
+READY_TIMEOUT = 30.0
+READY_CHECK = 0.01
+
+
+def import_seconds(module):
+  """Seconds to import module in a new interpreter, or None."""
+  try:
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_TIMER % module],
+                                  stderr=open(os.devnull, 'w'))
+  except subprocess.CalledProcessError:
+    return None
+  return float(out.strip())
+
+
+def ready(port):
+  """True once the server completes a TLS handshake on port."""
+  context = ssl._create_unverified_context()
+  try:
+    sock = socket.create_connection(('localhost', port), timeout=1)
+  except socket.error:
+    return False
+  try:
+    context.wrap_socket(sock).close()
+    return True
+  except (socket.error, ssl.SSLError):
+    return False
+  finally:
+    sock.close()
+
+
+def start_seconds(port):
+  """Seconds from starting arcom-server.py until it is ready."""
+  start = time.time()
+  server = subprocess.Popen(
+      [sys.executable, 'arcom-server.py', '--testing', '--port', str(port)],
+      stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+  try:
+    while not ready(port):
+      if server.poll() is not None:
+        raise RuntimeError('arcom-server.py exited with %d' % server.returncode)
+      if time.time() - start > READY_TIMEOUT:
+        raise RuntimeError('arcom-server.py not ready after %ds' % READY_TIMEOUT)
+      time.sleep(READY_CHECK)
+    return time.time() - start
+  finally:
+    server.send_signal(signal.SIGINT)
+    server.wait()
+
+
+def main():
+  p = optparse.OptionParser()
+  p.add_option('--runs', action='store', type='int', dest='runs',
+               help='server starts to time')
+  p.add_option('--port', action='store', type='int', dest='port')
+  p.add_option('--json', action='store', type='string', dest='json',
+               help='write the results to this file')
+  p.set_defaults(runs=5, port=3399, json=None)
+  opt, _ = p.parse_args()
+
+  results = {
+      'time': time.time(),
+      'python': platform.python_version(),
+      'imports': {},
+  }
+  for module in MODULES:
+    seconds = import_seconds(module)
+    results['imports'][module] = seconds
+    if seconds is None:
+      print '%-16s not importable' % module
+    else:
+      print '%-16s import %7.2fms' % (module, 1000 * seconds)
+
+  samples = [start_seconds(opt.port) for _ in range(opt.runs)]
+  results['start'] = web_server_bench.summary(samples)
+  web_server_bench.report('start', results['start'])
+
+  if opt.json:
+    with open(opt.json, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
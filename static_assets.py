@@ -0,0 +1,161 @@
+#!/usr/bin/python
+"""
+Static files for the arcom-server web UI.
+
+Only a whitelist of files is served, all from memory.  Each file is read
+once at startup along with a gzip copy, and responses carry an ETag and
+Last-Modified so browsers can revalidate with a 304 instead of a
+download.  The vendor/ copies of the CDN libraries have the version in
+their names and are cached by browsers for a year; when a vendor file is
+missing the request is redirected to the CDN instead.
+
+Run this file directly to download the vendor/ copies.
+"""
+import email.utils
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import StringIO
+import sys
+import urllib2
+
+log = logging.getLogger('arcom')
+
+STATIC_FILES = (
+    'index.html',
+    'arcom.css',
+    'favicon.ico',
+)
+
+# Local copy -> CDN original.
+VENDOR_FILES = {
+    'vendor/jquery-3.1.1.min.js':
+        'https://ajax.googleapis.com/ajax/libs/jquery/3.1.1/jquery.min.js',
+    'vendor/bootstrap-3.3.7.min.css':
+        'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css',
+    'vendor/bootstrap-3.3.7.min.js':
+        'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/js/bootstrap.min.js',
+    'vendor/bootbox-4.4.0.min.js':
+        'https://cdnjs.cloudflare.com/ajax/libs/bootbox.js/4.4.0/bootbox.min.js',
+    'vendor/jquery.cookie-1.4.1.min.js':
+        'https://cdnjs.cloudflare.com/ajax/libs/jquery-cookie/1.4.1/jquery.cookie.min.js',
+}
+
+INDEX = 'index.html'
+VERSIONED_MAX_AGE = 365 * 24 * 3600
+
+
+class Asset(object):
+  """One file held in memory with its gzip copy and validators."""
+  def __init__(self, name, data, mtime, versioned):
+    self.name = name
+    self.data = data
+    self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    self.etag = '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+    self.mtime = int(mtime)
+    self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+    if versioned:
+      self.cache_control = 'private, max-age=%d' % VERSIONED_MAX_AGE
+    else:
+      self.cache_control = 'private, no-cache'
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=mtime)
+    f.write(data)
+    f.close()
+    self.gzip_data = buf.getvalue()
+    if len(self.gzip_data) >= len(data):
+      self.gzip_data = None
+
+  def not_modified(self, headers):
+    """True if the request's conditional headers match this version."""
+    if_none_match = headers.getheader('If-None-Match')
+    if if_none_match:
+      tags = [tag.strip() for tag in if_none_match.split(',')]
+      return '*' in tags or self.etag in tags or self.etag[:-1] + '-gz"' in tags
+    if_modified_since = headers.getheader('If-Modified-Since')
+    if if_modified_since:
+      since = email.utils.parsedate_tz(if_modified_since)
+      if since:
+        return self.mtime <= email.utils.mktime_tz(since)
+    return False
+
+
+class StaticAssets(object):
+  """The whitelisted files, loaded into memory from root."""
+  def __init__(self, root='.'):
+    self.root = root
+    self.assets = {}
+    self.load()
+
+  def load(self):
+    """(Re)read all the whitelisted files that exist."""
+    assets = {}
+    for name in STATIC_FILES + tuple(VENDOR_FILES):
+      path = os.path.join(self.root, name)
+      try:
+        with open(path, 'rb') as f:
+          data = f.read()
+        mtime = os.path.getmtime(path)
+      except (IOError, OSError) as e:
+        log.debug('static file %s not loaded: %s', name, e)
+        continue
+      assets[name] = Asset(name, data, mtime, name in VENDOR_FILES)
+    self.assets = assets
+    log.info('Loaded %d static files', len(assets))
+
+  def serve(self, handler, head=False):
+    """Answer a GET (or HEAD) for handler.path."""
+    name = handler.path.split('?', 1)[0].lstrip('/') or INDEX
+    asset = self.assets.get(name)
+    if asset is None:
+      if name in VENDOR_FILES:
+        handler.send_response(302)
+        handler.send_header('Location', VENDOR_FILES[name])
+        handler.send_header('Content-length', '0')
+        handler.end_headers()
+      else:
+        handler.send_error(404, 'File not found')
+      return
+
+    if asset.not_modified(handler.headers):
+      handler.send_response(304)
+      handler.send_header('ETag', asset.etag)
+      handler.send_header('Cache-Control', asset.cache_control)
+      handler.end_headers()
+      return
+
+    data, etag = asset.data, asset.etag
+    accept = handler.headers.getheader('Accept-Encoding') or ''
+    gzipped = asset.gzip_data is not None and 'gzip' in accept
+    if gzipped:
+      data, etag = asset.gzip_data, asset.etag[:-1] + '-gz"'
+    handler.send_response(200)
+    handler.send_header('Content-type', asset.content_type)
+    handler.send_header('Content-length', str(len(data)))
+    if gzipped:
+      handler.send_header('Content-Encoding', 'gzip')
+    handler.send_header('Vary', 'Accept-Encoding')
+    handler.send_header('ETag', etag)
+    handler.send_header('Last-Modified', asset.last_modified)
+    handler.send_header('Cache-Control', asset.cache_control)
+    handler.end_headers()
+    if not head:
+      handler.wfile.write(data)
+
+
+def fetch_vendor_files(root='.'):
+  """Download the CDN libraries into root/vendor."""
+  for name, url in sorted(VENDOR_FILES.items()):
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    print 'fetching %s' % url
+    data = urllib2.urlopen(url, timeout=30).read()
+    with open(path, 'wb') as f:
+      f.write(data)
+
+
+if __name__ == '__main__':
+  fetch_vendor_files(sys.argv[1] if len(sys.argv) > 1 else '.')
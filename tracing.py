@@ -0,0 +1,177 @@
+"""
+Per-request tracing for arcom-server.
+
+The web server starts a trace for each HTTP request; code on the way
+down opens spans inside it with span() or the traced() decorator, so a
+slow request can be broken down into TLS handshake, authentication, lock
+waits, serial queueing and the controller's answers.  Finished traces
+are kept in a ring of the last RING_SIZE.
+
+Spans are thread local.  Work handed to another thread (the serial
+engine's executor) carries its parent span along explicitly.  When no
+trace is active span() is a shared no-op, so instrumented code costs
+next to nothing outside a request.
+"""
+import collections
+import functools
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger('arcom')
+
+RING_SIZE = 2000
+
+_local = threading.local()
+_ring = collections.deque(maxlen=RING_SIZE)
+_ring_lock = threading.Lock()
+
+
+class Span(object):
+  """A named interval with child spans."""
+  __slots__ = ('name', 'start', 'end', 'attrs', 'children')
+
+  def __init__(self, name, start=None, attrs=None):
+    self.name = name
+    self.start = time.time() if start is None else start
+    self.end = None
+    self.attrs = attrs or {}
+    self.children = []
+
+  def to_dict(self, origin=None):
+    """Times in milliseconds relative to the root span's start."""
+    if origin is None:
+      origin = self.start
+    end = self.end if self.end is not None else time.time()
+    span = {'name': self.name,
+            'at': round(1000 * (self.start - origin), 3),
+            'ms': round(1000 * (end - self.start), 3)}
+    if self.attrs:
+      span['attrs'] = self.attrs
+    if self.children:
+      span['children'] = [child.to_dict(origin) for child in self.children]
+    return span
+
+
+class _NoSpan(object):
+  def __enter__(self):
+    return None
+
+  def __exit__(self, *args):
+    pass
+
+_no_span = _NoSpan()
+
+
+class _SpanContext(object):
+  def __init__(self, parent, name, attrs):
+    self.parent = parent
+    self.span = Span(name, attrs=attrs)
+
+  def __enter__(self):
+    self.parent.children.append(self.span)
+    self.previous = getattr(_local, 'span', None)
+    _local.span = self.span
+    return self.span
+
+  def __exit__(self, *args):
+    self.span.end = time.time()
+    _local.span = self.previous
+
+
+def current():
+  """The innermost open span on this thread, or None."""
+  return getattr(_local, 'span', None)
+
+
+def span(name, parent=None, **attrs):
+  """Context manager for a child span of parent (default: the current
+     span).  Does nothing when there is no parent.
+     """
+  if parent is None:
+    parent = getattr(_local, 'span', None)
+    if parent is None:
+      return _no_span
+  return _SpanContext(parent, name, attrs)
+
+
+def add_span(name, start, end, parent=None, **attrs):
+  """Record an interval that has already happened."""
+  if parent is None:
+    parent = getattr(_local, 'span', None)
+    if parent is None:
+      return
+  child = Span(name, start, attrs)
+  child.end = end
+  parent.children.append(child)
+
+
+def traced(name):
+  """Decorator running the function in a span."""
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if getattr(_local, 'span', None) is None:
+        return func(*args, **kwargs)
+      with span(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def carry(name, start, end):
+  """Hold an interval for the next trace started on this thread, such
+     as a connection's TLS handshake before its first request.
+     """
+  _local.carried = (name, start, end)
+
+
+def start(name, **attrs):
+  """Start a trace on this thread, replacing any unfinished one."""
+  carried = getattr(_local, 'carried', None)
+  root = Span(name, start=carried[1] if carried else None, attrs=attrs)
+  if carried:
+    add_span(carried[0], carried[1], carried[2], parent=root)
+    _local.carried = None
+  _local.span = root
+  _local.root = root
+  return root
+
+
+def finish(**attrs):
+  """Finish this thread's trace and keep it in the ring."""
+  root = getattr(_local, 'root', None)
+  if root is None:
+    return
+  root.end = time.time()
+  root.attrs.update(attrs)
+  _local.span = _local.root = None
+  with _ring_lock:
+    _ring.append(root)
+
+
+def traces(limit=100, min_ms=0):
+  """Finished traces as dicts, newest first, optionally only those that
+     took at least min_ms milliseconds.
+     """
+  with _ring_lock:
+    roots = list(_ring)
+  result = []
+  for root in reversed(roots):
+    if 1000 * (root.end - root.start) >= min_ms:
+      trace = root.to_dict()
+      trace['time'] = root.start
+      result.append(trace)
+      if len(result) >= limit:
+        break
+  return result
+
+
+def dump(path):
+  """Write every trace in the ring to path, one JSON object per line."""
+  entries = traces(RING_SIZE)
+  with open(path, 'w') as f:
+    for trace in reversed(entries):
+      f.write(json.dumps(trace) + '\n')
+  log.info('Dumped %d traces to %s', len(entries), path)
@@ -2,81 +2,385 @@
 Web server function of arcom-server
 """
 import base64
+import collections
+import csv
 import hashlib
+import inspect
+import io
+import json
 import logging
+import os
+import select
+import socket
 import ssl
+import threading
+import time
+import metrics
+import passwords
+import static_assets
+import tracing
 
 try:                 # Python 3
   from http.server import (SimpleHTTPRequestHandler)
-  from socketserver import ThreadingMixIn
+  import queue as Queue
+  from urllib.parse import parse_qs, urlparse
   from xmlrpc.server import (SimpleXMLRPCServer,
                              SimpleXMLRPCRequestHandler)
 except ImportError:  # Python 2
   from SimpleHTTPServer import SimpleHTTPRequestHandler
-  from SocketServer import ThreadingMixIn
+  import Queue
+  from urlparse import parse_qs, urlparse
   from SimpleXMLRPCServer import (SimpleXMLRPCServer,
                                   SimpleXMLRPCRequestHandler)
 
 log = logging.getLogger('arcom')
 PASSWD_FILE = 'arcom.passwd'
+CACHE_SIZE = 64       # verified Authorization headers to remember
+CACHE_TTL = 300       # seconds a verified header stays valid
+RELOAD_CHECK = 1.0    # seconds between checks of PASSWD_FILE's mtime
+IDLE_TIMEOUT = 30     # seconds a kept-alive connection may sit idle
+IDLE_CHECK = 0.2      # seconds between an idle connection's checks for reclaim
+CLOSE_TIMEOUT = 0.2   # seconds to wait for the client's TLS close_notify
+MAX_WORKERS = 16      # threads handling connections
+MAX_QUEUED = 16       # accepted connections waiting for a worker
+MAX_WAITERS = MAX_WORKERS // 2  # concurrent /status and /events long-polls
+JSONRPC_PATH = '/jsonrpc'
+METRICS_PATH = '/metrics'
+EXPORT_PATH = '/export'
+UNKNOWN_METHOD = 'unknown'  # rpc_seconds label for a name not registered
+EXPORT_FIELDS = ('date', 'time', 'call', 'action', 'entry')
+EXPORT_TYPES = {'csv': 'text/csv; charset=utf-8',
+                'jsonl': 'application/x-ndjson'}
+EXPORT_CHUNK = 16384  # bytes of rows per chunk sent
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+STATUS_WAIT = 25      # default seconds a /status long-poll waits
+STATUS_WAIT_MAX = 60
 
 
 class BasicAuthorizor(object):
-  """Implement validation for basic auth with cache."""
+  """Implement validation for basic auth with cache.
+     Verified Authorization headers are cached for CACHE_TTL seconds so
+     repeat requests skip the (deliberately slow) hash; past CACHE_SIZE
+     the least recently used is dropped.  The password file is re-read
+     when its mtime changes, which also empties the cache.
+     """
   def __init__(self):
     """Read in authorized hashs and store in memory."""
     self.valid_users = {}
+    self.mtime = None
+    self.checked = 0
+    self.cache = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.load()
+
+  def load(self):
+    """(Re)read PASSWD_FILE."""
+    valid_users = {}
     try:
-      for line in open(PASSWD_FILE, "r"):
-        user, password_hash = line.strip().split(':')
-        self.valid_users[user] = password_hash
-    except IOError, e:
+      mtime = os.stat(PASSWD_FILE).st_mtime
+      for number, line in enumerate(open(PASSWD_FILE, "r"), 1):
+        if line.strip():
+          user, sep, password_hash = line.strip().partition(':')
+          if not sep:
+            log.warning('%s line %d: not user:hash', PASSWD_FILE, number)
+            continue
+          valid_users[user] = password_hash
+    except (IOError, OSError), e:
       log.error('error processing %s: %s', PASSWD_FILE, e)
-    
+      return
+    with self.lock:
+      self.valid_users = valid_users
+      self.mtime = mtime
+      self.cache.clear()
+    log.info('Loaded %d users from %s', len(valid_users), PASSWD_FILE)
+
+  def check_reload(self):
+    """Reload PASSWD_FILE if it changed, checking at most once a second."""
+    now = time.time()
+    if now - self.checked < RELOAD_CHECK:
+      return
+    self.checked = now
+    try:
+      mtime = os.stat(PASSWD_FILE).st_mtime
+    except OSError:
+      return
+    if mtime != self.mtime:
+      self.load()
+
+  def credentials(self, string):
+    """The (user, password) from a Basic Authorization header, or None
+       if it is not a well formed one.
+       """
+    try:
+      authtype, value = string.split(' ', 1)
+      user, password = base64.b64decode(value).split(':', 1)
+    except (AttributeError, TypeError, ValueError):
+      return None
+    if authtype != 'Basic':
+      return None
+    return user, password
+
+  def user(self, string):
+    """Return the user name from a Basic Authorization header."""
+    credentials = self.credentials(string)
+    return credentials[0] if credentials else None
+
+  @tracing.traced('valid_auth')
   def valid_auth(self, string):
     """Validate that user:hash is a valid credential."""
-    authtype, value = string.split(' ')
-    log.debug('Authenticating %s and "%s"', authtype, value)
-    if authtype == 'Basic':
-      value = base64.b64decode(value)
-      user, password = value.split(':')
-      password_hash = hashlib.sha224('arcom'+user+password).hexdigest()
-      #log.debug('Authenticating %s with %s (%s)', user, password, hash1)
-      if user in self.valid_users and self.valid_users[user] == password_hash:
-        log.info('Login succeeded for %s', user)
+    self.check_reload()
+    key = hashlib.sha256(string).digest()
+    now = time.time()
+    with self.lock:
+      expires = self.cache.pop(key, None)
+      if expires is not None and expires > now:
+        self.cache[key] = expires       # now the most recently used
         return True
+      valid_users = self.valid_users
+    credentials = self.credentials(string)
+    if credentials is None:
+      log.debug('Malformed Authorization header')
+      return False
+    user, password = credentials
+    if user in valid_users and passwords.check_password(
+        user, password, valid_users[user]):
+      log.info('Login succeeded for %s', user)
+      with self.lock:
+        if valid_users is self.valid_users:
+          self.cache[key] = now + CACHE_TTL
+          while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+      return True
     return False
 
 
 authorizor = BasicAuthorizor()
 
 
-class ArcomWebServer(ThreadingMixIn, SimpleXMLRPCServer):
-  """Basic XMLRPC and GET server class with localhost only access."""
+class PooledMixIn:
+  """Handle connections on a fixed pool of worker threads instead of a
+     thread per connection.  When every worker is busy, accepted
+     connections wait in a short queue; once that is full the accept
+     loop blocks and new connections wait in the listen backlog.
+
+     A kept-alive connection waiting for its next request still holds
+     its worker, so when a new connection would have to wait, the
+     connections idle longest are reclaimed: their workers close them
+     within IDLE_CHECK seconds and take the new one.  A connection that
+     goes idle while others wait is closed straight away.
+     """
+  max_workers = MAX_WORKERS
+  max_queued = MAX_QUEUED
+
+  def start_workers(self):
+    self.requests = Queue.Queue(self.max_queued)
+    self.pool_lock = threading.Lock()
+    self.free_workers = self.max_workers
+    self.queued = 0
+    self.idle = collections.OrderedDict()   # socket -> when it went idle
+    self.reclaimed = set()                  # idle sockets to be closed
+    for i in range(self.max_workers):
+      worker = threading.Thread(target=self.worker, name='http-%d' % i)
+      worker.daemon = True
+      worker.start()
+
+  def process_request(self, request, client_address):
+    with self.pool_lock:
+      self.queued += 1
+      needed = self.queued - self.free_workers
+      for connection in list(self.idle)[:max(0, needed)]:
+        del self.idle[connection]
+        self.reclaimed.add(connection)
+    self.requests.put((request, client_address))
+
+  def start_idle(self, connection):
+    """Note that connection is waiting for its next request.  Returns
+       False, and the connection should be closed, if other connections
+       are waiting for a worker.
+       """
+    with self.pool_lock:
+      if self.queued > self.free_workers:
+        return False
+      self.idle[connection] = time.time()
+      return True
+
+  def is_reclaimed(self, connection):
+    """True if an idle connection should close to free its worker."""
+    with self.pool_lock:
+      return connection in self.reclaimed
+
+  def end_idle(self, connection):
+    with self.pool_lock:
+      self.idle.pop(connection, None)
+      self.reclaimed.discard(connection)
+
+  def worker(self):
+    while True:
+      request, client_address = self.requests.get()
+      with self.pool_lock:
+        self.queued -= 1
+        self.free_workers -= 1
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+        with self.pool_lock:
+          self.free_workers += 1
+
+
+class ArcomWebServer(PooledMixIn, SimpleXMLRPCServer):
+  """Basic XMLRPC and GET server class with localhost only access.
+     Connections are accepted unencrypted and the TLS handshake is done
+     by the worker thread so a slow client can't hold up the accept loop.
+     """
+  ssl_context = None
+
+  def server_activate(self):
+    self.waiters = 0
+    self.waiters_lock = threading.Lock()
+    self.start_workers()
+    SimpleXMLRPCServer.server_activate(self)
+
   def verify_request(self, request, client_address):
     host, port = client_address
-    log.info('connection from %s:%s', host, port)
+    log.debug('connection from %s:%s', host, port)
     return SimpleXMLRPCServer.verify_request(self, request, client_address)
 
+  def finish_request(self, request, client_address):
+    request.settimeout(IDLE_TIMEOUT)
+    # Responses go out as a header write then a body write; don't let
+    # Nagle hold the body for the client's delayed ACK.
+    request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if self.ssl_context:
+      start = time.time()
+      try:
+        request = self.ssl_context.wrap_socket(request, server_side=True)
+      except (ssl.SSLError, socket.error) as e:
+        log.debug('TLS handshake with %s failed: %s', client_address[0], e)
+        return
+      tracing.carry('tls handshake', start, time.time())
+    SimpleXMLRPCServer.finish_request(self, request, client_address)
+
+  def _dispatch(self, method, params):
+    # The method name comes from the client, so only registered names
+    # become labels; anything else would add a series per name tried.
+    label = method if method in self.funcs else UNKNOWN_METHOD
+    start = time.time()
+    try:
+      with tracing.span('rpc ' + label):
+        response = SimpleXMLRPCServer._dispatch(self, method, params)
+    except Exception:
+      metrics.rpc_seconds.since(start, (label, 'error'))
+      raise
+    metrics.rpc_seconds.since(start, (label, 'ok'))
+    return response
+
 
 class ArcomAuthorizingRequestHandler(SimpleHTTPRequestHandler,
                                      SimpleXMLRPCRequestHandler):
   """Add functionality to basic XMLRPC handler.
      We need to add authentication and handling of GETs.
+     Connections are kept alive (HTTP/1.1) until idle for IDLE_TIMEOUT.
      """
   rpc_paths = ('/RPC2')
+  protocol_version = 'HTTP/1.1'
+  timeout = IDLE_TIMEOUT
+  kept_alive = False
+
+  def handle_one_request(self):
+    """Treat a client dropping a kept-alive connection as a close.
+       While waiting for a request after the first the connection is
+       idle, and the server may shut it down to free this worker for
+       another client.
+       """
+    self.response_code = None
+    if self.kept_alive and not self.wait_for_request():
+      self.close_idle()
+      return
+    self.kept_alive = True
+    try:
+      SimpleXMLRPCRequestHandler.handle_one_request(self)
+    except (ssl.SSLError, socket.error) as e:
+      log.debug('connection from %s closed: %s', self.client_address[0], e)
+      self.close_connection = 1
+    finally:
+      tracing.finish(code=self.response_code)
+
+  def wait_for_request(self):
+    """Wait for the next request on a kept-alive connection.  Returns
+       False after IDLE_TIMEOUT, or as soon as the server reclaims the
+       worker for a waiting client.
+       """
+    connection = self.connection
+    if self.rfile._rbuf.tell() or (
+        isinstance(connection, ssl.SSLSocket) and connection.pending()):
+      return True               # already read
+    if not self.server.start_idle(connection):
+      return False
+    try:
+      deadline = time.time() + IDLE_TIMEOUT
+      while True:
+        remaining = deadline - time.time()
+        if remaining <= 0 or self.server.is_reclaimed(connection):
+          return False
+        readable, _, _ = select.select([connection], [], [],
+                                       min(IDLE_CHECK, remaining))
+        if readable:
+          return True
+    finally:
+      self.server.end_idle(connection)
+
+  def close_idle(self):
+    """Close an idle connection.  A TLS connection gets a close_notify
+       first, so the client sees a clean close and retries its next
+       request on a new connection.
+       """
+    self.close_connection = 1
+    if isinstance(self.connection, ssl.SSLSocket):
+      try:
+        self.connection.settimeout(CLOSE_TIMEOUT)
+        self.connection.unwrap()
+      except (ssl.SSLError, socket.error):
+        pass
 
-  def __init__(self, *args, **kwargs):
-    SimpleXMLRPCRequestHandler.__init__(self, *args, **kwargs)
-    self.HTTPRequestHandler = SimpleHTTPRequestHandler.__init__(self, *args, **kwargs)
+  def parse_request(self):
+    """Start a trace once the request line and headers are in."""
+    if not SimpleXMLRPCRequestHandler.parse_request(self):
+      return False
+    tracing.start('%s %s' % (self.command, urlparse(self.path).path),
+                  client=self.client_address[0])
+    return True
 
-  def do_AUTHHEAD(self):
-    """Send authentication failure response."""
+  def log_request(self, code='-', size='-'):
+    self.response_code = code
+    metrics.http_responses.inc((str(code),))
+    SimpleXMLRPCRequestHandler.log_request(self, code, size)
+
+  def log_message(self, format, *args):
+    """Access and error lines go to our log rather than stderr."""
+    log.debug('%s %s', self.client_address[0], format % args)
+
+  def do_AUTHHEAD(self, body=''):
+    """Send authentication failure response.
+       The connection is closed since a rejected POST body is unread.
+       """
     log.debug('do AUTHHEAD')
     self.send_response(401)
     self.send_header('WWW-Authenticate', 'Basic realm=\"Arcom\"')
     self.send_header('Content-type', 'text/html')
+    self.send_header('Content-length', str(len(body)))
+    self.send_header('Connection', 'close')
     self.end_headers()
+    self.wfile.write(body)
+    self.close_connection = 1
 
   def do_GET(self):
     """Add authentication to the XMLRPC handlers."""
@@ -84,15 +388,227 @@ class ArcomAuthorizingRequestHandler(SimpleHTTPRequestHandler,
     #print '  headers: %s' % self.headers
     if self.headers.getheader('Authorization') is None:
       log.debug('do_GET: No auth received')
-      self.do_AUTHHEAD()
-      self.wfile.write('No auth received')
+      metrics.auth_failures.inc(('missing',))
+      self.do_AUTHHEAD('No auth received')
     elif authorizor.valid_auth(self.headers.getheader('Authorization')):
-      SimpleHTTPRequestHandler.do_GET(self)
+      path = urlparse(self.path).path
+      if path == '/status':
+        self.do_status()
+      elif path == '/events':
+        self.do_events()
+      elif path == METRICS_PATH:
+        self.do_metrics()
+      elif path == EXPORT_PATH:
+        self.do_export()
+      else:
+        self.server.assets.serve(self)
     else:
       log.info('do_GET: invalid auth')
+      metrics.auth_failures.inc(('invalid',))
+      self.do_AUTHHEAD('Not authenticated: ' +
+                       self.headers.getheader('Authorization'))
+
+  def do_HEAD(self):
+    """Static file headers, authenticated like GET."""
+    auth = self.headers.getheader('Authorization')
+    if auth is None or not authorizor.valid_auth(auth):
+      metrics.auth_failures.inc(('missing' if auth is None else 'invalid',))
       self.do_AUTHHEAD()
-      self.wfile.write('Not authenticated: ')
-      self.wfile.write(self.headers.getheader('Authorization'))
+    else:
+      self.server.assets.serve(self, head=True)
+
+  def do_status(self):
+    """Long-poll for status changes.
+       GET /status?since=N[&timeout=secs][&call=CALL][&controller=NAME]
+       returns JSON with the current version, status and changed keys as
+       soon as the version is newer than N, or after the timeout.
+       """
+    self.long_poll(self.server.arcom.waitStatus)
+
+  def do_events(self):
+    """Long-poll for unsolicited controller output.
+       GET /events?since=N[&timeout=secs][&call=CALL][&controller=NAME]
+       returns JSON with the events numbered after N, the seq to pass
+       next time and how many were missed, as soon as there are any or
+       after the timeout.
+       """
+    self.long_poll(self.server.arcom.waitEvents)
+
+  def long_poll(self, wait):
+    """Answer with JSON from wait(call, since, timeout[, controller]),
+       which blocks, taken from the query string.  Only MAX_WAITERS may
+       wait at once.
+       """
+    query = parse_qs(urlparse(self.path).query)
+    try:
+      since = int(query.get('since', ['0'])[0])
+      timeout = min(float(query.get('timeout', [STATUS_WAIT])[0]),
+                    STATUS_WAIT_MAX)
+    except ValueError:
+      self.send_error(400, 'Bad since or timeout')
+      return
+    call = query.get('call', [None])[0] or authorizor.user(
+        self.headers.getheader('Authorization'))
+    server = self.server
+    with server.waiters_lock:
+      busy = server.waiters >= MAX_WAITERS
+      if not busy:
+        server.waiters += 1
+    if busy:
+      # Every waiter holds a worker; leave the rest for other requests.
+      self.send_response(503)
+      self.send_header('Retry-After', '5')
+      self.send_header('Content-length', '0')
+      self.end_headers()
+      return
+    try:
+      args = (call, since, timeout)
+      if 'controller' in query:
+        args += (query['controller'][0],)
+      body = json.dumps(wait(*args))
+    except KeyError:
+      body = None
+    finally:
+      with server.waiters_lock:
+        server.waiters -= 1
+    if body is None:
+      self.send_error(404, 'Unknown controller')
+      return
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.send_header('Content-length', str(len(body)))
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_metrics(self):
+    """Counters and histograms in the Prometheus text format."""
+    body = metrics.render()
+    self.send_response(200)
+    self.send_header('Content-type', 'text/plain; version=0.0.4')
+    self.send_header('Content-length', str(len(body)))
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_export(self):
+    """Stream the history as CSV or JSON lines, oldest first.
+       GET /export?format=csv|jsonl[&call=CALL][&action=ACTION]
+       [&start=DATE][&end=DATE][&controller=NAME] where a DATE is a
+       local YYYY-MM-DD or seconds since the epoch, and end is not
+       included.  Rows are sent with chunked encoding as they are read
+       from the history index.
+       """
+    query = parse_qs(urlparse(self.path).query)
+    def param(name):
+      return query.get(name, [''])[0]
+    fmt = param('format') or 'csv'
+    if fmt not in EXPORT_TYPES:
+      self.send_error(400, 'Bad format')
+      return
+    try:
+      start, end = export_time(param('start')), export_time(param('end'))
+    except ValueError:
+      self.send_error(400, 'Bad start or end')
+      return
+    args = (authorizor.user(self.headers.getheader('Authorization')),
+            param('call'), param('action'), start, end)
+    if 'controller' in query:
+      args += (param('controller'),)
+    try:
+      rows = self.server.arcom.exportLog(*args)
+    except KeyError:
+      self.send_error(404, 'Unknown controller')
+      return
+    chunked = self.request_version == 'HTTP/1.1'
+    self.send_response(200)
+    self.send_header('Content-type', EXPORT_TYPES[fmt])
+    self.send_header('Content-Disposition',
+                     'attachment; filename="arcom-history.%s"' % fmt)
+    if chunked:
+      self.send_header('Transfer-Encoding', 'chunked')
+    else:
+      self.close_connection = 1
+    self.end_headers()
+    try:
+      for data in export_chunks(rows, fmt):
+        if chunked:
+          data = '%x\r\n%s\r\n' % (len(data), data)
+        self.wfile.write(data)
+      if chunked:
+        self.wfile.write('0\r\n\r\n')
+    except socket.error as e:
+      log.debug('export to %s stopped: %s', self.client_address[0], e)
+      self.close_connection = 1
+
+  def jsonrpc_call(self, request):
+    """Run one JSON-RPC 2.0 request object and return its response
+       object, or None for a notification.
+       """
+    if (not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or
+        not isinstance(request.get('method'), basestring)):
+      return {'jsonrpc': '2.0', 'id': None,
+              'error': {'code': INVALID_REQUEST, 'message': 'Invalid Request'}}
+    req_id = request.get('id')
+    method = request['method']
+    params = request.get('params', [])
+    func = self.server.funcs.get(method)
+    if func is None:
+      error = {'code': METHOD_NOT_FOUND, 'message': 'Method not found: %s' % method}
+    elif not isinstance(params, (list, dict)):
+      error = {'code': INVALID_PARAMS, 'message': 'Invalid params'}
+    else:
+      start = time.time()
+      error = check_params(func, params)
+      if error:
+        error = {'code': INVALID_PARAMS, 'message': error}
+      else:
+        try:
+          with tracing.span('rpc ' + method):
+            if isinstance(params, dict):
+              result = func(**dict((str(k), v) for k, v in params.items()))
+            else:
+              result = func(*params)
+        except Exception as e:
+          log.exception('jsonrpc %s failed', method)
+          error = {'code': INTERNAL_ERROR,
+                   'message': '%s: %s' % (type(e).__name__, e)}
+      metrics.rpc_seconds.since(start, (method, 'error' if error else 'ok'))
+    if 'id' not in request:
+      return None
+    if error:
+      return {'jsonrpc': '2.0', 'id': req_id, 'error': error}
+    return {'jsonrpc': '2.0', 'id': req_id, 'result': result}
+
+  def do_jsonrpc(self):
+    """JSON-RPC 2.0 over the same functions as /RPC2.  A batch (array)
+       of requests is answered with an array of responses in one round
+       trip.
+       """
+    length = int(self.headers.getheader('content-length', 0))
+    try:
+      request = json.loads(self.rfile.read(length))
+    except ValueError:
+      response = {'jsonrpc': '2.0', 'id': None,
+                  'error': {'code': PARSE_ERROR, 'message': 'Parse error'}}
+    else:
+      if isinstance(request, list) and request:
+        response = [r for r in map(self.jsonrpc_call, request) if r is not None]
+      elif isinstance(request, list):
+        response = self.jsonrpc_call(None)
+      else:
+        response = self.jsonrpc_call(request)
+    if not response:
+      self.send_response(204)
+      self.send_header('Content-length', '0')
+      self.end_headers()
+      return
+    body = json.dumps(response)
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.send_header('Content-length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
 
   def do_POST(self):
     """Add authentication to the XMLRPC handlers."""
@@ -101,25 +617,123 @@ class ArcomAuthorizingRequestHandler(SimpleHTTPRequestHandler,
     #print '  headers: %s' % self.headers
     if self.headers.getheader('Authorization') is None:
       log.debug('do_POST: No auth received')
-      self.do_AUTHHEAD()
-      self.wfile.write('No auth received')
+      metrics.auth_failures.inc(('missing',))
+      self.do_AUTHHEAD('No auth received')
     elif authorizor.valid_auth(self.headers.getheader('Authorization')):
-      SimpleXMLRPCRequestHandler.do_POST(self)
+      if self.path == JSONRPC_PATH:
+        self.do_jsonrpc()
+      else:
+        SimpleXMLRPCRequestHandler.do_POST(self)
     else:
       log.info('do_POST: invalid auth')
-      self.do_AUTHHEAD()
-      self.wfile.write('Not authenticated: ')
-      self.wfile.write(self.headers.getheader('Authorization'))
+      metrics.auth_failures.inc(('invalid',))
+      self.do_AUTHHEAD('Not authenticated: ' +
+                       self.headers.getheader('Authorization'))
 
 
-def run_server(arcom, opt):
-  """Creat and run the core XMLRPC webserver."""
+def check_params(func, params):
+  """Why func cannot be called with params, a list of positional or a
+     dict of named arguments, or None if it can.  Checked before the
+     call, so a TypeError raised inside func is not mistaken for bad
+     params.
+     """
+  try:
+    args, varargs, keywords, defaults = inspect.getargspec(func)
+  except TypeError:             # not a Python function; let the call decide
+    return None
+  if inspect.ismethod(func) and func.__self__ is not None:
+    args = args[1:]
+  required = args[:len(args) - len(defaults or ())]
+  if isinstance(params, dict):
+    unknown = sorted(key for key in params if key not in args)
+    if unknown and not keywords:
+      return 'unexpected params: %s' % ', '.join(unknown)
+    missing = [arg for arg in required if arg not in params]
+    if missing:
+      return 'missing params: %s' % ', '.join(missing)
+  elif len(params) < len(required) or (len(params) > len(args) and not varargs):
+    if len(required) == len(args):
+      return 'takes %d params, %d given' % (len(args), len(params))
+    return 'takes %d to %d params, %d given' % (
+        len(required), len(args), len(params))
+  return None
+
+
+def export_time(value):
+  """Seconds since the epoch from seconds or a local YYYY-MM-DD date;
+     0 (no limit) for an empty string.
+     """
+  if not value:
+    return 0
+  try:
+    return float(value)
+  except ValueError:
+    return time.mktime(time.strptime(value, '%Y-%m-%d'))
+
+
+def _utf8(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def export_chunks(rows, fmt):
+  """Encode (time, call, action, string) rows as csv or jsonl in
+     pieces of about EXPORT_CHUNK bytes.
+     """
+  buf = io.BytesIO()
+  if fmt == 'csv':
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    def write(row):
+      writer.writerow([_utf8(value) for value in row])
+  else:
+    def write(row):
+      buf.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n')
+  for seconds, call, action, string in rows:
+    date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
+    write((date, seconds, call, action, string))
+    if buf.tell() >= EXPORT_CHUNK:
+      yield buf.getvalue()
+      buf.seek(0)
+      buf.truncate()
+  if buf.tell():
+    yield buf.getvalue()
+
+
+def ssl_context():
+  """Server TLS context.  OpenSSL's server session cache and session
+     tickets are on by default, so returning clients can resume instead
+     of doing a full handshake.
+     """
+  context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+  context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+  context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
+  return context
+
+
+def make_server(arcom, opt):
+  """Create the core XMLRPC webserver."""
   server = ArcomWebServer(('', opt.port), ArcomAuthorizingRequestHandler, allow_none=True)
-  server.socket = ssl.wrap_socket(
-      server.socket,
-      keyfile="key.pem",
-      certfile='cert.pem',
-      server_side=True)
+  server.ssl_context = ssl_context()
+  server.assets = static_assets.StaticAssets()
+  server.arcom = arcom
   server.register_introspection_functions()
+  server.register_multicall_functions()
   arcom.register_functions(server)
-  server.serve_forever()
+  return server
+
+
+def reload(server):
+  """Re-read the password file, static files and TLS certificate."""
+  authorizor.load()
+  server.assets.load()
+  try:
+    server.ssl_context = ssl_context()
+  except (IOError, ssl.SSLError) as e:
+    log.error('TLS certificate not reloaded: %s', e)
+
+
+def run_server(arcom, opt):
+  """Create and run the core XMLRPC webserver."""
+  make_server(arcom, opt).serve_forever()
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+"""
+Latency and load benchmark for the web server function of arcom-server.
+
+Starts web_server with the ArcomDummy backend from web_server_test.py
+on a localhost port.  It first times XMLRPC status calls over TLS with a
+new connection (TCP + full TLS handshake) for every call and then over
+one kept-alive connection.  It then runs a load test: --clients threads,
+each with its own kept-alive connection, make --count calls drawn from
+the --mix of status, getLog and port1Disable/port1Enable.  Throughput
+and p50/p95/p99 latency are printed, and --json writes them to a file
+so runs can be compared release to release.
+
+With --engine the dummy's port 1 commands go through a SerialEngine (in
+testing mode, writing to /dev/null) so the executor queue is part of
+what is measured.  Run it from the arcom-server directory so key.pem and
+cert.pem are found.
+"""
+import httplib
+import json
+import logging
+import optparse
+import os
+import platform
+import random
+import socket
+import ssl
+import threading
+import time
+import xmlrpclib
+import passwords
+import serial_engine
+import web_server
+import web_server_test
+
+BENCH_USER = 'BENCH'
+BENCH_PASSWORD = 'bench'
+DEFAULT_MIX = 'status=70,getLog=20,port1=10'
+
+
+class QuietHandler(web_server.ArcomAuthorizingRequestHandler):
+  def log_message(self, *args):
+    pass
+
+
+class EngineDummy(web_server_test.ArcomDummy):
+  """ArcomDummy whose port 1 commands are sent through a SerialEngine."""
+  def __init__(self):
+    web_server_test.ArcomDummy.__init__(self)
+    self.engine = serial_engine.SerialEngine(open(os.devnull, 'w'),
+                                             testing=True)
+
+  def port1Disable(self, auth, interval=0):
+    status, msg = self.engine.send('1000')
+    if status:
+      web_server_test.ArcomDummy.port1Disable(self, auth, interval)
+    return status, msg
+
+  def port1Enable(self, auth, fromTimer=False):
+    status, msg = self.engine.send('1001')
+    if status:
+      web_server_test.ArcomDummy.port1Enable(self, auth, fromTimer)
+    return status, msg
+
+
+def start_server(arcom):
+  """Start the server for arcom on a free port and return the port."""
+  opt = optparse.Values({'port': 0})
+  server = web_server.make_server(arcom, opt)
+  server.RequestHandlerClass = QuietHandler
+  web_server.authorizor.valid_users[BENCH_USER] = passwords.hash_password(
+      BENCH_USER, BENCH_PASSWORD, iterations=1000)
+  thread = threading.Thread(target=server.serve_forever, name='server')
+  thread.daemon = True
+  thread.start()
+  return server.server_address[1]
+
+
+def proxy(port):
+  return xmlrpclib.ServerProxy(
+      'https://%s:%s@localhost:%d' % (BENCH_USER, BENCH_PASSWORD, port),
+      allow_none=True, context=ssl._create_unverified_context())
+
+
+def percentile(samples, fraction):
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def summary(samples, errors=0):
+  """Latency statistics in milliseconds for a list of seconds."""
+  if not samples:
+    return {'n': 0, 'errors': errors}
+  return {
+      'n': len(samples),
+      'errors': errors,
+      'mean': 1000 * sum(samples) / len(samples),
+      'p50': 1000 * percentile(samples, .5),
+      'p95': 1000 * percentile(samples, .95),
+      'p99': 1000 * percentile(samples, .99),
+      'max': 1000 * max(samples),
+  }
+
+
+def report(name, stats):
+  if not stats['n']:
+    print '%-16s n=0     errors %d' % (name, stats['errors'])
+    return
+  print ('%-16s n=%-5d mean %7.2fms  p50 %7.2fms  p95 %7.2fms  '
+         'p99 %7.2fms  max %7.2fms  errors %d') % (
+             name, stats['n'], stats['mean'], stats['p50'], stats['p95'],
+             stats['p99'], stats['max'], stats['errors'])
+
+
+def timed_calls(get_proxy, count):
+  samples = []
+  for _ in range(count):
+    start = time.time()
+    get_proxy().status(BENCH_USER)
+    samples.append(time.time() - start)
+  return samples
+
+
+def parse_mix(mix):
+  """Parse 'op=weight,...' into a list of (op, cumulative weight)."""
+  ops, total = [], 0
+  for item in mix.split(','):
+    op, _, weight = item.partition('=')
+    if op not in ('status', 'getLog', 'port1'):
+      raise ValueError('unknown operation in mix: %s' % op)
+    total += int(weight or 1)
+    ops.append((op, total))
+  return ops
+
+
+class Client(threading.Thread):
+  """One load test client making count calls over a kept-alive connection."""
+  def __init__(self, port, count, ops, seed):
+    threading.Thread.__init__(self, name='client-%d' % seed)
+    self.daemon = True
+    self.port = port
+    self.count = count
+    self.ops = ops
+    self.random = random.Random(seed)
+    self.samples = {}
+    self.errors = {}
+
+  def choose(self):
+    pick = self.random.randint(1, self.ops[-1][1])
+    for op, weight in self.ops:
+      if pick <= weight:
+        return op
+
+  def run(self):
+    server = proxy(self.port)
+    disabled = False
+    for _ in range(self.count):
+      op = self.choose()
+      if op == 'status':
+        name, call = op, lambda: server.status(BENCH_USER)
+      elif op == 'getLog':
+        name, call = op, lambda: server.getLog(BENCH_USER, 20)
+      elif disabled:
+        name, call = 'port1Enable', lambda: server.port1Enable(BENCH_USER)
+      else:
+        name, call = 'port1Disable', lambda: server.port1Disable(BENCH_USER)
+      start = time.time()
+      try:
+        call()
+      except (socket.error, httplib.HTTPException, xmlrpclib.Error):
+        self.errors[name] = self.errors.get(name, 0) + 1
+        server = proxy(self.port)
+        continue
+      self.samples.setdefault(name, []).append(time.time() - start)
+      if name.startswith('port1'):
+        disabled = not disabled
+    server('close')()
+
+
+def load_test(port, clients, count, mix):
+  """Run the clients and return the throughput and latency results."""
+  ops = parse_mix(mix)
+  threads = [Client(port, count, ops, seed) for seed in range(clients)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+
+  samples, errors = {}, {}
+  for thread in threads:
+    for name, times in thread.samples.items():
+      samples.setdefault(name, []).extend(times)
+    for name, n in thread.errors.items():
+      errors[name] = errors.get(name, 0) + n
+  all_samples = [t for times in samples.values() for t in times]
+  methods = {}
+  for name in set(samples) | set(errors):
+    methods[name] = summary(samples.get(name, []), errors.get(name, 0))
+  return {
+      'clients': clients,
+      'calls_per_client': count,
+      'mix': mix,
+      'seconds': elapsed,
+      'throughput': len(all_samples) / elapsed,
+      'all': summary(all_samples, sum(errors.values())),
+      'methods': methods,
+  }
+
+
+def main():
+  p = optparse.OptionParser()
+  p.add_option('--count', action='store', type='int', dest='count',
+               help='calls per connection test and per load test client')
+  p.add_option('--clients', action='store', type='int', dest='clients',
+               help='concurrent load test clients, 0 to skip the load test')
+  p.add_option('--mix', action='store', type='string', dest='mix',
+               help='operation weights, e.g. %s' % DEFAULT_MIX)
+  p.add_option('--engine', action='store_true', dest='engine',
+               help='send port 1 commands through a SerialEngine')
+  p.add_option('--json', action='store', type='string', dest='json',
+               help='write the results to this file')
+  p.set_defaults(count=200, clients=8, mix=DEFAULT_MIX, engine=False,
+                 json=None)
+  opt, _ = p.parse_args()
+
+  logging.getLogger('').setLevel(logging.WARNING)
+  web_server_test.log.handlers = []
+  if opt.engine:
+    port = start_server(EngineDummy())
+  else:
+    port = start_server(web_server_test.ArcomDummy())
+
+  results = {
+      'time': time.time(),
+      'python': platform.python_version(),
+      'engine': opt.engine,
+  }
+  results['new connection'] = summary(timed_calls(lambda: proxy(port), opt.count))
+  report('new connection', results['new connection'])
+  keepalive = proxy(port)
+  results['keep-alive'] = summary(timed_calls(lambda: keepalive, opt.count))
+  report('keep-alive', results['keep-alive'])
+  keepalive('close')()
+
+  if opt.clients:
+    load = load_test(port, opt.clients, opt.count, opt.mix)
+    results['load'] = load
+    print '\nload: %d clients x %d calls (%s) in %.2fs, %.1f calls/s' % (
+        opt.clients, opt.count, opt.mix, load['seconds'], load['throughput'])
+    report('all', load['all'])
+    for name, stats in sorted(load['methods'].items()):
+      report(name, stats)
+
+  if opt.json:
+    with open(opt.json, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""
+Tests for the web server's worker pool: idle kept-alive connections
+must not keep new clients waiting for a worker.
+
+Run it from the arcom-server directory so key.pem and cert.pem are
+found:  python web_server_pool_test.py
+"""
+import logging
+import optparse
+import ssl
+import threading
+import time
+import unittest
+import xmlrpclib
+import passwords
+import web_server
+import web_server_test
+
+TEST_USER = 'POOLTEST'
+TEST_PASSWORD = 'pooltest'
+
+
+def start_server():
+  """Start a server for ArcomDummy on a free port; returns the port."""
+  opt = optparse.Values({'port': 0})
+  server = web_server.make_server(web_server_test.ArcomDummy(), opt)
+  web_server.authorizor.valid_users[TEST_USER] = passwords.hash_password(
+      TEST_USER, TEST_PASSWORD, iterations=1000)
+  thread = threading.Thread(target=server.serve_forever, name='server')
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def proxy(port):
+  return xmlrpclib.ServerProxy(
+      'https://%s:%s@localhost:%d' % (TEST_USER, TEST_PASSWORD, port),
+      allow_none=True, context=ssl._create_unverified_context())
+
+
+class IdleConnectionTest(unittest.TestCase):
+  def setUp(self):
+    self.server = start_server()
+    self.port = self.server.server_address[1]
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_new_client_served_when_pool_is_idle(self):
+    idle = []
+    for _ in range(web_server.MAX_WORKERS):
+      client = proxy(self.port)
+      client.status(TEST_USER)          # leaves the connection open
+      idle.append(client)
+    start = time.time()
+    status, _ = proxy(self.port).port1Disable(TEST_USER)
+    self.assertTrue(status)
+    self.assertLess(time.time() - start, 1.0)
+
+  def test_idle_client_reconnects(self):
+    idle = [proxy(self.port) for _ in range(web_server.MAX_WORKERS)]
+    for client in idle:
+      client.status(TEST_USER)
+    proxy(self.port).status(TEST_USER)
+    # Whichever connection was closed for the new client, every old
+    # client can still make calls.
+    for client in idle:
+      self.assertTrue(client.status(TEST_USER)['testing'])
+
+
+if __name__ == '__main__':
+  logging.getLogger('').setLevel(logging.WARNING)
+  web_server_test.log.handlers = []
+  unittest.main()
@@ -1,10 +1,21 @@
 #!/usr/bin/python
 """
 Test framework for web server function of arcom-server
+
+Run it to serve ArcomDummy on --port.  The unit tests run with
+python -m unittest web_server_test
 """
+import base64
 import logging
 import optparse
+import os
+import shutil
 import sys
+import tempfile
+import time
+import unittest
+import events
+import passwords
 import web_server
 
 logFormat = '%(levelname)-7s %(asctime)s %(threadName)s %(message)s' 
@@ -28,6 +39,8 @@ class ArcomDummy(object):
     self.enableTimer = None
     self.port3Bridged = True
     self.identity = 'DummyArcom'
+    self.changes = events.ChangeNotifier(self.statusSnapshot)
+    self.events = events.EventRing()
 
   def register_functions(self, server):
     """Register externally callable methods with XMLRPC server."""
@@ -40,8 +53,10 @@ class ArcomDummy(object):
     server.register_function(self.setDateTime)
     server.register_function(self.status)
     server.register_function(self.getLog)
+    server.register_function(self.queryLog)
     server.register_function(self.getIdentity)
     server.register_function(self.logInterference)
+    server.register_function(self.runMacro)
 
   def authlog(self, auth, string, history=True, level=logging.INFO):
     """We log to a file and the in memory queue."""
@@ -55,6 +70,7 @@ class ArcomDummy(object):
 
     status, msg = True, 'success'
     self.port1Enabled = False
+    self.changes.notify()
     return status, msg
 
   def port1Enable(self, auth, fromTimer=False):
@@ -62,6 +78,7 @@ class ArcomDummy(object):
     self.authlog(auth, 'Port 1 ON')
     status, msg = True, 'success'
     self.port1Enabled = True
+    self.changes.notify()
     return status, msg
 
   def port3Unbridge(self, auth):
@@ -69,6 +86,7 @@ class ArcomDummy(object):
     status, msg = True, 'success'
     if status:
       self.port3Bridged = False
+      self.changes.notify()
     return status, msg
 
   def port3Bridge(self, auth):
@@ -76,6 +94,7 @@ class ArcomDummy(object):
     status, msg = True, 'success'
     if status:
       self.port3Bridged = True
+      self.changes.notify()
     return status, msg
 
   def restart(self, auth):
@@ -86,13 +105,15 @@ class ArcomDummy(object):
     self.authlog(auth, 'Set Date/Time')
     return True, 'time set'
 
+  def runMacro(self, auth, name):
+    self.authlog(auth, 'Macro %s' % name)
+    return True, [(name, True, 'success')]
+
   def logInterference(self, auth, location, minutes):
     self.authlog(auth, 'Log Interference (%s, %s, %s)' % (auth, location, minutes))
     return True
 
-  def status(self, auth):
-    """Non-Standard: returns dict"""
-    self.authlog(auth, "Status Request", history=False, level=logging.INFO)
+  def statusSnapshot(self):
     status = {
         'port1Enabled': self.port1Enabled,
         'port3Bridged': self.port3Bridged,
@@ -101,11 +122,36 @@ class ArcomDummy(object):
         }
     return status
 
+  def status(self, auth):
+    """Non-Standard: returns dict"""
+    self.authlog(auth, "Status Request", history=False, level=logging.INFO)
+    return self.statusSnapshot()
+
+  def waitStatus(self, auth, since, timeout):
+    self.authlog(auth, "Status Wait (since %d)" % since, history=False)
+    version, status, changed = self.changes.wait(since, timeout)
+    return {'version': version, 'status': status, 'changed': changed}
+
+  def waitEvents(self, auth, since, timeout):
+    self.authlog(auth, "Events Wait (since %d)" % since, history=False)
+    return self.events.wait(since, timeout)
+
   def getLog(self, auth, num_entries):
     """Non-Standard: returns an array of strings, possibly empty"""
     self.authlog(auth, "Log Request - %d entries" % num_entries)
     return []
 
+  def queryLog(self, auth, call='', action='', start=0, end=0,
+               cursor=0, limit=50):
+    """Non-Standard: returns a dict with a page of entries and a cursor"""
+    self.authlog(auth, "Log Query - call '%s', action '%s'" % (call, action))
+    return {'entries': [], 'cursor': 0}
+
+  def exportLog(self, auth, call='', action='', start=0, end=0):
+    """Generates (time, call, action, string) for /export"""
+    self.authlog(auth, "Log Export - call '%s', action '%s'" % (call, action))
+    return iter([])
+
   def getIdentity(self, auth):
     """We always log this to record invocations of the client."""
     self.authlog(auth, 'Identity')
@@ -116,6 +162,118 @@ class ArcomDummy(object):
     return False, 'Not implemented yet.'
 
 
+def basic(user, password):
+  return 'Basic ' + base64.b64encode('%s:%s' % (user, password))
+
+
+class AuthorizorTest(unittest.TestCase):
+  USERS = ('ALPHA', 'BRAVO', 'CHARLIE')
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.saved = (web_server.PASSWD_FILE, web_server.CACHE_TTL,
+                  web_server.CACHE_SIZE, passwords.check_password)
+    web_server.PASSWD_FILE = os.path.join(self.dir, 'arcom.passwd')
+    self.write_passwd(['%s:%s' % (user, passwords.hash_password(
+        user, user.lower(), iterations=1000)) for user in self.USERS] +
+                      ['NOHASH', 'BROKEN:pbkdf2_sha256$many$salt$hash'])
+    self.checks = []
+    def check_password(user, password, password_hash):
+      self.checks.append(user)
+      return self.saved[3](user, password, password_hash)
+    passwords.check_password = check_password
+    self.authorizor = web_server.BasicAuthorizor()
+
+  def tearDown(self):
+    (web_server.PASSWD_FILE, web_server.CACHE_TTL,
+     web_server.CACHE_SIZE, passwords.check_password) = self.saved
+    shutil.rmtree(self.dir)
+
+  def write_passwd(self, lines, mtime=None):
+    with open(web_server.PASSWD_FILE, 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+    if mtime:
+      os.utime(web_server.PASSWD_FILE, (mtime, mtime))
+
+  def test_password_checked(self):
+    self.assertTrue(self.authorizor.valid_auth(basic('ALPHA', 'alpha')))
+    self.assertFalse(self.authorizor.valid_auth(basic('ALPHA', 'bravo')))
+    self.assertFalse(self.authorizor.valid_auth(basic('DELTA', 'delta')))
+
+  def test_malformed_header_rejected(self):
+    for header in ('Basic', 'Basic!', 'Basic ***', 'Basic a',
+                   'Basic ' + base64.b64encode('ALPHA'),
+                   'Digest ' + base64.b64encode('ALPHA:alpha')):
+      self.assertFalse(self.authorizor.valid_auth(header), header)
+    self.assertEqual(self.authorizor.user('Basic ***'), None)
+
+  def test_malformed_hash_rejected(self):
+    self.assertFalse(self.authorizor.valid_auth(basic('BROKEN', 'broken')))
+    self.assertNotIn('NOHASH', self.authorizor.valid_users)
+
+  def test_cache_expires(self):
+    web_server.CACHE_TTL = 0.1
+    for _ in range(3):
+      self.assertTrue(self.authorizor.valid_auth(basic('ALPHA', 'alpha')))
+    self.assertEqual(self.checks, ['ALPHA'])
+    time.sleep(0.15)
+    self.assertTrue(self.authorizor.valid_auth(basic('ALPHA', 'alpha')))
+    self.assertEqual(self.checks, ['ALPHA', 'ALPHA'])
+
+  def test_cache_drops_least_recently_used(self):
+    web_server.CACHE_SIZE = 2
+    for user in ('ALPHA', 'BRAVO', 'ALPHA', 'CHARLIE', 'ALPHA', 'BRAVO'):
+      self.assertTrue(self.authorizor.valid_auth(basic(user, user.lower())))
+    self.assertEqual(self.checks, ['ALPHA', 'BRAVO', 'CHARLIE', 'BRAVO'])
+
+  def test_reload_on_mtime_change(self):
+    self.assertTrue(self.authorizor.valid_auth(basic('ALPHA', 'alpha')))
+    self.write_passwd(['DELTA:' + passwords.hash_password(
+        'DELTA', 'delta', iterations=1000)], time.time() + 10)
+    self.authorizor.checked = 0
+    self.assertTrue(self.authorizor.valid_auth(basic('DELTA', 'delta')))
+    self.assertFalse(self.authorizor.valid_auth(basic('ALPHA', 'alpha')))
+
+
+class CheckParamsTest(unittest.TestCase):
+  def setUp(self):
+    self.arcom = ArcomDummy()
+
+  def check(self, func, params):
+    return web_server.check_params(func, params)
+
+  def test_arity(self):
+    method = self.arcom.port1Disable        # (auth, interval=0)
+    self.assertEqual(self.check(method, ['TEST']), None)
+    self.assertEqual(self.check(method, ['TEST', 60]), None)
+    self.assertEqual(self.check(method, []),
+                     'takes 1 to 2 params, 0 given')
+    self.assertEqual(self.check(method, ['TEST', 60, 1]),
+                     'takes 1 to 2 params, 3 given')
+    self.assertEqual(self.check(self.arcom.status, ['TEST', 1]),
+                     'takes 1 params, 2 given')
+
+  def test_keywords(self):
+    method = self.arcom.port1Disable
+    self.assertEqual(self.check(method, {'auth': 'TEST'}), None)
+    self.assertEqual(self.check(method, {'auth': 'TEST', 'interval': 60}),
+                     None)
+    self.assertEqual(self.check(method, {'interval': 60}),
+                     'missing params: auth')
+    self.assertEqual(self.check(method, {'auth': 'TEST', 'minutes': 1}),
+                     'unexpected params: minutes')
+
+  def test_varargs_and_keywords(self):
+    def fan(auth, *args, **kwargs):
+      pass
+    self.assertEqual(self.check(fan, ['TEST', 1, 2, 3]), None)
+    self.assertEqual(self.check(fan, {'auth': 'TEST', 'other': 1}), None)
+    self.assertEqual(self.check(fan, []), 'takes 1 params, 0 given')
+
+  def test_not_python_function(self):
+    self.assertEqual(self.check(len, [1, 2]), None)
+
+
 def main():
   p = optparse.OptionParser()
 
@@ -1,8 +1,23 @@
 """Web logging for interference.
    This module implements rudimentary web logging by posting to a Google Form
    which then populates a Google Sheet.
+
+   Reports go through a durable outbox (see outbox.py) so logging never
+   waits on Google; one pooled HTTP session is shared by the senders.
+   requests is slow to import, so that waits for the first report.
    """
-import requests
+import threading
+import time
+import metrics
+import outbox
+
+weblogDefaults = {
+    'outbox': 'arcom.outbox',
+    'senders': '2',
+    'timeout': '10',
+    'max_attempts': '20',
+}
+
 
 class LogGoogle(object):
   """Post the event(s) to Google interference log.
@@ -11,35 +26,111 @@ class LogGoogle(object):
   """
   testing = False
   url_base = ''
-  form_data = {}
   user_agent = {'User-Agent':'arcom-server.py v1.0'}
 
   def __init__(self, cfg, testing):
     self.testing = testing
-    self.url_base = cfg.get('google form', 'url_base')
+    self.apply_settings(self.read_settings(cfg))
+    self.senders = int(self.setting(cfg, 'senders'))
+    self.session = None
+    self.session_lock = threading.Lock()
+    self.outbox = None
+    if not testing:
+      self.outbox = outbox.Outbox(
+          self.setting(cfg, 'outbox'), self.post, senders=self.senders,
+          max_attempts=int(self.setting(cfg, 'max_attempts')))
+
+  def setting(self, cfg, key):
+    if cfg.has_option('weblog', key):
+      return cfg.get('weblog', key)
+    return weblogDefaults[key]
+
+  def read_settings(self, cfg):
+    """Read the form and timeout from cfg without using them.  Returns
+       them for apply_settings().
+       """
+    url_base = cfg.get('google form', 'url_base')
+    form_data = {}
+    defaults = cfg.defaults()
     for entry in cfg.items('google form'):
       key, value = entry
-      self.form_data[key] = value
-    self.form_data['draftResponse'] = []
-    self.form_data['pageHistory'] = 0
-    self.user_agent['Referer'] = self.url_base + '/viewform'
+      if key != 'url_base' and key not in defaults:
+        form_data[key] = value
+    form_data['draftResponse'] = []
+    form_data['pageHistory'] = 0
+    user_agent = dict(LogGoogle.user_agent)
+    user_agent['Referer'] = url_base + '/viewform'
+    return {'timeout': float(self.setting(cfg, 'timeout')),
+            'url_base': url_base,
+            'form_data': form_data,
+            'user_agent': user_agent}
+
+  def apply_settings(self, settings):
+    """Use settings from read_settings().  The outbox and senders are
+       kept.
+       """
+    self.timeout = settings['timeout']
+    self.url_base = settings['url_base']
+    self.form_data = settings['form_data']
+    self.user_agent = settings['user_agent']
+
+  def http_session(self):
+    """The shared session, created on first use."""
+    with self.session_lock:
+      if self.session is None:
+        import requests
+        import requests.adapters
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.senders))
+        session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.senders))
+        self.session = session
+      return self.session
+
+  def form(self, call, location, minutes):
+    """Return the form fields for one interference report."""
+    form_data = dict(self.form_data)
+    form_data['entry.1984381604'] = '__other_option__'
+    form_data['entry.1984381604.other_option_response'] = call
+    form_data['entry.773252163'] = location
+    form_data['entry.530211156'] = 'Yes - ' + str(minutes) + ' min'
+    return form_data
+
+  def post(self, form_data):
+    """Post one report to the Google form.  Called by the outbox."""
+    start = time.time()
+    try:
+      resp = self.http_session().post(self.url_base+'/formResponse',
+                                      data=form_data,
+                                      headers=self.user_agent,
+                                      timeout=self.timeout)
+    except Exception:
+      metrics.weblog_post_seconds.since(start, ('error',))
+      raise
+    metrics.weblog_post_seconds.since(start, (str(resp.status_code),))
+    if resp.status_code == 200:
+      return True, "Action logged to Google."
+    else:
+      return False, "Logging to Google failed: %s" % resp.status_code
 
   def log(self, call, location, minutes):
-    """Post an interference report to Google form."""
-    self.form_data['entry.1984381604'] = '__other_option__'
-    self.form_data['entry.1984381604.other_option_response'] = call
-    self.form_data['entry.773252163'] = location
-    self.form_data['entry.530211156'] = 'Yes - ' + str(minutes) + ' min'
+    """Queue an interference report for the Google form."""
+    form_data = self.form(call, location, minutes)
     if self.testing:
       print 'URL: %s' % self.url_base+'/formResponse'
-      print self.form_data
+      print form_data
       print 'User agent: %s' % self.user_agent
       return True, "Action NOT logged.  (Testing mode)"
 
-    resp = requests.post(self.url_base+'/formResponse',
-                         data=self.form_data,
-                         headers=self.user_agent)
-    if resp.status_code == 200:
-      return True, "Action logged to Google."
-    else:
-      return False, "Logging to Google failed: %s" % resp.status_code
+    try:
+      self.outbox.put(form_data)
+    except (IOError, OSError) as e:
+      return False, "Queueing for Google failed: %s" % e
+    return True, "Action queued for Google."
+
+  def stats(self):
+    """Outbox queue depth and latency."""
+    if self.outbox is None:
+      return {}
+    return self.outbox.stats()
@@ -5,8 +5,19 @@
 
    Copyright 2016 Costa Katsaniotis, KG7AUL
    Released under Apache License V2.0
-   http://www.apache.org/licenses/LICENSE-2.0.txt  
+   http://www.apache.org/licenses/LICENSE-2.0.txt
+
+   With --standin, reports go to a local stand-in for the Google form
+   that can be made slow or flaky, and the outbox stats are printed
+   until everything is delivered.
 """
+import optparse
+import random
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 from configparser import ConfigParser
 import weblog_Google as weblog
 
@@ -17,14 +28,72 @@ defaults = {
 cfg = ConfigParser(defaults)
 
 
+class StandinServer(ThreadingMixIn, HTTPServer):
+  """Local stand-in for the Google form."""
+  daemon_threads = True
+  delay = 0.0
+  fail = 0.0
+  received = 0
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+  def do_POST(self):
+    self.rfile.read(int(self.headers.getheader('content-length', 0)))
+    time.sleep(self.server.delay)
+    if random.random() < self.server.fail:
+      self.send_response(500)
+    else:
+      self.server.received += 1
+      self.send_response(200)
+    self.send_header('Content-length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
 def main():
-  """Main module - parse args and start server"""
-  global testing, verbose
+  """Main module - parse args and post report(s)"""
+  p = optparse.OptionParser()
+  p.add_option('--standin', action='store', type='int', dest='standin',
+               help='run a stand-in form server on this port')
+  p.add_option('--count', action='store', type='int', dest='count')
+  p.add_option('--delay', action='store', type='float', dest='delay',
+               help='stand-in response delay in seconds')
+  p.add_option('--fail', action='store', type='float', dest='fail',
+               help='fraction of posts the stand-in fails')
+  p.set_defaults(standin=0, count=1, delay=0.0, fail=0.0)
+  opt, _ = p.parse_args()
 
   cfg.read('arcom-server.conf')
 
+  if opt.standin:
+    server = StandinServer(('localhost', opt.standin), StandinHandler)
+    server.delay = opt.delay
+    server.fail = opt.fail
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    if not cfg.has_section('google form'):
+      cfg.add_section('google form')
+    cfg.set('google form', 'url_base', 'http://localhost:%d' % opt.standin)
+    if not cfg.has_section('weblog'):
+      cfg.add_section('weblog')
+    cfg.set('weblog', 'outbox', tempfile.mkdtemp(prefix='arcom.outbox.'))
+    cfg.set('weblog', 'max_attempts', '5')
+
   w = weblog.LogGoogle(cfg, False)
-  print 'status %s: %s' % w.log('KD7DK/TEST', 'CN87tq', 5)
+  w.outbox.backoff = 0.5
+  start = time.time()
+  for i in range(opt.count):
+    print 'status %s: %s' % w.log('KD7DK/TEST', 'CN87tq', 5)
+  print 'queued %d in %.3fs' % (opt.count, time.time() - start)
+  while True:
+    stats = w.stats()
+    print stats
+    if not stats['queued'] and not stats['inflight']:
+      break
+    time.sleep(1)
 
 
 if __name__ == '__main__':